@@ -0,0 +1,253 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, request
+from flask_jwt_extended import get_jwt_identity
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__('rate limit exceeded')
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__('too many concurrent requests')
+        self.retry_after = retry_after
+
+
+#
+# Leases and token buckets in one mapping shared by the workers of a host, guarded by a single
+# lock (lockf on the file behind a threading lock, or a multiprocessing lock for an anonymous
+# mapping inherited by forked workers). The layout follows the configured groups, a file written
+# with another layout is reset.
+#
+class AdmissionState(object):
+    HEADER = struct.Struct('<16s')
+    LEASE = struct.Struct('<qd')  # pid, acquired at
+    BUCKET = struct.Struct('<Qdd')  # key hash, tokens, updated at
+    PROBES = 8
+
+    def __init__(self, groups, max_leases, buckets, path=None):
+        self.slots = {name: i for i, name in enumerate(sorted(groups))}
+        self.max_leases = max_leases
+        self.buckets = buckets
+        self.lease_offset = self.HEADER.size
+        self.bucket_offset = self.lease_offset + len(self.slots) * max_leases * self.LEASE.size
+        length = self.bucket_offset + buckets * self.BUCKET.size
+        layout = hashlib.blake2b(repr((sorted(groups), max_leases, buckets)).encode(), digest_size=16).digest()
+
+        if path:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != length or os.pread(fd, self.HEADER.size, 0) != layout:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, length)
+                    os.pwrite(fd, layout, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, length)
+            # lockf only excludes other processes, threads of this one queue on the lock first
+            self._lock_fd, self._lock = fd, threading.Lock()
+        else:
+            self._map = mmap.mmap(-1, length)
+            self._lock_fd, self._lock = None, multiprocessing.Lock()
+            self.HEADER.pack_into(self._map, 0, layout)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._lock_fd is None:
+                yield
+                return
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+
+    def _lease_free(self, offset, now, timeout, check_pid):
+        pid, acquired = self.LEASE.unpack_from(self._map, offset)
+        if not pid or now - acquired > timeout:
+            return True
+        if check_pid:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True  # the worker died holding it
+            except PermissionError:
+                pass
+        return False
+
+    #
+    # Take one of the first `limit` lease slots of `group`, returns its offset or None when all are
+    # held. Leases older than `timeout` or held by a dead worker count as free.
+    #
+    def acquire(self, group, limit, timeout):
+        base = self.lease_offset + self.slots[group] * self.max_leases * self.LEASE.size
+        offsets = [base + i * self.LEASE.size for i in range(min(limit, self.max_leases))]
+        now = time.time()
+        with self._locked():
+            for check_pid in (False, True):
+                for offset in offsets:
+                    if self._lease_free(offset, now, timeout, check_pid):
+                        self.LEASE.pack_into(self._map, offset, os.getpid(), now)
+                        return offset
+        return None
+
+    def release(self, offset):
+        with self._locked():
+            self.LEASE.pack_into(self._map, offset, 0, 0.0)
+
+    def in_flight(self, group, timeout):
+        base = self.lease_offset + self.slots[group] * self.max_leases * self.LEASE.size
+        now = time.time()
+        return sum(not self._lease_free(base + i * self.LEASE.size, now, timeout, False)
+                   for i in range(self.max_leases))
+
+    #
+    # Take a token from the bucket of `key`, returns 0 or the seconds until one is available.
+    # Buckets live in an open addressed table; when every probed slot is taken the stalest one
+    # is reused, which can only reset somebody's bucket to full, never limit the wrong client.
+    #
+    def take(self, key, rate, burst):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        now = time.time()
+        with self._locked():
+            target, stalest = None, None
+            for probe in range(self.PROBES):
+                offset = self.bucket_offset + ((digest + probe) % self.buckets) * self.BUCKET.size
+                owner, tokens, updated = self.BUCKET.unpack_from(self._map, offset)
+                if owner == digest:
+                    target = offset
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                    break
+                if stalest is None or updated < stalest[1]:
+                    stalest = offset, updated
+            if target is None:
+                target, tokens = stalest[0], burst
+
+            if tokens >= 1:
+                self.BUCKET.pack_into(self._map, target, digest, tokens - 1, now)
+                return 0
+            self.BUCKET.pack_into(self._map, target, digest, tokens, now)
+            return (1 - tokens) / rate
+
+
+#
+# Admission control for expensive or abusable routes, next to limit_payload_length.
+# @admission.concurrency(group) caps the requests of a group in flight on the host
+# (ADMISSION_CONCURRENCY: group -> (limit, queue seconds)); a request finding the group full
+# waits up to its queue time for a slot and is shed with 503 otherwise.
+# @admission.rate_limit(group) is a token bucket per user, or per client address for
+# anonymous routes (ADMISSION_RATES: group -> (tokens per second, burst)), 429 when empty.
+# Both answer with Retry-After. Groups missing from the config are not limited.
+# Shed and admitted requests are counted per worker and exported at /api/metrics.
+#
+class AdmissionControl(object):
+    def __init__(self):
+        self.enabled = False
+        self.state = None
+        self.concurrency_limits, self.rates = {}, {}
+        self.lease_timeout = 300
+        self.trusted_proxies = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_ENABLED', False)
+        self.concurrency_limits = dict(app.config.get('ADMISSION_CONCURRENCY') or {})
+        self.rates = dict(app.config.get('ADMISSION_RATES') or {})
+        self.lease_timeout = app.config.get('ADMISSION_LEASE_TIMEOUT', self.lease_timeout)
+        self.trusted_proxies = app.config.get('ADMISSION_TRUSTED_PROXIES', 0)
+        self.reset_stats()
+        self.state = None
+        if self.enabled:
+            max_leases = max([limit for limit, _ in self.concurrency_limits.values()] or [1])
+            self.state = AdmissionState(self.concurrency_limits, max_leases,
+                                        app.config.get('ADMISSION_BUCKETS', 1 << 16),
+                                        app.config.get('ADMISSION_STATE_PATH'))
+
+    def reset_stats(self):
+        self.stats = {'admitted': {}, 'shed': {}}
+
+    def _count(self, kind, group, reason=None):
+        key = (group, reason) if reason else group
+        with self._lock:
+            self.stats[kind][key] = self.stats[kind].get(key, 0) + 1
+
+    def _client_key(self):
+        identity = get_jwt_identity()
+        if identity is not None:
+            return 'user:{}'.format(identity)
+        # behind ADMISSION_TRUSTED_PROXIES proxies the client is the address the outermost one saw
+        route = request.access_route
+        if self.trusted_proxies and len(route) >= self.trusted_proxies:
+            return 'addr:{}'.format(route[-self.trusted_proxies])
+        return 'addr:{}'.format(request.remote_addr)
+
+    def concurrency(self, group):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or group not in self.concurrency_limits:
+                    return f(*args, **kwargs)
+
+                limit, queue_seconds = self.concurrency_limits[group]
+                deadline = time.time() + queue_seconds
+                delay = 0.005
+                lease = self.state.acquire(group, limit, self.lease_timeout)
+                while lease is None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._count('shed', group, 'concurrency')
+                        raise Overloaded(max(1, int(math.ceil(queue_seconds))))
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.05)
+                    lease = self.state.acquire(group, limit, self.lease_timeout)
+
+                self._count('admitted', group)
+                try:
+                    response = current_app.make_response(f(*args, **kwargs))
+                except BaseException:
+                    self.state.release(lease)
+                    raise
+                # a streamed body is still being produced after the view returns
+                if response.is_streamed:
+                    response.call_on_close(lambda: self.state.release(lease))
+                else:
+                    self.state.release(lease)
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def rate_limit(self, group):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or group not in self.rates:
+                    return f(*args, **kwargs)
+
+                rate, burst = self.rates[group]
+                wait = self.state.take('{}:{}'.format(group, self._client_key()), rate, burst)
+                if wait:
+                    self._count('shed', group, 'rate')
+                    raise RateLimited(max(1, int(math.ceil(wait))))
+                return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
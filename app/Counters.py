@@ -0,0 +1,100 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from app import db
+from app.Models import Article, Channel, Comment, favorite_table, subscription_table
+
+
+#
+# Denormalized counters are adjusted with a single UPDATE ... SET x = x + delta in the same
+# transaction as the write they describe, so concurrent writers never lose an increment.
+# Counter writes aren't edits: the "updated" column is set to itself so its onupdate doesn't fire.
+#
+_UPDATED_COLUMNS = {Article: Article.article_updated, Channel: Channel.channel_updated}
+
+
+def _update_counter(query, model, counter, value):
+    updated = _UPDATED_COLUMNS[model]
+    return query.update({counter: value, updated: updated}, synchronize_session=False)
+
+
+def adjust_article_likes(aid, delta):
+    _update_counter(Article.query.filter_by(aid=aid), Article, Article.like_count, Article.like_count + delta)
+
+
+def adjust_article_comments(aid, delta):
+    _update_counter(Article.query.filter_by(aid=aid), Article, Article.comment_count, Article.comment_count + delta)
+
+
+def adjust_channel_subscribers(cid, delta):
+    _update_counter(Channel.query.filter_by(cid=cid), Channel, Channel.subscriber_count,
+                    Channel.subscriber_count + delta)
+
+
+def adjust_articles_likes(aids, delta):
+    if aids:
+        _update_counter(Article.query.filter(Article.aid.in_(aids)), Article, Article.like_count,
+                        Article.like_count + delta)
+
+
+def adjust_channels_subscribers(cids, delta):
+    if cids:
+        _update_counter(Channel.query.filter(Channel.cid.in_(cids)), Channel, Channel.subscriber_count,
+                        Channel.subscriber_count + delta)
+
+
+#
+# Recount the likes of `aids` / the subscribers of `cids` from the join tables, in the current
+# transaction, when a bulk write can't tell which of its rows it changed.
+#
+def recount_articles_likes(aids):
+    if aids:
+        likes = select([func.count()]).where(favorite_table.c.fav_article_aid == Article.aid).as_scalar()
+        _update_counter(Article.query.filter(Article.aid.in_(aids)), Article, Article.like_count, likes)
+
+
+def recount_channels_subscribers(cids):
+    if cids:
+        subscribers = select([func.count()]).where(subscription_table.c.sub_channel_cid == Channel.cid).as_scalar()
+        _update_counter(Channel.query.filter(Channel.cid.in_(cids)), Channel, Channel.subscriber_count, subscribers)
+
+
+def _reconcile(model, pk, counter, actual, batch_size):
+    fixed = 0
+    last_key = 0
+    while True:
+        keys = [row[0] for row in db.session.query(pk).filter(pk > last_key).order_by(pk).limit(batch_size)]
+        if not keys:
+            break
+
+        fixed += _update_counter(model.query.filter(pk.in_(keys)).filter(counter != actual), model, counter, actual)
+        db.session.commit()
+        last_key = keys[-1]
+
+    return fixed
+
+
+#
+# Recompute every counter from the source tables, batch by batch on the primary key.
+# Only rows that drifted are written. Returns the number of fixed rows per counter.
+#
+def reconcile_counters(batch_size=10000):
+    likes = select([func.count()]).where(favorite_table.c.fav_article_aid == Article.aid).as_scalar()
+    comments = select([func.count()]).where(Comment.comment_article_aid == Article.aid).as_scalar()
+    subscribers = select([func.count()]).where(subscription_table.c.sub_channel_cid == Channel.cid).as_scalar()
+
+    return {
+        'like_count': _reconcile(Article, Article.aid, Article.like_count, likes, batch_size),
+        'comment_count': _reconcile(Article, Article.aid, Article.comment_count, comments, batch_size),
+        'subscriber_count': _reconcile(Channel, Channel.cid, Channel.subscriber_count, subscribers, batch_size)
+    }
+
+
+@click.command('reconcile-counters')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows checked per transaction.')
+@with_appcontext
+def reconcile_counters_command(batch_size):
+    """Recompute drifted like/comment/subscriber counters."""
+    for counter, fixed in reconcile_counters(batch_size).items():
+        click.echo('{}: {} row(s) fixed'.format(counter, fixed))
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+
+
+class HashingPoolSaturated(Exception):
+    def __init__(self, retry_after):
+        super(HashingPoolSaturated, self).__init__('password hashing pool saturated')
+        self.retry_after = retry_after
+
+
+#
+# Functions below run inside the pool processes, each keeps its own PasswordHasher.
+# The submit time travels with the job so the parent can tell queueing from hashing.
+#
+_worker_hasher = None
+
+
+def _hasher():
+    global _worker_hasher
+    if _worker_hasher is None:
+        _worker_hasher = PasswordHasher()
+    return _worker_hasher
+
+
+def _hash(password, submitted):
+    started = time.time()
+    return _hasher().hash(password), started - submitted
+
+
+def _verify(password_hash, password, submitted):
+    started = time.time()
+    try:
+        return _hasher().verify(password_hash, password), started - submitted
+    except VerifyMismatchError:
+        return False, started - submitted
+
+
+#
+# Argon2 hashing off the request workers.
+# Each web worker owns a small process pool and admits at most HASH_POOL_SIZE + HASH_QUEUE_DEPTH
+# jobs; anything past that is refused right away so logins can't pile up behind each other.
+# HASH_POOL_SIZE = 0 hashes inline, which is what scripts outside the app get.
+#
+class HashingPool(object):
+    WAIT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.size, self.depth, self.timeout, self.retry_after = 0, 0, None, 1
+        self._executor, self._pid = None, None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def init_app(self, app):
+        self.size = app.config.get('HASH_POOL_SIZE', 0)
+        self.depth = app.config.get('HASH_QUEUE_DEPTH', 0)
+        self.timeout = app.config.get('HASH_TIMEOUT')
+        self.retry_after = app.config.get('HASH_RETRY_AFTER', 1)
+        self._slots = threading.BoundedSemaphore(self.size + self.depth) if self.size else None
+        self.shutdown()
+
+    def reset_stats(self):
+        self.stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'wait_seconds_sum': 0.0,
+            'wait_seconds_max': 0.0,
+            'wait_buckets': [0] * len(self.WAIT_BUCKETS)
+        }
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor, self._pid = None, None
+
+    def _get_executor(self):
+        # pools don't survive a fork, a preloaded app gets a fresh one per worker
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor, self._pid = ProcessPoolExecutor(max_workers=self.size), os.getpid()
+        return self._executor
+
+    def _record(self, waited):
+        with self._lock:
+            self.stats['submitted'] += 1
+            self.stats['wait_seconds_sum'] += waited
+            self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+            for i, bound in enumerate(self.WAIT_BUCKETS):
+                if waited <= bound:
+                    self.stats['wait_buckets'][i] += 1
+                    break
+
+    def _run(self, fn, *args):
+        if not self.size:
+            return fn(*args, time.time())[0]
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise HashingPoolSaturated(self.retry_after)
+
+        try:
+            future = self._get_executor().submit(fn, *args, time.time())
+        except BaseException:
+            slots.release()
+            raise
+        # a job we stop waiting for still holds its place in the pool until it is done
+        future.add_done_callback(lambda _: slots.release())
+
+        try:
+            result, waited = future.result(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self.stats['rejected'] += 1
+            raise HashingPoolSaturated(self.retry_after)
+
+        self._record(waited)
+        return result
+
+    def hash(self, password):
+        return self._run(_hash, password)
+
+    def verify(self, password_hash, password):
+        return self._run(_verify, password_hash, password)
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import namedtuple
+
+from flask_jwt_extended import get_jwt_claims, get_jwt_identity
+
+from app import db
+from app.Loading import load_uid
+from app.Models import User, UserRole
+
+
+class Identity(namedtuple('Identity', ['uid', 'username', 'role'])):
+    __slots__ = ()
+
+    def is_admin(self):
+        return self.role & UserRole.Admin.value != 0
+
+
+# only the uid: the role is read through identity_cache, so a role change applies to tokens already issued
+def identity_claims(user):
+    return {'uid': user.uid}
+
+
+#
+# uid -> (role, is_active) with a short TTL, so a worker only asks the database once per user
+# per IDENTITY_CACHE_TTL seconds. Admin changes invalidate the entry on the worker that made them,
+# other workers pick them up when their entry expires.
+#
+class IdentityCache(object):
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl, self.max_size = ttl, max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', self.ttl)
+        self.max_size = app.config.get('IDENTITY_CACHE_SIZE', self.max_size)
+        self.clear()
+
+    def get(self, uid):
+        entry = self._entries.get(uid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1], entry[2]
+
+    def put(self, uid, role, is_active):
+        now = time.time()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[uid] = (now + self.ttl, role, is_active)
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._entries.pop(uid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+identity_cache = IdentityCache()
+
+
+#
+# Resolve the caller of a @jwt_required route.
+# Returns None for unknown or disabled users. Tokens issued before uid claims existed
+# fall back to a username lookup.
+#
+def current_identity():
+    username = get_jwt_identity()
+    uid = get_jwt_claims().get('uid')
+    if uid is None:
+        uid = load_uid(username)
+        if uid is None:
+            return None
+
+    cached = identity_cache.get(uid)
+    if cached is None:
+        row = db.session.query(User.role, User.is_active).filter_by(uid=uid).first()
+        if row is None:
+            return None
+        identity_cache.put(uid, row.role, row.is_active)
+        cached = row.role, row.is_active
+
+    role, is_active = cached
+    if not is_active:
+        return None
+    return Identity(uid, username, role)
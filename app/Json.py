@@ -0,0 +1,165 @@
+import json
+from datetime import date, datetime, timezone
+from uuid import UUID
+
+from flask import current_app, json as flask_json
+from flask import jsonify as flask_jsonify
+from flask.json import JSONEncoder
+from werkzeug.http import http_date
+
+BACKENDS = ('orjson', 'ujson', 'json')
+# ujson has to call back into Python for every datetime, which costs it its lead over the standard library
+AUTO_BACKENDS = ('orjson', 'json')
+
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+# werkzeug's http_date, without the detour through a time tuple. Naive datetimes are UTC.
+def _http_datetime(o):
+    if o.tzinfo is not None:
+        o = o.astimezone(timezone.utc)
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (_WEEKDAYS[o.weekday()], o.day, _MONTHS[o.month - 1], o.year,
+                                                   o.hour, o.minute, o.second)
+
+
+def _default(datetime_format):
+    def default(o):
+        if isinstance(o, datetime):
+            if datetime_format == 'http':
+                return _http_datetime(o)
+            # stored timestamps are UTC
+            return o.isoformat() + '+00:00' if o.tzinfo is None else o.isoformat()
+        if isinstance(o, date):
+            return http_date(o) if datetime_format == 'http' else o.isoformat()
+        if isinstance(o, UUID):
+            return str(o)
+        if hasattr(o, '__html__'):
+            return str(o.__html__())
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+    return default
+
+
+def _orjson_dumps(default, datetime_format, sort_keys, ensure_ascii):
+    import orjson
+
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    # orjson writes ISO 8601 itself, http dates go through default
+    if datetime_format == 'iso':
+        option |= orjson.OPT_NAIVE_UTC
+    else:
+        option |= orjson.OPT_PASSTHROUGH_DATETIME
+    pretty = option | orjson.OPT_INDENT_2
+
+    def dumps(obj, indent=False):
+        return orjson.dumps(obj, default=default, option=pretty if indent else option)
+
+    return dumps
+
+
+def _ujson_dumps(default, datetime_format, sort_keys, ensure_ascii):
+    import ujson
+
+    def dumps(obj, indent=False):
+        return ujson.dumps(obj, default=default, sort_keys=sort_keys, indent=2 if indent else 0,
+                           ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    return dumps
+
+
+def _json_dumps(default, datetime_format, sort_keys, ensure_ascii):
+    compact = json.JSONEncoder(default=default, sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                               separators=(',', ':'))
+    pretty = json.JSONEncoder(default=default, sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                              separators=(', ', ': '), indent=2)
+
+    def dumps(obj, indent=False):
+        return (pretty if indent else compact).encode(obj).encode('utf-8')
+
+    return dumps
+
+
+_FACTORIES = {'orjson': _orjson_dumps, 'ujson': _ujson_dumps, 'json': _json_dumps}
+
+
+#
+# Response bodies are encoded by orjson when it is installed, else by the standard library, or by
+# the backend named in JSON_BACKEND. Every backend writes bytes directly and
+# formats dates per JSON_DATETIME_FORMAT: 'http' (RFC 1123, what flask.jsonify always sent) or
+# 'iso' (ISO 8601, which orjson writes natively without calling back into Python).
+# Keys are sorted and bodies indented like flask.jsonify, following JSON_SORT_KEYS and
+# JSONIFY_PRETTYPRINT_REGULAR (or debug). Only the standard library honours JSON_AS_ASCII,
+# the others always send UTF-8.
+#
+class JsonEncoding(object):
+    def __init__(self):
+        self.backend = 'json'
+        self.datetime_format = 'http'
+        self.dumps = _json_dumps(_default('http'), 'http', True, True)
+
+    def init_app(self, app):
+        backend = app.config.get('JSON_BACKEND', 'auto')
+        datetime_format = app.config.get('JSON_DATETIME_FORMAT', 'http')
+        if datetime_format not in ('http', 'iso'):
+            raise ValueError('JSON_DATETIME_FORMAT must be "http" or "iso", not {!r}'.format(datetime_format))
+
+        if backend == 'auto':
+            backend = next(name for name in AUTO_BACKENDS if self._available(name))
+        elif backend not in _FACTORIES:
+            raise ValueError('unknown JSON_BACKEND {!r}, use one of {} or "auto"'.format(backend, BACKENDS))
+        elif not self._available(backend):
+            raise RuntimeError('JSON_BACKEND = "{0}" requires the {0} package'.format(backend))
+
+        default = _default(datetime_format)
+        self.backend, self.datetime_format = backend, datetime_format
+        self.dumps = _FACTORIES[backend](default, datetime_format, app.config.get('JSON_SORT_KEYS', True),
+                                         app.config.get('JSON_AS_ASCII', True))
+
+        # flask.json (request parsing, extension error responses) formats dates the same way
+        class Encoder(JSONEncoder):
+            def default(self, o):
+                if isinstance(o, date):
+                    return default(o)
+                return JSONEncoder.default(self, o)
+
+        app.json_encoder = Encoder
+        app.extensions['json_encoding'] = self
+
+    @staticmethod
+    def _available(name):
+        try:
+            __import__(name)
+        except ImportError:
+            return False
+        return True
+
+
+#
+# Compact UTF-8 JSON of `obj` through the app's JsonEncoding.
+#
+def dumps(obj):
+    encoding = current_app.extensions.get('json_encoding')
+    if encoding is None:
+        return flask_json.dumps(obj).encode('utf-8')
+    return encoding.dumps(obj)
+
+
+#
+# flask.jsonify through the app's JsonEncoding.
+#
+def jsonify(*args, **kwargs):
+    encoding = current_app.extensions.get('json_encoding')
+    if encoding is None:
+        return flask_jsonify(*args, **kwargs)
+
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+
+    indent = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+    return current_app.response_class(encoding.dumps(data, indent) + b'\n',
+                                      mimetype=current_app.config['JSONIFY_MIMETYPE'])
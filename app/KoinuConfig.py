@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 
 
@@ -15,11 +16,96 @@ class KoinuConfig(object):
 
     # sqlalchemy config
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # applied to the primary and every replica engine, recycle below mysql wait_timeout
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_recycle': 280
+    }
+
+    # @read_only handlers are spread over these, empty keeps everything on the primary
+    SQLALCHEMY_REPLICA_URIS = []
+    # after a write the client's reads stay on the primary this long, keep above replication lag
+    READ_YOUR_WRITES_SECONDS = 5
 
     # jwt config
     JWT_BLACKLIST_ENABLED = True
     JWT_BLACKLIST_TOKEN_CHECKS = ['access', 'refresh']
 
+    # token revocation, backend is one of 'memory' (single process), 'sqlite' (one host) or 'redis'
+    REVOCATION_BACKEND = 'sqlite'
+    REVOCATION_SQLITE_PATH = os.path.join(tempfile.gettempdir(), 'koinu-revoked.db')
+    REVOCATION_REDIS_URL = 'redis://localhost:6379/0'
+    REVOCATION_BLOOM = True
+    REVOCATION_BLOOM_BITS = 1 << 23
+    # with redis the bloom filter needs a file shared by all workers, leave unset across hosts
+    REVOCATION_BLOOM_PATH = None
+
+    # uid -> role/active status cache used by authenticated routes
+    IDENTITY_CACHE_TTL = 30
+    IDENTITY_CACHE_SIZE = 10000
+
+    # subscription feeds, channels with more subscribers than the limit are read on demand
+    TIMELINE_FANOUT_LIMIT = 10000
+    TIMELINE_BACKFILL = 50
+
+    # cache for public read endpoints, backend is None (off), 'local' (per worker) or 'redis' (shared)
+    RESPONSE_CACHE_BACKEND = 'local'
+    RESPONSE_CACHE_TTL = 30
+    RESPONSE_CACHE_SIZE = 2048
+    RESPONSE_CACHE_REDIS_URL = 'redis://localhost:6379/1'
+
+    # per request sql metrics served at /api/metrics, workers share them through per-pid files in METRICS_DIR
+    METRICS_ENABLED = True
+    METRICS_DIR = os.path.join(tempfile.gettempdir(), 'koinu-metrics')
+    METRICS_N_PLUS_ONE_THRESHOLD = 10
+    METRICS_SLOW_QUERY_SECONDS = 0.5
+    METRICS_FLUSH_INTERVAL = 1.0
+
+    # response encoding, backend 'auto' (orjson if installed, else json), 'orjson', 'ujson' or 'json';
+    # dates as 'http' (Sun, 06 Nov 1994 08:49:37 GMT) or 'iso' (1994-11-06T08:49:37+00:00)
+    JSON_BACKEND = 'auto'
+    JSON_DATETIME_FORMAT = 'http'
+
+    # ?stream=1 list responses, rows fetched per server side cursor round trip
+    STREAM_YIELD_PER = 1000
+
+    # likes and comments acknowledged once in a local sqlite log, applied in batches by a flusher thread
+    WRITE_BEHIND_ENABLED = False
+    WRITE_BEHIND_LOG_PATH = os.path.join(tempfile.gettempdir(), 'koinu-writes.db')
+    WRITE_BEHIND_FLUSH_INTERVAL = 0.5
+    WRITE_BEHIND_BATCH_SIZE = 1000
+    WRITE_BEHIND_MAX_STALENESS = 5
+
+    # /api/trending, article scores halve every TRENDING_HALF_LIFE seconds
+    TRENDING_SIZE = 100
+    TRENDING_HALF_LIFE = 6 * 3600
+    TRENDING_PERSIST_INTERVAL = 10
+    TRENDING_WEIGHTS = {'like': 1.0, 'comment': 2.0}
+
+    # admission control, leases and token buckets shared by the workers of a host through ADMISSION_STATE_PATH
+    ADMISSION_ENABLED = True
+    ADMISSION_STATE_PATH = os.path.join(tempfile.gettempdir(), 'koinu-admission.state')
+    # group -> (requests in flight per host, seconds a request may wait for a slot before a 503)
+    ADMISSION_CONCURRENCY = {'login': (8, 2.0), 'listing': (32, 1.0), 'moderation': (4, 1.0)}
+    # group -> (tokens per second, burst) per user, per client address before login; 429 when empty
+    ADMISSION_RATES = {'login': (1, 10), 'write': (5, 30)}
+    # leases older than this are taken over, e.g. from a hung worker
+    ADMISSION_LEASE_TIMEOUT = 300
+    ADMISSION_BUCKETS = 1 << 16
+    # reverse proxies (nginx) in front of the app, their X-Forwarded-For entry identifies the client
+    ADMISSION_TRUSTED_PROXIES = 0
+
+    # gunicorn workers open this many connections per engine and run the hot queries before serving,
+    # None opens the whole pool, see app/Startup.py
+    STARTUP_WARM_UP = True
+    STARTUP_WARM_CONNECTIONS = None
+
+    # argon2 process pool per web worker, 0 hashes inline
+    HASH_POOL_SIZE = 2
+    HASH_QUEUE_DEPTH = 8
+    HASH_TIMEOUT = 10
+    HASH_RETRY_AFTER = 2
+
     # flask config
     FLASK_SECRET = SECRET_KEY
 
@@ -35,6 +121,16 @@ class ProductionConfig(KoinuConfig):
     SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://{}:{}@{}/{}?charset=utf8mb4'.format(DB_USER, DB_PASS,
                                                                                    DB_HOST, KoinuConfig.APP_NAME)
 
+    # shared by the workers, a 'local' cache only sees the invalidations of its own worker
+    RESPONSE_CACHE_BACKEND = 'redis'
+
+    # per worker pool, (pool_size + max_overflow) * workers must stay below mysql max_connections
+    SQLALCHEMY_ENGINE_OPTIONS = dict(KoinuConfig.SQLALCHEMY_ENGINE_OPTIONS,
+                                     pool_size=10,
+                                     max_overflow=5,
+                                     pool_timeout=5,
+                                     connect_args={'connect_timeout': 5, 'read_timeout': 30, 'write_timeout': 30})
+
 
 class DebugConfig(KoinuConfig):
     DEBUG = True
@@ -47,6 +143,10 @@ class DebugConfig(KoinuConfig):
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(days=1)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=1)
 
+    # the dev server is a single process
+    REVOCATION_BACKEND = 'memory'
+    METRICS_DIR = None
+
     # use root to avoid permission error while performing migrations
     DB_USER = 'root'
     DB_PASS = 'random...string...'
@@ -55,5 +155,19 @@ class DebugConfig(KoinuConfig):
                                                                                    DB_HOST, KoinuConfig.APP_NAME)
 
 
+CONFIGS = {'production': ProductionConfig, 'debug': DebugConfig}
+
+
+#
+# KOINU_ENV picks the config, 'debug' (the default, for the dev server) or 'production'.
+# gunicorn.conf.py defaults it to production.
+#
+def config_from_env(environ=os.environ):
+    name = environ.get('KOINU_ENV', 'debug').lower()
+    if name not in CONFIGS:
+        raise RuntimeError('KOINU_ENV must be one of {}, not {!r}'.format(', '.join(sorted(CONFIGS)), name))
+    return CONFIGS[name]()
+
+
 DefaultConfig = ProductionConfig()
-ActiveConfig = DebugConfig()
+ActiveConfig = config_from_env()
@@ -0,0 +1,60 @@
+from sqlalchemy import bindparam, true
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import configure_mappers, contains_eager, undefer
+
+from app import db
+from app.Models import User, Article, Channel, Comment
+
+# backrefs such as Article.author only exist once the mappers are configured
+configure_mappers()
+
+#
+# Loading profiles for routes.
+# Collections on the models default to noload, so a route only pays for what it lists here.
+# List endpoints don't need a profile, app/Serializers.py batches their related rows.
+# Profiles built on contains_eager expect the query to join the related table itself.
+#
+USER_IDENTITY = ()
+
+ARTICLE_AUTHOR_JOINED = (contains_eager(Article.author),)
+
+# Article.content is deferred, list views show Article.excerpt instead
+ARTICLE_WITH_CONTENT = ARTICLE_AUTHOR_JOINED + (undefer(Article.content),)
+
+#
+# Columns of the list views, for db.session.query(*RECORD). Rows come back as keyed tuples
+# (__slots__, attributes named after the column keys) without building mapped objects or
+# touching the identity map, app/Serializers.py reads them like the models.
+#
+ARTICLE_RECORD = (Article.aid, Article.title, Article.article_author_uid, Article.article_channel_cid,
+                  Article.article_created, Article.excerpt, Article.like_count, Article.comment_count)
+
+COMMENT_RECORD = (Comment.coid, Comment.comment_user_uid, Comment.body, Comment.comment_created)
+
+CHANNEL_RECORD = (Channel.cid, Channel.name, Channel.description, Channel.subscriber_count)
+
+#
+# Hot lookups are baked: each query shape is built and compiled to SQL once per process and
+# later calls only bind their parameters. The cache key is the code of the lambdas plus the
+# extra arguments given to add_criteria, so profiles must be module level constants.
+#
+bakery = baked.bakery()
+
+
+def with_profile(query, profile):
+    query.add_criteria(lambda q: q.options(*profile), profile)
+    return query
+
+
+def load_user(username, profile=USER_IDENTITY, active_only=False):
+    query = with_profile(bakery(lambda session: session.query(User)), profile)
+    query += lambda q: q.filter(User.username == bindparam('username'))
+    if active_only:
+        query += lambda q: q.filter(User.is_active == true())
+    return query(db.session()).params(username=username).first()
+
+
+def load_uid(username):
+    query = bakery(lambda session: session.query(User.uid))
+    query += lambda q: q.filter(User.username == bindparam('username'))
+    return query(db.session()).params(username=username).scalar()
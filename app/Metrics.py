@@ -0,0 +1,365 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+HELP = {
+    'koinu_request_duration_seconds': ('histogram', 'Request handling time per endpoint.'),
+    'koinu_request_queries': ('histogram', 'SQL statements executed per request.'),
+    'koinu_request_db_seconds': ('histogram', 'Time spent in SQL statements per request.'),
+    'koinu_requests_total': ('counter', 'Requests served per endpoint and status code.'),
+    'koinu_n_plus_one_suspects_total': ('counter', 'Requests above METRICS_N_PLUS_ONE_THRESHOLD queries.'),
+    'koinu_slowest_query_seconds': ('gauge', 'Slowest single SQL statement seen per endpoint.'),
+    'koinu_hash_wait_seconds': ('histogram', 'Time password hashing jobs waited for a pool process.'),
+    'koinu_hash_rejected_total': ('counter', 'Password hashing jobs refused because the pool was full.'),
+    'koinu_response_cache_hits_total': ('counter', 'Public read responses served from the cache.'),
+    'koinu_response_cache_misses_total': ('counter', 'Public read responses computed on a cache miss.'),
+    'koinu_response_cache_stores_total': ('counter', 'Responses written to the cache.'),
+    'koinu_response_cache_invalidations_total': ('counter', 'Cache invalidations issued by writes.'),
+    'koinu_write_behind_queued_total': ('counter', 'Likes and comments acknowledged from the write-behind log.'),
+    'koinu_write_behind_flushed_total': ('counter', 'Write-behind log entries applied to the database.'),
+    'koinu_write_behind_inline_flushes_total': ('counter', 'Flushes run by a request because the log got stale.'),
+    'koinu_write_behind_flush_errors_total': ('counter', 'Failed flushes of the write-behind log.'),
+    'koinu_admission_admitted_total': ('counter', 'Requests admitted past a concurrency limit, per group.'),
+    'koinu_admission_shed_total': ('counter', 'Requests refused by admission control, per group and reason.'),
+    'koinu_admission_in_flight': ('gauge', 'Requests holding a concurrency slot on the host, per group.'),
+    'koinu_worker_startup_seconds': ('gauge', 'Slowest worker start, from fork to ready, on the host.'),
+    'koinu_worker_warm_up_seconds': ('gauge', 'Slowest worker warm-up before accepting requests on the host.')
+}
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def _empty():
+    return {'histograms': {}, 'counters': {}, 'maxima': {}}
+
+
+#
+# Snapshots are plain dicts keyed by metric name and rendered label string, so worker files
+# merge by adding histograms and counters and taking the max of maxima.
+#
+def merge(snapshots):
+    merged = _empty()
+    for snapshot in snapshots:
+        for name, histogram in snapshot.get('histograms', {}).items():
+            target = merged['histograms'].setdefault(name, {'bounds': histogram['bounds'], 'series': {}})
+            for labels, series in histogram['series'].items():
+                total = target['series'].setdefault(labels, {'buckets': [0] * len(histogram['bounds']),
+                                                             'sum': 0.0, 'count': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], series['buckets'])]
+                total['sum'] += series['sum']
+                total['count'] += series['count']
+        for name, series in snapshot.get('counters', {}).items():
+            target = merged['counters'].setdefault(name, {})
+            for labels, value in series.items():
+                target[labels] = target.get(labels, 0) + value
+        for name, series in snapshot.get('maxima', {}).items():
+            target = merged['maxima'].setdefault(name, {})
+            for labels, value in series.items():
+                target[labels] = max(target.get(labels, value), value)
+    return merged
+
+
+def _series_name(name, labels, extra=None):
+    labels = ','.join(part for part in (labels, extra) if part)
+    return '{}{{{}}}'.format(name, labels) if labels else name
+
+
+def render(snapshot):
+    lines = []
+
+    def header(name):
+        kind, text = HELP.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        header(name)
+        for labels, series in sorted(histogram['series'].items()):
+            cumulative = 0
+            for bound, count in zip(histogram['bounds'], series['buckets']):
+                cumulative += count
+                lines.append('{} {}'.format(_series_name(name + '_bucket', labels, 'le="{}"'.format(bound)),
+                                            cumulative))
+            lines.append('{} {}'.format(_series_name(name + '_bucket', labels, 'le="+Inf"'), series['count']))
+            lines.append('{} {}'.format(_series_name(name + '_sum', labels), series['sum']))
+            lines.append('{} {}'.format(_series_name(name + '_count', labels), series['count']))
+    for name, series in sorted(list(snapshot['counters'].items()) + list(snapshot['maxima'].items())):
+        header(name)
+        for labels, value in sorted(series.items()):
+            lines.append('{} {}'.format(_series_name(name, labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+#
+# Metrics of one worker process.
+#
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._data = _empty()
+
+    def observe(self, name, labels, value, bounds):
+        with self._lock:
+            histogram = self._data['histograms'].setdefault(name, {'bounds': list(bounds), 'series': {}})
+            series = histogram['series'].setdefault(labels, {'buckets': [0] * len(bounds), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            series = self._data['counters'].setdefault(name, {})
+            series[labels] = series.get(labels, 0) + amount
+
+    def maximum(self, name, labels, value):
+        with self._lock:
+            series = self._data['maxima'].setdefault(name, {})
+            series[labels] = max(series.get(labels, value), value)
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._data))
+
+
+#
+# Statements of the current request, filled in by the engine hooks below.
+#
+class RequestQueries(object):
+    __slots__ = ('count', 'seconds', 'slowest', 'slowest_statement', 'statements')
+
+    def __init__(self):
+        self.count, self.seconds = 0, 0.0
+        self.slowest, self.slowest_statement = 0.0, None
+        self.statements = Counter()
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.seconds += elapsed
+        self.statements[statement] += 1
+        if elapsed >= self.slowest:
+            self.slowest, self.slowest_statement = elapsed, statement
+
+
+# start times are keyed by cursor, a statement that fails drops its entry in _handle_error
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('koinu_query_started', {})[id(cursor)] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('koinu_query_started', {}).pop(id(cursor), None)
+    if started is not None and has_request_context():
+        queries = g.get('koinu_queries')
+        if queries is not None:
+            queries.add(statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    conn, cursor = exception_context.connection, exception_context.cursor
+    if conn is not None and cursor is not None:
+        conn.info.get('koinu_query_started', {}).pop(id(cursor), None)
+
+
+_hooks_installed = False
+
+
+def _install_engine_hooks():
+    # listening on the Engine class covers every engine flask-sqlalchemy creates later
+    global _hooks_installed
+    if not _hooks_installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _hooks_installed = True
+
+
+def _hashing_pool_metrics():
+    from app import hashing_pool
+    from app.Hashing import HashingPool
+
+    stats = hashing_pool.stats
+    snapshot = _empty()
+    snapshot['histograms']['koinu_hash_wait_seconds'] = {
+        'bounds': list(HashingPool.WAIT_BUCKETS),
+        'series': {'': {'buckets': list(stats['wait_buckets']), 'sum': stats['wait_seconds_sum'],
+                        'count': stats['submitted']}}
+    }
+    snapshot['counters']['koinu_hash_rejected_total'] = {'': stats['rejected']}
+    return snapshot
+
+
+def _response_cache_metrics():
+    from app import response_cache
+
+    snapshot = _empty()
+    for key, value in response_cache.stats.items():
+        snapshot['counters']['koinu_response_cache_{}_total'.format(key)] = {'': value}
+    return snapshot
+
+
+def _write_behind_metrics():
+    from app import write_behind
+
+    snapshot = _empty()
+    if write_behind.enabled:
+        for key, value in write_behind.stats.items():
+            snapshot['counters']['koinu_write_behind_{}_total'.format(key)] = {'': value}
+    return snapshot
+
+
+def _admission_metrics():
+    from app import admission
+
+    snapshot = _empty()
+    if admission.enabled:
+        snapshot['counters']['koinu_admission_admitted_total'] = {
+            _labels(group=group): count for group, count in admission.stats['admitted'].items()}
+        snapshot['counters']['koinu_admission_shed_total'] = {
+            _labels(group=group, reason=reason): count for (group, reason), count in admission.stats['shed'].items()}
+        # host wide already, merging worker files by max keeps it that way
+        snapshot['maxima']['koinu_admission_in_flight'] = {
+            _labels(group=group): admission.state.in_flight(group, admission.lease_timeout)
+            for group in admission.concurrency_limits}
+    return snapshot
+
+
+def _startup_metrics():
+    from app import startup
+
+    # slowest worker of the host, set by the gunicorn hooks
+    snapshot = _empty()
+    for key in ('startup_seconds', 'warm_up_seconds'):
+        if startup.stats[key] is not None:
+            snapshot['maxima']['koinu_worker_{}'.format(key)] = {'': startup.stats[key]}
+    return snapshot
+
+
+#
+# Per request SQL instrumentation and a prometheus text exposition of it.
+# With METRICS_DIR set every worker periodically dumps its metrics to <dir>/worker-<pid>.json
+# and a scrape of any worker merges all files, so counters add up across gunicorn workers.
+# Files of exited workers are kept so their counts don't go backwards; a new worker reusing
+# a pid takes over its file, which prometheus treats as a counter reset. The gunicorn master
+# calls clear() when it starts so files of a previous run don't pile up or add to this one.
+#
+class RequestMetrics(object):
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.collectors = [_hashing_pool_metrics, _response_cache_metrics, _write_behind_metrics,
+                           _admission_metrics, _startup_metrics]
+        self.enabled = True
+        self.directory = None
+        self.n_plus_one_threshold = 10
+        self.slow_query_seconds = 0.5
+        self.flush_interval = 1.0
+        self._last_flush = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.directory = app.config.get('METRICS_DIR')
+        self.n_plus_one_threshold = app.config.get('METRICS_N_PLUS_ONE_THRESHOLD', self.n_plus_one_threshold)
+        self.slow_query_seconds = app.config.get('METRICS_SLOW_QUERY_SECONDS', self.slow_query_seconds)
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', self.flush_interval)
+        self.registry.reset()
+        if not self.enabled:
+            return
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        _install_engine_hooks()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        g.koinu_queries = RequestQueries()
+        g.koinu_request_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        queries = g.get('koinu_queries')
+        if queries is None:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        labels = _labels(endpoint=endpoint)
+        registry = self.registry
+        registry.observe('koinu_request_duration_seconds', labels,
+                         time.perf_counter() - g.koinu_request_started, DURATION_BUCKETS)
+        registry.observe('koinu_request_queries', labels, queries.count, QUERY_BUCKETS)
+        registry.observe('koinu_request_db_seconds', labels, queries.seconds, DURATION_BUCKETS)
+        registry.inc('koinu_requests_total', _labels(endpoint=endpoint, status=response.status_code))
+        if queries.count:
+            registry.maximum('koinu_slowest_query_seconds', labels, queries.slowest)
+
+        if queries.count > self.n_plus_one_threshold:
+            registry.inc('koinu_n_plus_one_suspects_total', labels)
+            statement, repeats = queries.statements.most_common(1)[0]
+            current_app.logger.warning('possible N+1 in %s: %d queries, %d x %s',
+                                       endpoint, queries.count, repeats, statement)
+        if queries.slowest > self.slow_query_seconds:
+            current_app.logger.warning('slow query in %s (%.3fs): %s',
+                                       endpoint, queries.slowest, queries.slowest_statement)
+
+        if self.directory and time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+        return response
+
+    def worker_snapshot(self):
+        return merge([self.registry.snapshot()] + [collector() for collector in self.collectors])
+
+    def flush(self):
+        self._last_flush = time.time()
+        path = os.path.join(self.directory, 'worker-{}.json'.format(os.getpid()))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.worker-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.worker_snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+
+        for name in os.listdir(self.directory):
+            if name.startswith(('worker-', '.worker-')):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue  # already gone
+        self.registry.reset()
+
+    def snapshot(self):
+        if not self.directory:
+            return self.worker_snapshot()
+
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith('worker-') and name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # worker file vanished or is mid-replace on a filesystem without atomic rename
+        return merge(snapshots)
+
+    def expose(self):
+        return render(self.snapshot())
@@ -1,30 +1,66 @@
 from enum import Enum
 
-from argon2.exceptions import VerifyMismatchError
 from itsdangerous import (TimedJSONWebSignatureSerializer as Serializer,
                           BadSignature, SignatureExpired)
 
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import validates
 from sqlalchemy.sql import func
 
-from app import db, argon2
+from app import db, argon2, hashing_pool
 from app.KoinuConfig import ActiveConfig as Config
 
 
 subscription_table = db.Table('subscriptions',
                               db.Column('sub_user_uid', db.Integer, db.ForeignKey('User.uid'), primary_key=True),
-                              db.Column('sub_channel_cid', db.Integer, db.ForeignKey('Channel.cid'), primary_key=True))
+                              db.Column('sub_channel_cid', db.Integer, db.ForeignKey('Channel.cid'), primary_key=True),
+                              db.Index('ix_subscriptions_channel', 'sub_channel_cid', 'sub_user_uid'))
+
+# sqlite stores CURRENT_TIMESTAMP without fractional seconds, bind datetimes the same way so
+# comparisons against server defaults (keyset cursors) hold, mysql DATETIME has no fraction either
+Timestamp = db.DateTime(timezone=True).with_variant(
+    sqlite.DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d'),
+    'sqlite')
 
 favorite_table = db.Table('favorites',
                           db.Column('fav_user_uid', db.Integer, db.ForeignKey('User.uid'), primary_key=True),
-                          db.Column('fav_article_aid', db.Integer, db.ForeignKey('Article.aid'), primary_key=True))
+                          db.Column('fav_article_aid', db.Integer, db.ForeignKey('Article.aid'), primary_key=True),
+                          db.Index('ix_favorites_article', 'fav_article_aid', 'fav_user_uid'))
+
+# precomputed subscription feeds, one row per (subscriber, public article), see app/Timeline.py
+timeline_table = db.Table('timelines',
+                          db.Column('tl_user_uid', db.Integer, db.ForeignKey('User.uid'), primary_key=True),
+                          db.Column('tl_article_aid', db.Integer, db.ForeignKey('Article.aid'), primary_key=True),
+                          db.Column('tl_channel_cid', db.Integer, db.ForeignKey('Channel.cid'), nullable=False),
+                          db.Column('tl_created', Timestamp, nullable=False),
+                          db.Index('ix_timelines_user_created', 'tl_user_uid', 'tl_created', 'tl_article_aid'),
+                          db.Index('ix_timelines_article', 'tl_article_aid'),
+                          db.Index('ix_timelines_channel', 'tl_channel_cid'))
+
+# last write-behind log entry applied to this database, per local log, see app/WriteBehind.py
+write_checkpoint_table = db.Table('write_checkpoints',
+                                  db.Column('log_id', db.String(32), primary_key=True),
+                                  db.Column('last_seq', db.BigInteger, nullable=False))
+
+# forward decayed article scores behind /api/trending, see app/Trending.py
+trending_table = db.Table('trending',
+                          db.Column('tr_article_aid', db.Integer, db.ForeignKey('Article.aid'), primary_key=True),
+                          db.Column('tr_epoch', db.Integer, nullable=False),
+                          db.Column('tr_score', db.Float, nullable=False),
+                          db.Index('ix_trending_epoch_score', 'tr_epoch', 'tr_score'))
+
+
+def insert_ignore(table):
+    return table.insert().prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite')
 
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = (db.Index('ix_comments_article_created', 'comment_article_aid', 'comment_created', 'coid'),)
     BODY_MAX_LENGTH = 255
     coid = db.Column(db.Integer, primary_key=True, autoincrement=True)
     body = db.Column(db.Text(length=BODY_MAX_LENGTH), nullable=False)
-    comment_created = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    comment_created = db.Column(Timestamp, server_default=func.now())
     comment_updated = db.Column(db.DateTime(timezone=True), onupdate=func.now())
     comment_user_uid = db.Column(db.Integer, db.ForeignKey('User.uid'), nullable=False)
     comment_article_aid = db.Column(db.Integer, db.ForeignKey('Article.aid'), nullable=False)
@@ -46,13 +82,14 @@ class User(db.Model):
     role = db.Column(db.SmallInteger, default=4, server_default="4", nullable=False)
     is_active = db.Column(db.Boolean, default=1, server_default="1", nullable=False)
 
-    subscriptions = db.relationship('Channel', secondary=subscription_table, lazy='subquery',
+    # history collections are never loaded implicitly, see app/Loading.py for per-route profiles
+    subscriptions = db.relationship('Channel', secondary=subscription_table, lazy='noload',
                                     backref=db.backref('subscribers', lazy=True))
-    favorites = db.relationship('Article', secondary=favorite_table, lazy='subquery',
+    favorites = db.relationship('Article', secondary=favorite_table, lazy='noload',
                                 backref=db.backref('liked_by', lazy=True))
-    published_articles = db.relationship('Article', lazy='subquery',
+    published_articles = db.relationship('Article', lazy='noload',
                                          backref=db.backref('author', lazy=True))
-    sent_comments = db.relationship('Comment', lazy='subquery',
+    sent_comments = db.relationship('Comment', lazy='noload',
                                     backref=db.backref('sent_by', lazy=True))
 
     def __init__(self, username):
@@ -78,17 +115,16 @@ class User(db.Model):
     def get_id(self):
         return self.uid
 
+    # hashing runs in app.hashing_pool, these raise HashingPoolSaturated when it is full
     def set_password(self, password):
-        self.password_hash = argon2.hash(password)
+        self.password_hash = hashing_pool.hash(password)
 
     def check_password(self, password):
-        try:
-            argon2.verify(self.password_hash, password)
-            if argon2.check_needs_rehash(self.password_hash):
-                self.password_hash = argon2.hash(password)
-            return True
-        except VerifyMismatchError:
+        if not hashing_pool.verify(self.password_hash, password):
             return False
+        if argon2.check_needs_rehash(self.password_hash):
+            self.password_hash = hashing_pool.hash(password)
+        return True
 
     def check_has_role(self, role_enum):
         if role_enum in UserRole:
@@ -110,6 +146,7 @@ class ChannelStatus(Enum):
 
 class Channel(db.Model):
     __tablename__ = 'Channel'
+    __table_args__ = (db.Index('ix_Channel_visible', 'visible', 'cid'),)
     MAX_NAME_LENGTH = 32
     MAX_DESCRIPTION_LENGTH = 255
     cid = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -119,10 +156,18 @@ class Channel(db.Model):
     channel_updated = db.Column(db.DateTime(timezone=True), onupdate=func.now())
     status = db.Column(db.SmallInteger, default=1, server_default="1", nullable=False)
     channel_admin_uid = db.Column(db.Integer, db.ForeignKey('User.uid'))
+    subscriber_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    # materialized from status so read paths filter on an indexable column instead of status & 4
+    visible = db.Column(db.Boolean, default=1, server_default="1", nullable=False)
 
-    articles = db.relationship('Article', lazy='subquery',
+    articles = db.relationship('Article', lazy='noload',
                                backref=db.backref('channel', lazy=True))
 
+    @validates('status')
+    def sync_visible(self, key, status):
+        self.visible = status & ChannelStatus.Disabled.value == 0
+        return status
+
     def check_has_status(self, status_enum):
         if status_enum in ChannelStatus:
             return self.status & status_enum.value != 0
@@ -149,22 +194,71 @@ class ArticleStatus(Enum):
     RejectedRequest = 12
 
 
+#
+# Materialized from the ArticleStatus flags: disabled wins over requested, anything else is visible.
+#
+class ArticleVisibility(Enum):
+    Hidden = 0
+    Visible = 1
+    Requested = 2
+
+
 class Article(db.Model):
     __tablename__ = 'Article'
+    __table_args__ = (db.Index('ix_Article_channel_visibility_created',
+                               'article_channel_cid', 'visibility', 'article_created', 'aid'),
+                      db.Index('ix_Article_visibility_created', 'visibility', 'article_created', 'aid'))
     MAX_TITLE_LENGTH = 64
     MAX_CONTENT_LENGTH = 65535
+    EXCERPT_LENGTH = 200
     aid = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(MAX_TITLE_LENGTH), index=True, nullable=False)
-    content = db.Column(db.Text(MAX_CONTENT_LENGTH), nullable=False)
-    article_created = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    # only the single article view loads content, see ARTICLE_WITH_CONTENT in app/Loading.py
+    content = db.deferred(db.Column(db.Text(MAX_CONTENT_LENGTH), nullable=False))
+    excerpt = db.Column(db.String(EXCERPT_LENGTH), default='', server_default='', nullable=False)
+    article_created = db.Column(Timestamp, server_default=func.now())
     article_updated = db.Column(db.DateTime(timezone=True), onupdate=func.now())
     article_status = db.Column(db.SmallInteger, default=9, server_default="9", nullable=False)
     article_author_uid = db.Column(db.Integer, db.ForeignKey('User.uid'))
     article_channel_cid = db.Column(db.Integer, db.ForeignKey('Channel.cid'))
+    like_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    comment_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    visibility = db.Column(db.SmallInteger, default=2, server_default="2", nullable=False)
 
-    received_comments = db.relationship('Comment', lazy='subquery',
+    received_comments = db.relationship('Comment', lazy='noload',
                                         backref=db.backref('posted_on', lazy=True))
 
+    @staticmethod
+    def visibility_of(status):
+        if status & ArticleStatus.Disabled.value:
+            return ArticleVisibility.Hidden.value
+        if status & ArticleStatus.Requested.value:
+            return ArticleVisibility.Requested.value
+        return ArticleVisibility.Visible.value
+
+    @validates('article_status')
+    def sync_visibility(self, key, status):
+        self.visibility = Article.visibility_of(status)
+        return status
+
+    #
+    # Whitespace collapsed, cut on a word boundary when longer than EXCERPT_LENGTH.
+    #
+    @staticmethod
+    def excerpt_of(content):
+        text = ' '.join((content or '').split())
+        if len(text) <= Article.EXCERPT_LENGTH:
+            return text
+        cut = text[:Article.EXCERPT_LENGTH - 3]
+        if ' ' in cut:
+            cut = cut.rsplit(' ', 1)[0]
+        return cut + '...'
+
+    @validates('content')
+    def sync_excerpt(self, key, content):
+        self.excerpt = Article.excerpt_of(content)
+        return content
+
     def check_has_status(self, status_enum):
         if status_enum in ArticleStatus:
             return self.article_status & status_enum.value != 0
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+from flask import current_app, request
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class BadCursor(ValueError):
+    pass
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='koinu-page-cursor')
+
+
+#
+# Cursors are signed so clients treat them as opaque tokens and can't forge arbitrary keys.
+#
+def encode_cursor(created, key):
+    return _serializer().dumps([created.isoformat(), key])
+
+
+def decode_cursor(token):
+    try:
+        created, key = _serializer().loads(token)
+        return datetime.fromisoformat(created), int(key)
+    except (BadSignature, ValueError, TypeError):
+        raise BadCursor(token)
+
+
+#
+# Read ?cursor= and ?limit= from the query string, a limit in the url path takes precedence.
+#
+def page_args(limit=None):
+    if limit is None:
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+
+    token = request.args.get('cursor')
+    cursor = decode_cursor(token) if token else None
+    return cursor, min(limit, MAX_PAGE_SIZE)
+
+
+#
+# Order a query on (created, key) and start it strictly after `cursor`, if any.
+#
+def keyset_query(query, created_column, key_column, cursor, descending=True):
+    if cursor:
+        created, key = cursor
+        if descending:
+            query = query.filter(or_(created_column < created, and_(created_column == created, key_column < key)))
+        else:
+            query = query.filter(or_(created_column > created, and_(created_column == created, key_column > key)))
+
+    if descending:
+        query = query.order_by(created_column.desc(), key_column.desc())
+    else:
+        query = query.order_by(created_column.asc(), key_column.asc())
+    return query
+
+
+#
+# Keyset pagination on (created, key).
+# The next page starts strictly after the last row of this one, so a deep page is the same
+# index range scan as the first one. Returns the rows and the cursor of the next page, if any.
+#
+def keyset_page(query, created_column, key_column, cursor, limit, descending=True):
+    if limit < 1:
+        return [], None
+
+    query = keyset_query(query, created_column, key_column, cursor, descending)
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, created_column.key), getattr(last, key_column.key))
+
+
+def page_headers(next_cursor):
+    return {'X-Next-Cursor': next_cursor} if next_cursor else {}
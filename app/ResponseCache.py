@@ -0,0 +1,189 @@
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request
+
+from app.Routing import pinned_to_primary, use_primary
+
+
+#
+# Size bounded LRU with a TTL per entry, private to one worker.
+# Tag generations are bounded the same way. They come from one counter, and a tag that was
+# evicted reads as the highest generation evicted so far, so it can never go back to a value
+# that entries written before a later bump were keyed on.
+#
+class LocalCacheBackend(object):
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = OrderedDict()
+        self._clock = itertools.count(1)
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, tags):
+        with self._lock:
+            for tag in tags:
+                if tag in self._generations:
+                    self._generations.move_to_end(tag)
+            return [self._generations.get(tag, self._evicted) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = next(self._clock)
+                self._generations.move_to_end(tag)
+            while len(self._generations) > self.max_entries:
+                self._evicted = max(self._evicted, self._generations.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+#
+# Shared by every worker through any redis-py compatible client. Eviction is left to the
+# server (maxmemory-policy allkeys-lru) on top of the per key TTL.
+#
+class RedisCacheBackend(object):
+    def __init__(self, client, prefix='koinu:cache:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_BACKEND = "redis" requires the redis package')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(int(ttl), 1))
+
+    def generations(self, tags):
+        values = self.client.mget([self.prefix + 'gen:' + tag for tag in tags])
+        return [int(value or 0) for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(self.prefix + 'gen:' + tag)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+
+#
+# Cache for public GET responses.
+# Every entry is keyed on its tags' generation numbers; invalidate() bumps the generations, so
+# entries written before the bump, including ones computed concurrently with a write, are never
+# read again and simply age out. Misses are computed where @read_only sends them, so an entry
+# refilled from a replica right after a write can lag the primary by the replication delay.
+#
+class ResponseCache(object):
+    GLOBAL_TAG = 'all'
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 30
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def init_app(self, app):
+        backend = app.config.get('RESPONSE_CACHE_BACKEND')
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        if backend == 'local':
+            self.backend = LocalCacheBackend(app.config.get('RESPONSE_CACHE_SIZE', 2048))
+        elif backend == 'redis':
+            self.backend = RedisCacheBackend.from_url(app.config['RESPONSE_CACHE_REDIS_URL'])
+        elif backend is None:
+            self.backend = None
+        else:
+            raise ValueError('unknown RESPONSE_CACHE_BACKEND {!r}'.format(backend))
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _key(self, tags):
+        generations = self.backend.generations(tags)
+        return '{}|{}|{}'.format(request.endpoint, request.full_path,
+                                 ','.join('{}={}'.format(t, g) for t, g in zip(tags, generations)))
+
+    def cached(self, *tag_templates):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None or request.method != 'GET':
+                    return f(*args, **kwargs)
+
+                tags = [self.GLOBAL_TAG] + [template.format(**kwargs) for template in tag_templates]
+                key = self._key(tags)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self._count('hits')
+                    entry = json.loads(entry)
+                    return current_app.response_class(entry['body'], status=entry['status'],
+                                                      headers=entry['headers'])
+
+                self._count('misses')
+                # misses follow @read_only, only a client that has to read its own writes refills from the primary
+                if g.get('koinu_wrote') or pinned_to_primary():
+                    use_primary()
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    headers = [(k, v) for k, v in response.headers.items() if k != 'Content-Length']
+                    self.backend.set(key, json.dumps({'status': 200, 'headers': headers,
+                                                      'body': response.get_data(as_text=True)}), self.ttl)
+                    self._count('stores')
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+            self._count('invalidations')
+
+    #
+    # Read-your-writes pins of app/Routing.py, kept in the cache's store so workers share them.
+    #
+    def pin(self, name, seconds):
+        if self.backend is not None:
+            self.backend.set('pin:' + name, '1', seconds)
+
+    def pinned(self, name):
+        return self.backend is not None and self.backend.get('pin:' + name) is not None
@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import mmap
+import multiprocessing
+import os
+import sqlite3
+import struct
+import threading
+import time
+from datetime import timedelta
+
+_thread_lock = threading.Lock()
+
+
+#
+# Bloom filter over a shared mapping, split in two halves by token expiry window.
+# A token expiring in window w lives in half w % 2; that half is wiped the first time a token
+# of window w + 2 is added, at which point everything it held has already expired.
+# File backed filters are shared by every process on the host, anonymous ones only by
+# processes forked after creation. A negative answer is exact, a positive one goes to the store.
+#
+class RevocationBloom(object):
+    HEADER = struct.Struct('<qq')
+
+    def __init__(self, window_seconds, size_bits=1 << 23, hashes=7, path=None):
+        self.window = max(int(window_seconds), 1)
+        self.hashes = hashes
+        self.half_bytes = size_bits // 16
+        self.half_bits = self.half_bytes * 8
+        length = self.HEADER.size + 2 * self.half_bytes
+
+        self.fresh = True
+        if path:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self.fresh = os.fstat(fd).st_size != length
+            if self.fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, length)
+            self._bits = mmap.mmap(fd, length)
+            self._lock_fd = fd
+            self._lock = None
+        else:
+            self._bits = mmap.mmap(-1, length)
+            self._lock_fd = None
+            self._lock = multiprocessing.Lock()
+
+        if self.fresh:
+            self.HEADER.pack_into(self._bits, 0, -1, -1)
+
+    # lockf only excludes other processes, threads of this one queue on _thread_lock first
+    def _acquire(self):
+        if self._lock_fd is not None:
+            _thread_lock.acquire()
+            try:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_EX)
+            except BaseException:
+                _thread_lock.release()
+                raise
+        else:
+            self._lock.acquire()
+
+    def _release(self):
+        if self._lock_fd is not None:
+            try:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+            finally:
+                _thread_lock.release()
+        else:
+            self._lock.release()
+
+    def _positions(self, jti):
+        digest = hashlib.blake2b(jti.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.half_bits for i in range(self.hashes)]
+
+    def _half(self, exp):
+        window = int(exp) // self.window
+        return window, window % 2, self.HEADER.size + (window % 2) * self.half_bytes
+
+    def add(self, jti, exp):
+        window, half, offset = self._half(exp)
+        self._acquire()
+        try:
+            windows = list(self.HEADER.unpack_from(self._bits, 0))
+            if windows[half] != window:
+                self._bits[offset:offset + self.half_bytes] = bytes(self.half_bytes)
+                windows[half] = window
+                self.HEADER.pack_into(self._bits, 0, *windows)
+
+            for pos in self._positions(jti):
+                index = offset + (pos >> 3)
+                self._bits[index] = self._bits[index] | (1 << (pos & 7))
+        finally:
+            self._release()
+
+    def might_contain(self, jti, exp):
+        window, half, offset = self._half(exp)
+        if self.HEADER.unpack_from(self._bits, 0)[half] != window:
+            return False
+
+        return all(self._bits[offset + (pos >> 3)] & (1 << (pos & 7)) for pos in self._positions(jti))
+
+
+#
+# Per process dict, expired tokens are pruned at most once every PURGE_INTERVAL seconds.
+#
+class MemoryRevocationStore(object):
+    PURGE_INTERVAL = 60
+
+    def __init__(self):
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._last_purge = 0
+
+    def revoke(self, jti, exp):
+        now = time.time()
+        with self._lock:
+            self._revoked[jti] = exp
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = now
+                for k in [k for k, v in self._revoked.items() if v < now]:
+                    del self._revoked[k]
+
+    def is_revoked(self, jti):
+        exp = self._revoked.get(jti)
+        return exp is not None and exp >= time.time()
+
+    def unexpired(self):
+        now = time.time()
+        return [(k, v) for k, v in list(self._revoked.items()) if v >= now]
+
+
+#
+# One sqlite file shared by all workers on the host, rows expire with the token.
+#
+class SQLiteRevocationStore(object):
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS revoked (jti TEXT PRIMARY KEY, exp INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_revoked_exp ON revoked (exp)')
+
+    def _connection(self):
+        # connections must not cross threads or forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def revoke(self, jti, exp):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO revoked (jti, exp) VALUES (?, ?)', (jti, int(exp)))
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                conn.execute('DELETE FROM revoked WHERE exp < ?', (int(now),))
+                self._last_purge = now
+
+    def is_revoked(self, jti):
+        row = self._connection().execute('SELECT 1 FROM revoked WHERE jti = ? AND exp >= ?',
+                                         (jti, int(time.time()))).fetchone()
+        return row is not None
+
+    def unexpired(self):
+        return self._connection().execute('SELECT jti, exp FROM revoked WHERE exp >= ?',
+                                          (int(time.time()),)).fetchall()
+
+
+#
+# Works with any client speaking the redis-py interface (set/exists/scan_iter/ttl),
+# so a local stand-in can replace the server. Keys expire with the token.
+#
+class RedisRevocationStore(object):
+    def __init__(self, client, prefix='koinu:revoked:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('REVOCATION_BACKEND = "redis" requires the redis package')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def revoke(self, jti, exp):
+        self.client.set(self.prefix + jti, 1, ex=max(int(exp - time.time()), 1))
+
+    def is_revoked(self, jti):
+        return bool(self.client.exists(self.prefix + jti))
+
+    def unexpired(self):
+        now = time.time()
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            key = key.decode() if isinstance(key, bytes) else key
+            yield key[len(self.prefix):], now + max(self.client.ttl(key), 0)
+
+
+#
+# Drop-in replacement for the old in-process blacklist set.
+#
+class TokenBlacklist(object):
+    def __init__(self):
+        self.store = MemoryRevocationStore()
+        self.bloom = None
+        self.max_lifetime = timedelta(days=30).total_seconds()
+
+    def init_app(self, app):
+        config = app.config
+        lifetimes = [config.get('JWT_ACCESS_TOKEN_EXPIRES'), config.get('JWT_REFRESH_TOKEN_EXPIRES')]
+        lifetimes = [lifetime.total_seconds() for lifetime in lifetimes if isinstance(lifetime, timedelta)]
+        if lifetimes:
+            self.max_lifetime = max(lifetimes)
+
+        # the bloom filter must be visible to every worker that can revoke, so it is file backed
+        # next to the sqlite store; with redis it is only safe when all workers share one host
+        backend = config.get('REVOCATION_BACKEND', 'memory')
+        use_bloom, bloom_path = config.get('REVOCATION_BLOOM', True), None
+        if backend == 'sqlite':
+            self.store = SQLiteRevocationStore(config['REVOCATION_SQLITE_PATH'])
+            bloom_path = config['REVOCATION_SQLITE_PATH'] + '.bloom'
+        elif backend == 'redis':
+            self.store = RedisRevocationStore.from_url(config['REVOCATION_REDIS_URL'])
+            bloom_path = config.get('REVOCATION_BLOOM_PATH')
+            use_bloom = use_bloom and bloom_path is not None
+        elif backend == 'memory':
+            self.store = MemoryRevocationStore()
+        else:
+            raise ValueError('unknown REVOCATION_BACKEND {!r}'.format(backend))
+
+        self.bloom = None
+        if use_bloom:
+            self.bloom = RevocationBloom(self.max_lifetime, config.get('REVOCATION_BLOOM_BITS', 1 << 23),
+                                         path=bloom_path)
+            if self.bloom.fresh:
+                for jti, exp in self.store.unexpired():
+                    self.bloom.add(jti, exp)
+
+    def _expiry(self, exp):
+        return exp if exp is not None else time.time() + self.max_lifetime
+
+    def revoke(self, jti, exp=None):
+        exp = self._expiry(exp)
+        self.store.revoke(jti, exp)
+        if self.bloom is not None:
+            self.bloom.add(jti, exp)
+
+    def is_revoked(self, jti, exp=None):
+        if self.bloom is not None and not self.bloom.might_contain(jti, self._expiry(exp)):
+            return False
+        return self.store.is_revoked(jti)
@@ -0,0 +1,119 @@
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request_optional
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+REPLICA_BIND_PREFIX = 'replica_'
+PIN_COOKIE = 'koinu_primary_until'
+PIN_KEY = 'primary:{}'
+
+
+#
+# Sends statements of @read_only handlers to the replica picked for the request.
+# Flushes and INSERT/UPDATE/DELETE always go to the primary and mark the request as a write,
+# which pins the client's following reads to the primary, see _pin_writer.
+#
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False):
+                g.koinu_wrote = True
+            else:
+                replica = g.get('koinu_replica')
+                if replica is not None:
+                    return get_state(self.app).db.get_engine(self.app, bind=replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+#
+# SQLALCHEMY_REPLICA_URIS become binds named replica_0, replica_1, ...; models keep using the
+# primary unless a handler is decorated with @read_only.
+#
+class RoutingSQLAlchemy(SQLAlchemy):
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        replicas = []
+        for i, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or []):
+            replicas.append(REPLICA_BIND_PREFIX + str(i))
+            binds[replicas[-1]] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        app.extensions['koinu_replicas'] = replicas
+
+        super(RoutingSQLAlchemy, self).init_app(app)
+        app.after_request(_pin_writer)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# the JWT identity of the request, also on handlers that don't require one
+def _identity():
+    try:
+        verify_jwt_in_request_optional()
+    except Exception:
+        return None
+    return get_jwt_identity()
+
+
+#
+# A client that wrote is pinned by a cookie, which bearer clients usually drop, and by its JWT
+# identity in the response cache's store (shared by the workers with the redis backend, per
+# worker with the local one, not at all with the cache off).
+#
+def _pin_writer(response):
+    if g.get('koinu_wrote') and current_app.extensions.get('koinu_replicas'):
+        from app import response_cache
+
+        window = current_app.config.get('READ_YOUR_WRITES_SECONDS', 5)
+        response.set_cookie(PIN_COOKIE, str(int(time.time() + window) + 1), max_age=window + 1, httponly=True)
+        identity = _identity()
+        if identity is not None:
+            response_cache.pin(PIN_KEY.format(identity), window + 1)
+    return response
+
+
+def _pinned(identity):
+    from app import response_cache
+
+    return identity is not None and response_cache.pinned(PIN_KEY.format(identity))
+
+
+#
+# Whether the client wrote within the last READ_YOUR_WRITES_SECONDS, remembered for the request.
+#
+def pinned_to_primary():
+    pinned = g.get('koinu_pinned')
+    if pinned is None:
+        try:
+            pinned = float(request.cookies.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        g.koinu_pinned = pinned = pinned or _pinned(_identity())
+    return pinned
+
+
+#
+# Keep the rest of the request on the primary, e.g. when the result outlives the request.
+#
+def use_primary():
+    g.koinu_use_primary = True
+    g.koinu_replica = None
+
+
+#
+# Serve a handler that doesn't write from a replica, unless the client wrote within the last
+# READ_YOUR_WRITES_SECONDS (it would otherwise miss its own write on a lagging replica).
+#
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('koinu_replicas')
+        if replicas and not g.get('koinu_use_primary') and not pinned_to_primary():
+            g.koinu_replica = random.choice(replicas)
+        return f(*args, **kwargs)
+
+    return wrapper
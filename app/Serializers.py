@@ -0,0 +1,79 @@
+from app import db
+from app.Models import User, Channel
+from app.Streaming import stream_query
+
+
+def batch_usernames(uids):
+    uids = set(uids)
+    if not uids:
+        return {}
+    return dict(db.session.query(User.uid, User.username).filter(User.uid.in_(uids)))
+
+
+def batch_channel_names(cids):
+    cids = set(cids)
+    if not cids:
+        return {}
+    return dict(db.session.query(Channel.cid, Channel.name).filter(Channel.cid.in_(cids)))
+
+
+def helper_article_dict(article, author, with_channel=False, channel=None):
+    article_dict = {
+        'aid': article.aid,
+        'title': article.title,
+        'author': author,
+        'publish_time': article.article_created,
+        'excerpt': article.excerpt,
+        'likes': article.like_count,
+        'comments': article.comment_count
+    }
+    if with_channel:
+        article_dict['cid'] = article.article_channel_cid
+        article_dict['channel'] = channel
+
+    return article_dict
+
+
+#
+# Serialize a page of articles (ARTICLE_RECORD rows or models) with a constant number of queries:
+# the page itself, then one IN lookup for the authors and, for moderation views, one for the channels.
+# Like and comment totals come from the counter columns, no per-row aggregate is needed.
+# Articles carry their stored excerpt, the full content is only served by /api/article/<aid>.
+#
+def helper_article_list(iterator, with_channel=False):
+    articles = list(iterator)
+    authors = batch_usernames(article.article_author_uid for article in articles)
+    channels = batch_channel_names(article.article_channel_cid for article in articles) if with_channel else {}
+
+    return [helper_article_dict(article, authors.get(article.article_author_uid), with_channel,
+                                channels.get(article.article_channel_cid)) for article in articles]
+
+
+#
+# Lazily serialize every article of an unpaged ARTICLE_RECORD query for stream_json.
+# A server side cursor keeps its connection busy until exhausted, so the per page IN lookups
+# are not possible: the query has to join User (and Channel, with_channel) itself and the
+# names are read along with each row.
+#
+def stream_article_list(query, with_channel=False):
+    columns = (User.username, Channel.name) if with_channel else (User.username,)
+    for row in stream_query(query.add_columns(*columns)):
+        yield helper_article_dict(row, row.username, with_channel, row.name if with_channel else None)
+
+
+def helper_comment_list(iterator):
+    comments = list(iterator)
+    authors = batch_usernames(comment.comment_user_uid for comment in comments)
+
+    comment_list = []
+    for comment in comments:
+        comment_dict = {
+            'coid': comment.coid,
+            'author': authors.get(comment.comment_user_uid),
+            'content': comment.body,
+            'time': comment.comment_created
+        }
+
+        comment_list.append(comment_dict)
+
+    return comment_list
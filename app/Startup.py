@@ -0,0 +1,125 @@
+import os
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+
+
+def _engines(app):
+    from app import db
+
+    return [db.get_engine(app)] + [db.get_engine(app, bind) for bind in (app.config.get('SQLALCHEMY_BINDS') or {})]
+
+
+def _dispose_engines(app):
+    for engine in _engines(app):
+        engine.dispose()
+
+
+#
+# Check out `connections` connections of every engine at once (the pool size when None) and
+# give them back, so the first requests of a worker don't pay for connecting.
+#
+def _open_pools(app, connections):
+    for engine in _engines(app):
+        size = connections
+        if size is None:
+            size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        opened = []
+        try:
+            for _ in range(size):
+                opened.append(engine.connect())
+                opened[-1].execute('SELECT 1')
+        finally:
+            for connection in opened:
+                connection.close()
+
+
+#
+# Build and compile the baked lookups (with keys that match nothing) and the url map.
+#
+def _precompile(app):
+    from app import db
+    from app.Loading import ARTICLE_WITH_CONTENT, load_uid, load_user
+    from app.routes.Admin import one_channel_query
+    from app.routes.ContentControl import one_article_query
+
+    with app.app_context():
+        try:
+            one_article_query(0)
+            one_article_query(0, ARTICLE_WITH_CONTENT)
+            one_channel_query(0)
+            load_user('')
+            load_uid('')
+        finally:
+            db.session.remove()
+    app.url_map.update()
+
+
+def _prime_caches(app):
+    from app import db, trending
+
+    with app.app_context():
+        try:
+            trending.ranking()
+        finally:
+            db.session.remove()
+
+
+#
+# Process startup for gunicorn, see gunicorn.conf.py.
+# With preload_app the master imports the app and runs prepare() before forking: modules,
+# mappers and compiled queries are then shared by the workers copy-on-write, and its database
+# connections are closed so none is inherited. Each worker disposes its engines again after the
+# fork and runs warm_up() before it accepts requests: it opens its pool, compiles the hot
+# queries unless the master did, and loads the trending ranking. Warm-up is best effort, a
+# database that is down only leaves the worker cold. The write-behind flusher is started there
+# too, warm-up or not, so a log left by a crash is replayed without waiting for a first request.
+# Timings are logged by the gunicorn hooks and exported as koinu_worker_*_seconds metrics.
+#
+class Startup(object):
+    def __init__(self):
+        self.started = time.time()
+        self.warm_up_enabled = True
+        self.warm_connections = None
+        self.stats = {'preload_seconds': None, 'warm_up_seconds': None, 'startup_seconds': None}
+        self._precompiled = False
+
+    def init_app(self, app):
+        self.warm_up_enabled = app.config.get('STARTUP_WARM_UP', True)
+        self.warm_connections = app.config.get('STARTUP_WARM_CONNECTIONS')
+
+    def prepare(self, app, started=None):
+        try:
+            _precompile(app)
+            self._precompiled = True
+        except SQLAlchemyError:
+            app.logger.warning('could not precompile queries before forking', exc_info=True)
+        _dispose_engines(app)
+        self.stats['preload_seconds'] = time.time() - (started or self.started)
+        return self.stats['preload_seconds']
+
+    def after_fork(self, app):
+        self.started = time.time()
+        _dispose_engines(app)
+
+    def warm_up(self, app):
+        from app import write_behind
+
+        begin = time.time()
+        if write_behind.enabled:
+            write_behind.start_flusher()
+        if self.warm_up_enabled:
+            try:
+                _open_pools(app, self.warm_connections)
+                if not self._precompiled:
+                    _precompile(app)
+                    self._precompiled = True
+                _prime_caches(app)
+            except SQLAlchemyError:
+                app.logger.warning('worker %d warm-up failed', os.getpid(), exc_info=True)
+
+        now = time.time()
+        self.stats['warm_up_seconds'] = now - begin
+        self.stats['startup_seconds'] = now - self.started
+        return self.stats['startup_seconds'], self.stats['warm_up_seconds']
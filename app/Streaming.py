@@ -0,0 +1,45 @@
+from flask import current_app, request, stream_with_context
+
+from app.Json import dumps
+
+
+def stream_requested():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+#
+# Iterate a query in STREAM_YIELD_PER batches. yield_per turns on stream_results, which is a
+# server side (unbuffered) cursor on MySQL, so only one batch of rows is held in memory.
+#
+def stream_query(query):
+    return query.yield_per(current_app.config.get('STREAM_YIELD_PER', 1000))
+
+
+#
+# Respond with `items` as a JSON array written while it is iterated, sent with chunked transfer
+# encoding. With `envelope` the array becomes its `key` member, e.g. the articles of a channel.
+# The generator runs after the view returned, stream_with_context keeps the request (and its
+# session and replica choice) around until the last chunk is sent.
+# Errors past the first chunk can't change the status any more, they cut the response short.
+#
+def stream_json(items, envelope=None, key='items', headers=None):
+    if envelope is None:
+        head, tail = b'[', b']'
+    else:
+        head = dumps(envelope)[:-1] + (b',' if envelope else b'') + dumps(key) + b':['
+        tail = b']}'
+
+    def generate():
+        chunk, size = [head], current_app.config.get('STREAM_YIELD_PER', 1000)
+        separator = b''
+        for item in items:
+            chunk.append(separator + dumps(item))
+            separator = b','
+            if len(chunk) >= size:
+                yield b''.join(chunk)
+                chunk = []
+        chunk.append(tail)
+        yield b''.join(chunk)
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json',
+                                      headers=headers)
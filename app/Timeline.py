@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, true
+
+from app import db
+from app.Loading import ARTICLE_RECORD
+from app.Models import User, Article, ArticleVisibility, Channel
+from app.Models import subscription_table, timeline_table, insert_ignore
+from app.Pagination import encode_cursor, keyset_page
+
+TIMELINE_COLUMNS = ['tl_user_uid', 'tl_article_aid', 'tl_channel_cid', 'tl_created']
+
+
+#
+# Channels above TIMELINE_FANOUT_LIMIT subscribers are not fanned out, their articles are read
+# at feed time instead. Reads treat channels above half the limit as hot so an article posted
+# while a channel was hot stays in its subscribers' feeds if the channel shrinks a little.
+#
+def fanout_limit():
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+
+
+#
+# Copy newly public articles into every subscriber's timeline with one INSERT ... SELECT.
+#
+def fan_out_articles(aids):
+    if not aids:
+        return
+
+    source = select([subscription_table.c.sub_user_uid, Article.aid, Article.article_channel_cid,
+                     Article.article_created])\
+        .select_from(Article.__table__
+                     .join(subscription_table, subscription_table.c.sub_channel_cid == Article.article_channel_cid)
+                     .join(Channel.__table__, Channel.cid == Article.article_channel_cid))\
+        .where(Article.aid.in_(aids))\
+        .where(Article.visibility == ArticleVisibility.Visible.value)\
+        .where(Channel.subscriber_count <= fanout_limit())\
+        .distinct()
+
+    db.session.execute(insert_ignore(timeline_table).from_select(TIMELINE_COLUMNS, source))
+
+
+#
+# Seed a new subscriber's timeline with the channel's latest articles.
+#
+def backfill_subscription(uid, cid):
+    source = select([db.literal(uid), Article.aid, Article.article_channel_cid, Article.article_created])\
+        .select_from(Article.__table__.join(Channel.__table__, Channel.cid == Article.article_channel_cid))\
+        .where(Article.article_channel_cid == cid)\
+        .where(Article.visibility == ArticleVisibility.Visible.value)\
+        .where(Channel.subscriber_count <= fanout_limit())\
+        .order_by(Article.article_created.desc(), Article.aid.desc())\
+        .limit(current_app.config.get('TIMELINE_BACKFILL', 50))
+
+    db.session.execute(insert_ignore(timeline_table).from_select(TIMELINE_COLUMNS, source))
+
+
+def prune_subscription(uid, cid):
+    prune_subscriptions(uid, [cid])
+
+
+def prune_subscriptions(uid, cids):
+    if cids:
+        db.session.execute(timeline_table.delete().where(timeline_table.c.tl_user_uid == uid)
+                                                  .where(timeline_table.c.tl_channel_cid.in_(cids)))
+
+
+def prune_articles(aids):
+    if aids:
+        db.session.execute(timeline_table.delete().where(timeline_table.c.tl_article_aid.in_(aids)))
+
+
+def prune_channel(cid):
+    db.session.execute(timeline_table.delete().where(timeline_table.c.tl_channel_cid == cid))
+
+
+#
+# One keyset page of a user's feed: a range read on the precomputed timeline merged with
+# a fan-out-on-read query for subscribed hot channels. Returns visible articles newest first
+# and the next page cursor.
+#
+def timeline_page(uid, cursor, limit):
+    if limit < 1:
+        return [], None
+
+    stored = db.session.query(timeline_table.c.tl_article_aid, timeline_table.c.tl_created)\
+                       .filter(timeline_table.c.tl_user_uid == uid)
+    stored, stored_next = keyset_page(stored, timeline_table.c.tl_created, timeline_table.c.tl_article_aid,
+                                      cursor, limit)
+    keys = {(row.tl_created, row.tl_article_aid) for row in stored}
+
+    hot_channels = db.session.query(subscription_table.c.sub_channel_cid)\
+        .join(Channel, Channel.cid == subscription_table.c.sub_channel_cid)\
+        .filter(subscription_table.c.sub_user_uid == uid)\
+        .filter(Channel.subscriber_count > fanout_limit() // 2)
+    live_next = None
+    if hot_channels.first() is not None:
+        live = db.session.query(Article.aid, Article.article_created)\
+                         .filter(Article.article_channel_cid.in_(hot_channels.subquery()))\
+                         .filter(Article.visibility == ArticleVisibility.Visible.value)
+        live, live_next = keyset_page(live, Article.article_created, Article.aid, cursor, limit)
+        keys.update((row.article_created, row.aid) for row in live)
+
+    keys = sorted(keys, reverse=True)
+    has_more = stored_next is not None or live_next is not None or len(keys) > limit
+    keys = keys[:limit]
+    next_cursor = encode_cursor(*keys[-1]) if has_more and keys else None
+
+    aids = [aid for _, aid in keys]
+    if not aids:
+        return [], next_cursor
+
+    articles = db.session.query(*ARTICLE_RECORD)\
+                         .join(User, User.uid == Article.article_author_uid)\
+                         .join(Channel, Channel.cid == Article.article_channel_cid)\
+                         .filter(Article.aid.in_(aids))\
+                         .filter(Article.visibility == ArticleVisibility.Visible.value)\
+                         .filter(Channel.visible == true())\
+                         .filter(User.is_active)
+    by_aid = {article.aid: article for article in articles}
+    return [by_aid[aid] for aid in aids if aid in by_aid], next_cursor
+
+
+@click.command('prune-timelines')
+@click.option('--days', default=90, show_default=True, help='Drop timeline entries older than this.')
+@with_appcontext
+def prune_timelines_command(days):
+    """Remove old entries from the precomputed subscription feeds."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    removed = db.session.execute(timeline_table.delete().where(timeline_table.c.tl_created < cutoff)).rowcount
+    db.session.commit()
+    click.echo('{} timeline row(s) removed'.format(removed))
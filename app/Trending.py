@@ -0,0 +1,192 @@
+import threading
+import time
+
+from flask import current_app, has_request_context
+from sqlalchemy.exc import SQLAlchemyError
+
+LIKE, COMMENT = 'like', 'comment'
+
+
+#
+# Hot articles by forward decay: an event at time t adds weight * 2 ** ((t - L) / half life)
+# to its article, L being a fixed landmark, so stored scores only ever grow and rank the same
+# way as exponentially decayed ones without rewriting every row as time passes.
+# To keep the numbers finite the landmark moves every TRENDING_EPOCH_HALF_LIVES half lives;
+# each row remembers its epoch and rows of the previous epoch are scaled down when compared
+# or updated, older ones have decayed to nothing and are deleted.
+#
+# Each worker sums its events per article in memory and every TRENDING_PERSIST_INTERVAL seconds
+# adds them to the trending table in one transaction, then reloads the TRENDING_SIZE best
+# visible articles. /api/trending is served from that list and only looks the articles up by
+# primary key, which also drops anything disabled since the last reload.
+#
+class Trending(object):
+    def __init__(self):
+        self.size = 100
+        self.half_life = 6 * 3600.0
+        self.epoch_half_lives = 64
+        self.persist_interval = 10.0
+        self.weights = {LIKE: 1.0, COMMENT: 2.0}
+        self._pending = {}
+        self._ranked = []
+        self._last_persist = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.size = app.config.get('TRENDING_SIZE', self.size)
+        self.half_life = float(app.config.get('TRENDING_HALF_LIFE', self.half_life))
+        self.epoch_half_lives = app.config.get('TRENDING_EPOCH_HALF_LIVES', self.epoch_half_lives)
+        self.persist_interval = app.config.get('TRENDING_PERSIST_INTERVAL', self.persist_interval)
+        self.weights = dict(self.weights, **(app.config.get('TRENDING_WEIGHTS') or {}))
+        with self._lock:
+            self._pending, self._ranked, self._last_persist = {}, [], 0
+
+    @property
+    def epoch_seconds(self):
+        return self.half_life * self.epoch_half_lives
+
+    def _epoch_scale(self, epochs):
+        # value of one unit of an older epoch in units of the current one
+        return 2.0 ** (-self.epoch_half_lives * epochs) if epochs < 4 else 0.0
+
+    def _forward(self, weight, now):
+        epoch = int(now // self.epoch_seconds)
+        return epoch, weight * 2.0 ** ((now - epoch * self.epoch_seconds) / self.half_life)
+
+    def _combine(self, epoch, score, new_epoch, delta):
+        return score * self._epoch_scale(new_epoch - epoch) + delta
+
+    def _add_pending(self, aid, epoch, delta):
+        # caller holds self._lock
+        pending_epoch, value = self._pending.get(aid, (epoch, 0.0))
+        latest = max(epoch, pending_epoch)
+        self._pending[aid] = (latest, value * self._epoch_scale(latest - pending_epoch) +
+                              delta * self._epoch_scale(latest - epoch))
+
+    #
+    # Count `count` events of `kind` (LIKE, COMMENT; negative to take likes back) on each of `aids`.
+    # Call after the write committed.
+    #
+    def record(self, kind, aids, count=1):
+        epoch, delta = self._forward(self.weights[kind] * count, time.time())
+        with self._lock:
+            for aid in aids:
+                self._add_pending(aid, epoch, delta)
+        self.maybe_persist()
+
+    def maybe_persist(self):
+        if time.time() - self._last_persist > self.persist_interval:
+            self.persist()
+
+    def persist(self):
+        from app import db
+        from app.Models import trending_table as table, insert_ignore
+        from app.Routing import use_primary
+        from sqlalchemy import bindparam
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_persist = time.time()
+
+        epoch = int(time.time() // self.epoch_seconds)
+        if has_request_context():
+            use_primary()
+        try:
+            if pending:
+                existing = {row.tr_article_aid: row for row in
+                            db.session.query(table).filter(table.c.tr_article_aid.in_(list(pending)))
+                                                   .with_for_update()}
+                deltas = {aid: self._combine(pending_epoch, delta, epoch, 0.0)
+                          for aid, (pending_epoch, delta) in pending.items()}
+                raced = []
+                for aid in deltas:
+                    if aid not in existing:
+                        row = {'tr_article_aid': aid, 'tr_epoch': epoch, 'tr_score': deltas[aid]}
+                        if not db.session.execute(insert_ignore(table), row).rowcount:
+                            raced.append(aid)
+                # another worker inserted these since the select above, add to its rows instead
+                if raced:
+                    existing.update((row.tr_article_aid, row) for row in
+                                    db.session.query(table).filter(table.c.tr_article_aid.in_(raced))
+                                                           .with_for_update())
+                updates = [{'b_aid': aid, 'b_epoch': epoch,
+                            'b_score': self._combine(row.tr_epoch, row.tr_score, epoch, deltas[aid])}
+                           for aid, row in existing.items()]
+                if updates:
+                    db.session.execute(table.update().where(table.c.tr_article_aid == bindparam('b_aid'))
+                                                     .values(tr_epoch=bindparam('b_epoch'),
+                                                             tr_score=bindparam('b_score')), updates)
+            db.session.execute(table.delete().where(table.c.tr_epoch < epoch - 1))
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            # trending is best effort, keep the events for the next attempt instead of failing a write
+            with self._lock:
+                for aid, (pending_epoch, delta) in pending.items():
+                    self._add_pending(aid, pending_epoch, delta)
+            current_app.logger.warning('could not persist trending scores', exc_info=True)
+            return
+
+        self.reload(epoch)
+
+    #
+    # Reload the best TRENDING_SIZE visible articles of the current and previous epoch.
+    #
+    def reload(self, epoch=None):
+        from app import db
+        from app.Models import User, Article, ArticleVisibility, Channel, trending_table as table
+        from sqlalchemy import true
+
+        if epoch is None:
+            epoch = int(time.time() // self.epoch_seconds)
+        ranked = []
+        for rows_epoch in (epoch, epoch - 1):
+            rows = db.session.query(table.c.tr_article_aid, table.c.tr_score)\
+                             .join(Article, Article.aid == table.c.tr_article_aid)\
+                             .join(Channel, Channel.cid == Article.article_channel_cid)\
+                             .join(User, User.uid == Article.article_author_uid)\
+                             .filter(table.c.tr_epoch == rows_epoch)\
+                             .filter(table.c.tr_score > 0)\
+                             .filter(Article.visibility == ArticleVisibility.Visible.value)\
+                             .filter(Channel.visible == true())\
+                             .filter(User.is_active)\
+                             .order_by(table.c.tr_score.desc()).limit(self.size)
+            scale = self._epoch_scale(epoch - rows_epoch)
+            ranked.extend((row.tr_article_aid, row.tr_score * scale) for row in rows)
+        ranked.sort(key=lambda item: -item[1])
+        with self._lock:
+            self._ranked = ranked[:self.size]
+
+    #
+    # Drop moderated articles (and their scores) right away.
+    #
+    def discard(self, aids=None, cid=None):
+        from app import db
+        from app.Models import Article, trending_table as table
+
+        if cid is not None:
+            aids = [row.aid for row in db.session.query(Article.aid)
+                                                 .join(table, table.c.tr_article_aid == Article.aid)
+                                                 .filter(Article.article_channel_cid == cid)]
+        if not aids:
+            return
+        db.session.execute(table.delete().where(table.c.tr_article_aid.in_(aids)))
+        gone = set(aids)
+        with self._lock:
+            self._ranked = [item for item in self._ranked if item[0] not in gone]
+            for aid in gone:
+                self._pending.pop(aid, None)
+
+    #
+    # The current ranking as (aid, score) pairs, scores decayed to now in units of one like.
+    #
+    def ranking(self):
+        if not self._last_persist:
+            self.persist()
+        else:
+            self.maybe_persist()
+        now = time.time()
+        epoch = int(now // self.epoch_seconds)
+        scale = 2.0 ** (-(now - epoch * self.epoch_seconds) / self.half_life)
+        with self._lock:
+            return [(aid, score * scale) for aid, score in self._ranked]
@@ -0,0 +1,326 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+LIKE, UNLIKE, COMMENT = 'like', 'unlike', 'comment'
+
+
+#
+# Append-only log of acknowledged writes, one sqlite file shared by all workers on the host.
+# Every append is committed with synchronous=FULL, so an acknowledged write survives a crash
+# of the process or the machine. seq never repeats (AUTOINCREMENT), the checkpoint kept in the
+# main database relies on that.
+#
+class WriteLog(object):
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS ops (seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, '
+                         'uid INTEGER NOT NULL, aid INTEGER NOT NULL, body TEXT, created REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_ops_user_article ON ops (uid, aid)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('log_id', ?)", (uuid.uuid4().hex,))
+        self.log_id = self._connection().execute("SELECT value FROM meta WHERE key = 'log_id'").fetchone()[0]
+
+    def _connection(self):
+        # connections must not cross threads or forks
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def append(self, op, uid, aid, body=None, created=None):
+        with self._connection() as conn:
+            conn.execute('INSERT INTO ops (op, uid, aid, body, created) VALUES (?, ?, ?, ?, ?)',
+                         (op, uid, aid, body, time.time() if created is None else created))
+
+    #
+    # Append a like (or unlike) unless `uid` already (doesn't) like `aid` once the log is applied,
+    # returns whether it was appended. BEGIN IMMEDIATE holds the log's write lock from the check to
+    # the append, so concurrent requests of any worker can't both append the same change, and a
+    # flush can't trim the pair's entries before `stored()` (the state in the database) is read.
+    #
+    def append_like(self, uid, aid, like, stored, created=None):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            pending = self.last_like(uid, aid)
+            changed = (stored() if pending is None else pending) != like
+            if changed:
+                conn.execute('INSERT INTO ops (op, uid, aid, body, created) VALUES (?, ?, ?, ?, ?)',
+                             (LIKE if like else UNLIKE, uid, aid, None, time.time() if created is None else created))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return changed
+
+    def last_like(self, uid, aid):
+        row = self._connection().execute('SELECT op FROM ops WHERE uid = ? AND aid = ? AND op IN (?, ?) '
+                                         'ORDER BY seq DESC LIMIT 1', (uid, aid, LIKE, UNLIKE)).fetchone()
+        return None if row is None else row['op'] == LIKE
+
+    def oldest(self):
+        row = self._connection().execute('SELECT created FROM ops ORDER BY seq LIMIT 1').fetchone()
+        return None if row is None else row['created']
+
+    def pending(self):
+        return self._connection().execute('SELECT COUNT(*) FROM ops').fetchone()[0]
+
+    def batch(self, after_seq, limit):
+        return self._connection().execute('SELECT seq, op, uid, aid, body, created FROM ops WHERE seq > ? '
+                                          'ORDER BY seq LIMIT ?', (after_seq, limit)).fetchall()
+
+    def discard(self, upto_seq):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM ops WHERE seq <= ?', (upto_seq,))
+
+
+def _group_deltas(deltas):
+    groups = {}
+    for key, delta in deltas.items():
+        if delta:
+            groups.setdefault(delta, []).append(key)
+    return groups
+
+
+#
+# Apply one batch of log entries in the current transaction.
+# Likes are coalesced per (user, article) to their last state and compared with the stored
+# likes, so a replayed or repeated entry never counts twice. Entries for articles deleted in
+# the meantime are dropped. Comments keep the time they were acknowledged at, not the flush time.
+# Returns the touched article ids and those that got comments.
+#
+def _apply(ops):
+    from app import db
+    from app.Counters import adjust_article_comments, adjust_articles_likes
+    from app.Models import Article, Comment, favorite_table, insert_ignore
+    from sqlalchemy import and_, bindparam
+
+    likes, comments = OrderedDict(), []
+    for op in ops:
+        if op['op'] == COMMENT:
+            comments.append(op)
+        else:
+            likes[(op['uid'], op['aid'])] = op['op'] == LIKE
+
+    aids = {op['aid'] for op in ops}
+    live = {row.aid for row in db.session.query(Article.aid).filter(Article.aid.in_(aids))}
+
+    liked_delta = Counter()
+    if likes:
+        uids = {uid for uid, _ in likes}
+        existing = {(row.fav_user_uid, row.fav_article_aid) for row in
+                    db.session.query(favorite_table).filter(favorite_table.c.fav_user_uid.in_(uids))
+                                                    .filter(favorite_table.c.fav_article_aid.in_(aids))
+                                                    .with_for_update()}
+        added = [pair for pair, liked in likes.items() if liked and pair not in existing and pair[1] in live]
+        removed = [pair for pair, liked in likes.items() if not liked and pair in existing]
+        if added:
+            db.session.execute(insert_ignore(favorite_table),
+                               [{'fav_user_uid': uid, 'fav_article_aid': aid} for uid, aid in added])
+        if removed:
+            pair = and_(favorite_table.c.fav_user_uid == bindparam('b_uid'),
+                        favorite_table.c.fav_article_aid == bindparam('b_aid'))
+            db.session.execute(favorite_table.delete().where(pair),
+                               [{'b_uid': uid, 'b_aid': aid} for uid, aid in removed])
+        liked_delta.update(aid for _, aid in added)
+        liked_delta.subtract(aid for _, aid in removed)
+        for delta, changed in _group_deltas(liked_delta).items():
+            adjust_articles_likes(changed, delta)
+
+    comment_rows = [{'body': op['body'], 'comment_user_uid': op['uid'], 'comment_article_aid': op['aid'],
+                     'comment_created': datetime.utcfromtimestamp(op['created'])}
+                    for op in comments if op['aid'] in live]
+    if comment_rows:
+        db.session.execute(Comment.__table__.insert(), comment_rows)
+        for aid, count in Counter(row['comment_article_aid'] for row in comment_rows).items():
+            adjust_article_comments(aid, count)
+
+    commented = {row['comment_article_aid'] for row in comment_rows}
+    return {aid for aid, delta in liked_delta.items() if delta} | commented, commented
+
+
+#
+# Write-behind mode for likes and comments (WRITE_BEHIND_ENABLED).
+# Routes append to the local WriteLog and answer 202 right away; a flusher thread per worker
+# applies the log every WRITE_BEHIND_FLUSH_INTERVAL seconds in batches of WRITE_BEHIND_BATCH_SIZE,
+# each in one transaction together with the log's checkpoint row. A crash between that commit
+# and trimming the log only leaves entries at or below the checkpoint, which the next flush
+# discards, so replaying the log after a restart applies every write exactly once.
+# One worker per host flushes at a time (file lock next to the log). If the oldest entry gets
+# older than WRITE_BEHIND_MAX_STALENESS the writing request flushes inline, which bounds the lag
+# even when the flushers can't keep up and pushes back on writers instead of growing the log.
+# The write is already in the log by then, so a failing inline flush is logged and the request
+# is still acknowledged.
+#
+class WriteBehind(object):
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.log = None
+        self.flush_interval, self.batch_size, self.max_staleness = 0.5, 1000, 5
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self._lock_fd, self._lock_pid = None, None
+        self._stats_lock = threading.Lock()
+        self.stats = {'queued': 0, 'flushed': 0, 'inline_flushes': 0, 'flush_errors': 0}
+
+    def init_app(self, app):
+        self.enabled = app.config.get('WRITE_BEHIND_ENABLED', False)
+        self.flush_interval = app.config.get('WRITE_BEHIND_FLUSH_INTERVAL', self.flush_interval)
+        self.batch_size = app.config.get('WRITE_BEHIND_BATCH_SIZE', self.batch_size)
+        self.max_staleness = app.config.get('WRITE_BEHIND_MAX_STALENESS', self.max_staleness)
+        if not self.enabled:
+            return
+
+        self.app = app
+        self.log = WriteLog(app.config['WRITE_BEHIND_LOG_PATH'])
+        app.before_request(self.start_flusher)
+
+    # threads don't survive a fork: called by the gunicorn post_worker_init hook (see app/Startup.py),
+    # and on the first request of a worker otherwise, so a log left by a crash is replayed right away
+    def start_flusher(self):
+        if self._thread_pid != os.getpid():
+            with self._lock:
+                if self._thread_pid != os.getpid():
+                    threading.Thread(target=self._run, name='koinu-write-behind', daemon=True).start()
+                    self._thread_pid = os.getpid()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                with self.app.app_context():
+                    self.flush(block=False)
+            except Exception:
+                self._count('flush_errors')
+                self.app.logger.exception('write-behind flush failed, retrying in %ss', self.flush_interval)
+
+    def _acquire(self, block):
+        if not self._lock.acquire(blocking=block):
+            return False
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.log.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_pid = os.getpid()
+        try:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            self._lock.release()
+            return False
+
+    def _release(self):
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def queue(self, op, uid, aid, body=None, stored=None):
+        acknowledged = time.time()
+        if op == COMMENT:
+            self.log.append(op, uid, aid, body, acknowledged)
+        elif not self.log.append_like(uid, aid, op == LIKE, stored, acknowledged):
+            return False
+        self._count('queued')
+        oldest = self.log.oldest()
+        if oldest is not None and acknowledged - oldest > self.max_staleness:
+            self._count('inline_flushes')
+            try:
+                self.flush()
+            except Exception:
+                self._count('flush_errors')
+                self.app.logger.exception('inline write-behind flush failed, the write stays in the log')
+        return True
+
+    #
+    # Queue a like/unlike unless it changes nothing once the log is applied, returns whether it was queued.
+    # `stored` returns whether `uid` likes `aid` in the database, it is only called when the log doesn't tell.
+    #
+    def like(self, uid, aid, stored):
+        return self.queue(LIKE, uid, aid, stored=stored)
+
+    def unlike(self, uid, aid, stored):
+        return self.queue(UNLIKE, uid, aid, stored=stored)
+
+    def comment(self, uid, aid, body):
+        self.queue(COMMENT, uid, aid, body)
+
+    def flush(self, block=True):
+        if not self._acquire(block):
+            return 0
+        try:
+            applied = 0
+            while True:
+                count = self._flush_batch()
+                applied += count
+                if count < self.batch_size:
+                    return applied
+        finally:
+            self._release()
+
+    def _flush_batch(self):
+        from app import db, response_cache
+        from app.Models import Article, write_checkpoint_table as checkpoints
+        from sqlalchemy import select
+
+        try:
+            checkpoint = db.session.execute(select([checkpoints.c.last_seq])
+                                            .where(checkpoints.c.log_id == self.log.log_id)
+                                            .with_for_update()).scalar()
+            # applied before a crash, the log just wasn't trimmed
+            if checkpoint is not None:
+                self.log.discard(checkpoint)
+
+            ops = self.log.batch(checkpoint or 0, self.batch_size)
+            if not ops:
+                db.session.rollback()
+                return 0
+
+            aids, commented = _apply(ops)
+            last_seq = ops[-1]['seq']
+            if checkpoint is None:
+                db.session.execute(checkpoints.insert().values(log_id=self.log.log_id, last_seq=last_seq))
+            else:
+                db.session.execute(checkpoints.update().where(checkpoints.c.log_id == self.log.log_id)
+                                                       .values(last_seq=last_seq))
+            cids = {row.article_channel_cid for row in
+                    db.session.query(Article.article_channel_cid).filter(Article.aid.in_(aids)).distinct()} \
+                if aids else set()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self.log.discard(last_seq)
+        self._count('flushed', len(ops))
+        tags = ['article:{}'.format(aid) for aid in aids] + ['channel:{}'.format(cid) for cid in cids]
+        tags += ['comments:{}'.format(aid) for aid in commented]
+        response_cache.invalidate(*tags)
+        return len(ops)
+
+
+@click.command('flush-writes')
+@with_appcontext
+def flush_writes_command():
+    """Apply the local write-behind log, e.g. to replay it after a crash."""
+    from app import write_behind
+
+    if not write_behind.enabled:
+        raise click.ClickException('WRITE_BEHIND_ENABLED is off')
+    click.echo('{} write(s) applied, {} pending'.format(write_behind.flush(), write_behind.log.pending()))
@@ -1,6 +1,5 @@
-from flask import Flask, jsonify, request
+from flask import Flask, request
 from flask_jwt_extended import JWTManager
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 
 from functools import wraps
@@ -8,13 +7,31 @@ from importlib import import_module
 
 from argon2 import PasswordHasher
 
+from app.Admission import AdmissionControl, Overloaded, RateLimited
+from app.Hashing import HashingPool, HashingPoolSaturated
+from app.Json import JsonEncoding, jsonify
 from app.KoinuConfig import ActiveConfig as Config
+from app.Metrics import RequestMetrics
+from app.ResponseCache import ResponseCache
+from app.Routing import RoutingSQLAlchemy
+from app.Startup import Startup
+from app.Revocation import TokenBlacklist
+from app.Trending import Trending
+from app.WriteBehind import WriteBehind
 
 jwt = JWTManager()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 argon2 = PasswordHasher()
-blacklist = set()
+hashing_pool = HashingPool()
+blacklist = TokenBlacklist()
+response_cache = ResponseCache()
+request_metrics = RequestMetrics()
+write_behind = WriteBehind()
+admission = AdmissionControl()
+trending = Trending()
+json_encoding = JsonEncoding()
+startup = Startup()
 
 import_module('app.Models')
 
@@ -36,13 +53,68 @@ def limit_payload_length(max_length):
     return decorator
 
 
-def create_app():
+def resource_not_found(e):
+    return jsonify({'msg': 'resource not found'}), 404
+
+
+def method_not_allowed(e):
+    return jsonify({'msg': 'method not allowed'}), 405
+
+
+def bad_cursor(e):
+    return jsonify({'msg': 'bad cursor'}), 400
+
+
+def hashing_pool_saturated(e):
+    return jsonify({'msg': 'too many logins, try again later'}), 503, {'Retry-After': str(e.retry_after)}
+
+
+def rate_limited(e):
+    return jsonify({'msg': 'too many requests, slow down'}), 429, {'Retry-After': str(e.retry_after)}
+
+
+def overloaded(e):
+    return jsonify({'msg': 'server busy, try again later'}), 503, {'Retry-After': str(e.retry_after)}
+
+
+def internal_error(e):
+    return jsonify(msg='an internal error has occurred'), 500
+
+
+def hello_world():
+    return jsonify({'msg': 'Hello!'})
+
+
+def response_cache_stats():
+    return jsonify(response_cache.stats), 200
+
+
+def metrics():
+    return request_metrics.expose(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+#
+# Build an app from the active config, entries of `config` override it (benchmarks, scripts).
+#
+def create_app(config=None):
     _app = Flask(__name__)
     _app.config.from_object(Config)
+    if config is not None:
+        _app.config.from_mapping(config)
 
     jwt.init_app(_app)
     db.init_app(_app)
     migrate.init_app(_app, db)
+    blacklist.init_app(_app)
+    hashing_pool.init_app(_app)
+    response_cache.init_app(_app)
+    request_metrics.init_app(_app)
+    write_behind.init_app(_app)
+    admission.init_app(_app)
+    trending.init_app(_app)
+    json_encoding.init_app(_app)
+    startup.init_app(_app)
+    import_module('app.Identity').identity_cache.init_app(_app)
 
     _app.register_blueprint(import_module('app.routes.UserControl').user_control, url_prefix='/api/user')
     _app.register_blueprint(import_module('app.routes.ContentDisplay').content_display, url_prefix='/api')
@@ -51,34 +123,29 @@ def create_app():
     _app.register_blueprint(import_module('app.routes.ContentControl').content_control, url_prefix='/api')
     _app.register_blueprint(import_module('app.routes.Admin').admin, url_prefix='/api')
 
-    return _app
+    _app.register_error_handler(404, resource_not_found)
+    _app.register_error_handler(405, method_not_allowed)
+    _app.register_error_handler(import_module('app.Pagination').BadCursor, bad_cursor)
+    _app.register_error_handler(HashingPoolSaturated, hashing_pool_saturated)
+    _app.register_error_handler(RateLimited, rate_limited)
+    _app.register_error_handler(Overloaded, overloaded)
+    if not _app.config['DEBUG']:
+        _app.register_error_handler(500, internal_error)
 
+    _app.add_url_rule('/api', 'hello_world', hello_world)
+    _app.add_url_rule('/api/cache/stats', 'response_cache_stats', response_cache_stats)
+    _app.add_url_rule('/api/metrics', 'metrics', metrics)
 
-app_instance = create_app()
+    _app.cli.add_command(import_module('app.Counters').reconcile_counters_command)
+    _app.cli.add_command(import_module('app.Timeline').prune_timelines_command)
+    _app.cli.add_command(import_module('app.WriteBehind').flush_writes_command)
+
+    return _app
 
 
 @jwt.token_in_blacklist_loader
 def check_blacklisted(decrypted_token):
-    jti = decrypted_token['jti']
-    return jti in blacklist
-
-
-@app_instance.errorhandler(404)
-def resource_not_found(e):
-    return jsonify({'msg': 'resource not found'}), 404
-
-
-@app_instance.errorhandler(405)
-def method_not_allowed(e):
-    return jsonify({'msg': 'method not allowed'}), 405
+    return blacklist.is_revoked(decrypted_token['jti'], decrypted_token.get('exp'))
 
 
-if not Config.DEBUG:
-    @app_instance.errorhandler(500)
-    def internal_error(e):
-        return jsonify(msg='an internal error has occurred'), 500
-
-
-@app_instance.route('/api')
-def hello_world():
-    return jsonify({'msg': 'Hello!'})
+app_instance = create_app()
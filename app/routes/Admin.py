@@ -1,18 +1,33 @@
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import get_jwt_identity, jwt_required
+from collections import Counter
+from functools import wraps
 
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
+
+from sqlalchemy import bindparam, true
 from sqlalchemy.exc import IntegrityError, DataError
 
-from app import db, limit_payload_length
-from app.Models import User, Article, Channel, Comment
+from app import db, admission, limit_payload_length, response_cache, trending
+from app.Counters import adjust_article_comments
+from app.Identity import current_identity, identity_cache
+from app.Json import jsonify
+from app.Loading import ARTICLE_RECORD, bakery
+from app.Models import User, Article, ArticleStatus, ArticleVisibility, Channel, Comment
+from app.Pagination import keyset_page, keyset_query, page_args, page_headers
+from app.Serializers import helper_article_list, stream_article_list
+from app.Streaming import stream_json, stream_requested
+from app.Timeline import fan_out_articles, prune_articles, prune_channel
 
 admin = Blueprint('admin', __name__)
 
 
-def check_admin(username):
-    user = User.query.filter_by(username=username).filter_by(is_active=True).first()
-    if user:
-        return user.is_admin()
+#
+# Answered from the token claims and the identity cache, see app/Identity.py.
+#
+def check_admin():
+    identity = current_identity()
+    if identity:
+        return identity.is_admin()
     return False
 
 
@@ -21,7 +36,9 @@ def check_admin(username):
 # Channel admin is not used so the query doesn't filter disabled admins.
 #
 def one_channel_query(cid):
-    channel = Channel.query.filter(Channel.status.op('&')(4) == 0).filter_by(cid=cid).first()
+    query = bakery(lambda session: session.query(Channel).filter(Channel.visible == true())
+                                                         .filter(Channel.cid == bindparam('cid')))
+    channel = query(db.session()).params(cid=cid).first()
     return channel
 
 
@@ -36,8 +53,7 @@ def create_channel():
     if not name:
         return jsonify(msg='missing required channel name'), 400
 
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     description = request.json.get('description')
@@ -49,6 +65,7 @@ def create_channel():
     try:
         db.session.commit()
         ret_json['cid'] = channel_obj.cid
+        response_cache.invalidate('channels')
     except IntegrityError:
         ret_json['msg'], ret_code = 'channel name existed', 400
         db.session.rollback()
@@ -64,8 +81,7 @@ def create_channel():
 @admin.route('/article/delete/<int:aid>', methods=['POST', 'DELETE'])
 @jwt_required
 def delete_article(aid):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     article_obj = Article.query.get(aid)
@@ -77,7 +93,11 @@ def delete_article(aid):
     else:
         article_obj.set_disabled()
         db.session.add(article_obj)
+        prune_articles([aid])
+        trending.discard(aids=[aid])
         db.session.commit()  # error not expected
+        response_cache.invalidate('article:{}'.format(aid), 'comments:{}'.format(aid),
+                                  'channel:{}'.format(article_obj.article_channel_cid))
         return jsonify(msg='article removed'), 200
 
 
@@ -87,24 +107,25 @@ def delete_article(aid):
 @admin.route('/article/comments/delete/<int:aid>/<int:coid>', methods=['POST', 'DELETE'])
 @jwt_required
 def delete_comment(aid, coid):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     comment_obj = Comment.query.filter_by(coid=coid, comment_article_aid=aid).first()
     if not comment_obj:
         return jsonify(msg='no such comment'), 404
 
+    cid = db.session.query(Article.article_channel_cid).filter_by(aid=aid).scalar()
     db.session.delete(comment_obj)
+    adjust_article_comments(aid, -1)
     db.session.commit()  # error not expected
+    response_cache.invalidate('comments:{}'.format(aid), 'article:{}'.format(aid), 'channel:{}'.format(cid))
     return jsonify(msg='comment deleted'), 200
 
 
 @admin.route('/channel/delete/<int:cid>', methods=['POST', 'DELETE'])
 @jwt_required
 def delete_channel(cid):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     channel_obj = Channel.query.get(cid)
@@ -116,12 +137,17 @@ def delete_channel(cid):
     else:
         channel_obj.set_disabled()
         db.session.add(channel_obj)
+        prune_channel(cid)
+        trending.discard(cid=cid)
         db.session.commit()  # error not expected
+        # articles of the channel are cached under their own tags, drop everything
+        response_cache.invalidate(response_cache.GLOBAL_TAG)
         return jsonify(msg='channel removed'), 200
 
 
 @admin.route('/channel/post/<int:cid>', methods=['POST'])
 @jwt_required
+@admission.rate_limit('write')
 @limit_payload_length(Article.MAX_CONTENT_LENGTH + Article.MAX_TITLE_LENGTH + 100)
 def post_article_to_channel(cid):
     if not request.is_json:
@@ -132,9 +158,8 @@ def post_article_to_channel(cid):
     if not title or not content:
         return jsonify(msg='missing title or content'), 400
 
-    username = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify(msg='who are you?'), 400
 
     channel = one_channel_query(cid)
@@ -142,12 +167,15 @@ def post_article_to_channel(cid):
         return jsonify(msg='what channel?'), 404
 
     # admin user can post article without approval
-    article_obj = Article(title=title, content=content, article_author_uid=user_obj.uid,
-                          article_channel_cid=cid, article_status=1 if user_obj.is_admin() else 9)
+    article_obj = Article(title=title, content=content, article_author_uid=identity.uid,
+                          article_channel_cid=cid, article_status=1 if identity.is_admin() else 9)
     db.session.add(article_obj)
 
     try:
+        db.session.flush()
+        fan_out_articles([article_obj.aid])
         db.session.commit()
+        response_cache.invalidate('channel:{}'.format(cid))
         return jsonify(msg='article requested', aid=article_obj.aid)
     except DataError:
         db.session.rollback()
@@ -156,52 +184,46 @@ def post_article_to_channel(cid):
 
 
 #
-# Return active requests of active channels.
+# Return active requests of active channels, oldest first.
+# With ?stream=1 the whole queue from the cursor on is streamed instead of a single page.
 #
 @admin.route('/article/requests')
 @admin.route('/article/requests/<int:cid>')
 @jwt_required
+@admission.concurrency('moderation')
 def get_requests(cid=None):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    cursor, limit = page_args()
+
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
-    request_it = []
+    requests_it = db.session.query(*ARTICLE_RECORD).join(Channel, Channel.cid == Article.article_channel_cid)\
+                                                   .filter(Article.visibility == ArticleVisibility.Requested.value)
     if cid:
         channel = one_channel_query(cid)
         if not channel:
             return jsonify(msg='what channel?'), 404
 
-        requests_it = Article.query.filter(Article.article_status.op('&')(4) == 0)\
-                                   .filter(Article.article_status.op('&')(8) != 0)\
-                                   .filter_by(article_channel_cid=cid)
+        requests_it = requests_it.filter(Article.article_channel_cid == cid)
     else:
-        requests_it = Article.query.join(Channel).filter(Channel.status.op('&')(4) == 0)\
-                                                 .filter(Article.article_status.op('&')(4) == 0)\
-                                                 .filter(Article.article_status.op('&')(8) != 0)
+        requests_it = requests_it.filter(Channel.visible == true())
 
-    requested_articles = []
-    for article in requests_it:
-        article_dict = {
-            'aid': article.aid,
-            'cid': article.article_channel_cid,
-            'channel': article.channel.name,
-            'title': article.title,
-            'author': article.author.username,
-            'publish_time': article.article_created,
-            'content': article.content
-        }
+    if stream_requested():
+        requests_it = keyset_query(requests_it.join(User, User.uid == Article.article_author_uid),
+                                   Article.article_created, Article.aid, cursor, descending=False)
+        return stream_json(stream_article_list(requests_it, with_channel=True))
 
-        requested_articles.append(article_dict)
+    requests_it, next_cursor = keyset_page(requests_it, Article.article_created, Article.aid, cursor, limit,
+                                           descending=False)
+    requested_articles = helper_article_list(requests_it, with_channel=True)
 
-    return jsonify(requested_articles), 200
+    return jsonify(requested_articles), 200, page_headers(next_cursor)
 
 
 @admin.route('/article/accept/<int:aid>', methods=['POST'])
 @jwt_required
 def accept_article(aid):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     article = Article.query.get(aid)
@@ -211,7 +233,10 @@ def accept_article(aid):
     if article.is_requested() and not article.is_disabled():
         article.toggle_requested()
         db.session.add(article)
+        db.session.flush()
+        fan_out_articles([aid])
         db.session.commit()
+        response_cache.invalidate('channel:{}'.format(article.article_channel_cid))
         return jsonify(msg='requested article accepted'), 200
 
     msg = 'requested article already accepted'
@@ -224,8 +249,7 @@ def accept_article(aid):
 @admin.route('/article/reject/<int:aid>', methods=['POST'])
 @jwt_required
 def reject_article(aid):
-    username = get_jwt_identity()
-    if not check_admin(username):
+    if not check_admin():
         return jsonify(msg='unauthorized'), 401
 
     article = Article.query.get(aid)
@@ -244,3 +268,231 @@ def reject_article(aid):
         msg = 'requested article already removed'
 
     return jsonify(msg=msg), 400
+
+
+#
+# Bulk moderation: every id is classified from one locked read, the eligible ones change with a
+# single UPDATE and the whole batch commits once. Outcomes are reported per id.
+#
+BULK_MAX_ITEMS = 1000
+BULK_OUTCOMES = {
+    ArticleVisibility.Hidden.value: 'already removed',
+    ArticleVisibility.Visible.value: 'already accepted',
+    ArticleVisibility.Requested.value: 'requested'
+}
+
+
+def helper_bulk_ids(key):
+    ids = request.json.get(key)
+    if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return None
+    return list(dict.fromkeys(ids))
+
+
+#
+# Ids from {"aids": [...]}, or with {"cid": ...} the oldest requested articles of that channel.
+# Returns (aids, more) where more tells the caller to repeat the request, or None if malformed.
+#
+def helper_bulk_article_ids(allow_channel_filter):
+    if allow_channel_filter and request.json.get('cid') is not None:
+        cid = request.json.get('cid')
+        if not isinstance(cid, int) or isinstance(cid, bool):
+            return None
+        aids = [row.aid for row in db.session.query(Article.aid)
+                .filter(Article.article_channel_cid == cid)
+                .filter(Article.visibility == ArticleVisibility.Requested.value)
+                .order_by(Article.article_created, Article.aid).limit(BULK_MAX_ITEMS + 1)]
+        return aids[:BULK_MAX_ITEMS], len(aids) > BULK_MAX_ITEMS
+
+    aids = helper_bulk_ids('aids')
+    return (aids, False) if aids is not None else None
+
+
+def helper_bulk_article_update(aids, eligible, values, outcome):
+    rows = db.session.query(Article.aid, Article.visibility, Article.article_channel_cid)\
+                     .filter(Article.aid.in_(aids)).with_for_update()
+    states = {row.aid: row for row in rows}
+
+    results, changed, cids = {}, [], set()
+    for aid in aids:
+        row = states.get(aid)
+        if row is None:
+            results[aid] = 'not found'
+        elif row.visibility in eligible:
+            results[aid] = outcome
+            changed.append(aid)
+            cids.add(row.article_channel_cid)
+        else:
+            results[aid] = BULK_OUTCOMES[row.visibility]
+
+    if changed:
+        # moderation isn't an edit, keep the author's updated time (onupdate would bump it)
+        values = dict(values)
+        values[Article.article_updated] = Article.article_updated
+        # the status bits change by arithmetic, only rows still eligible may take it
+        updated = Article.query.filter(Article.aid.in_(changed)).filter(Article.visibility.in_(eligible))\
+                               .update(values, synchronize_session=False)
+        if updated != len(changed):
+            # moderated in between (SQLite ignores FOR UPDATE), keep the rows this update moved
+            target = values[Article.visibility]
+            now = {row.aid: row.visibility for row in
+                   db.session.query(Article.aid, Article.visibility).filter(Article.aid.in_(changed))}
+            for aid in changed:
+                if now.get(aid) != target:
+                    results[aid] = BULK_OUTCOMES.get(now.get(aid), 'not found')
+            changed = [aid for aid in changed if now.get(aid) == target]
+            cids = {states[aid].article_channel_cid for aid in changed}
+    return results, changed, cids
+
+
+def helper_bulk_response(results, changed, noun, more=False):
+    ret_json = {'msg': '{} {}'.format(len(changed), noun), 'results': {str(k): v for k, v in results.items()}}
+    if more:
+        ret_json['more'] = True
+    return jsonify(ret_json), 200
+
+
+#
+# Parses and authorizes a bulk article request, the view gets (aids, more).
+#
+def bulk_article_request(allow_channel_filter):
+    def decorator(f):
+        @wraps(f)
+        def wrapper():
+            if not request.is_json:
+                return jsonify(msg='not json'), 400
+
+            if not check_admin():
+                return jsonify(msg='unauthorized'), 401
+
+            parsed = helper_bulk_article_ids(allow_channel_filter)
+            if parsed is None:
+                return jsonify(msg='expected a list of article ids'), 400
+
+            aids, more = parsed
+            if len(aids) > BULK_MAX_ITEMS:
+                return jsonify(msg='too many articles', max=BULK_MAX_ITEMS), 413
+
+            return f(aids, more)
+
+        return wrapper
+
+    return decorator
+
+
+@admin.route('/article/accept', methods=['POST'])
+@jwt_required
+@limit_payload_length(BULK_MAX_ITEMS * 12 + 100)
+@bulk_article_request(allow_channel_filter=True)
+def accept_articles(aids, more):
+    results, changed, cids = helper_bulk_article_update(
+        aids, {ArticleVisibility.Requested.value},
+        {Article.article_status: Article.article_status - ArticleStatus.Requested.value,
+         Article.visibility: ArticleVisibility.Visible.value}, 'accepted')
+
+    fan_out_articles(changed)
+    db.session.commit()
+    response_cache.invalidate(*['channel:{}'.format(cid) for cid in cids])
+    return helper_bulk_response(results, changed, 'article(s) accepted', more)
+
+
+#
+# Same bit change as reject_article: requested flag kept, disabled flag added.
+#
+@admin.route('/article/reject', methods=['POST'])
+@jwt_required
+@limit_payload_length(BULK_MAX_ITEMS * 12 + 100)
+@bulk_article_request(allow_channel_filter=True)
+def reject_articles(aids, more):
+    results, changed, _ = helper_bulk_article_update(
+        aids, {ArticleVisibility.Requested.value},
+        {Article.article_status: Article.article_status + ArticleStatus.Disabled.value,
+         Article.visibility: ArticleVisibility.Hidden.value}, 'rejected')
+
+    db.session.commit()
+    return helper_bulk_response(results, changed, 'article(s) rejected', more)
+
+
+@admin.route('/article/delete', methods=['POST', 'DELETE'])
+@jwt_required
+@limit_payload_length(BULK_MAX_ITEMS * 12 + 100)
+@bulk_article_request(allow_channel_filter=False)
+def delete_articles(aids, more):
+    results, changed, cids = helper_bulk_article_update(
+        aids, {ArticleVisibility.Visible.value, ArticleVisibility.Requested.value},
+        {Article.article_status: Article.article_status + ArticleStatus.Disabled.value,
+         Article.visibility: ArticleVisibility.Hidden.value}, 'removed')
+
+    prune_articles(changed)
+    trending.discard(aids=changed)
+    db.session.commit()
+    tags = ['article:{}'.format(aid) for aid in changed] + ['comments:{}'.format(aid) for aid in changed]
+    response_cache.invalidate(*(tags + ['channel:{}'.format(cid) for cid in cids]))
+    return helper_bulk_response(results, changed, 'article(s) removed', more)
+
+
+@admin.route('/article/comments/delete', methods=['POST', 'DELETE'])
+@jwt_required
+@limit_payload_length(BULK_MAX_ITEMS * 12 + 100)
+def delete_comments():
+    if not request.is_json:
+        return jsonify(msg='not json'), 400
+
+    if not check_admin():
+        return jsonify(msg='unauthorized'), 401
+
+    coids = helper_bulk_ids('coids')
+    if coids is None:
+        return jsonify(msg='expected a list of comment ids'), 400
+    if len(coids) > BULK_MAX_ITEMS:
+        return jsonify(msg='too many comments', max=BULK_MAX_ITEMS), 413
+
+    rows = db.session.query(Comment.coid, Comment.comment_article_aid, Article.article_channel_cid)\
+                     .join(Article, Article.aid == Comment.comment_article_aid)\
+                     .filter(Comment.coid.in_(coids)).with_for_update()
+    found = {row.coid: row for row in rows}
+    results = {coid: 'deleted' if coid in found else 'not found' for coid in coids}
+
+    removed = Counter(row.comment_article_aid for row in found.values())
+    if found:
+        Comment.query.filter(Comment.coid.in_(list(found))).delete(synchronize_session=False)
+        for aid, count in removed.items():
+            adjust_article_comments(aid, -count)
+    db.session.commit()
+
+    tags = ['comments:{}'.format(aid) for aid in removed] + ['article:{}'.format(aid) for aid in removed]
+    response_cache.invalidate(*(tags + ['channel:{}'.format(cid) for cid in
+                                        {row.article_channel_cid for row in found.values()}]))
+    return helper_bulk_response(results, list(found), 'comment(s) deleted')
+
+
+#
+# Disabled users can't log in, and their tokens stop working once the identity cache
+# entry for them is gone (immediately on this worker, after IDENTITY_CACHE_TTL on others).
+#
+def helper_set_user_active(uid, is_active):
+    if not check_admin():
+        return jsonify(msg='unauthorized'), 401
+
+    user_obj = User.query.get(uid)
+    if not user_obj:
+        return jsonify(msg='who is that?'), 404
+
+    user_obj.is_active = is_active
+    db.session.commit()
+    identity_cache.invalidate(uid)
+    # authors and commenters of cached pages may have changed visibility
+    response_cache.invalidate(response_cache.GLOBAL_TAG)
+    return jsonify(msg='user enabled' if is_active else 'user disabled'), 200
+
+
+@admin.route('/user/disable/<int:uid>', methods=['POST'])
+@jwt_required
+def disable_user(uid):
+    return helper_set_user_active(uid, False)
+
+
+@admin.route('/user/enable/<int:uid>', methods=['POST'])
+@jwt_required
+def enable_user(uid):
+    return helper_set_user_active(uid, True)
@@ -1,47 +1,45 @@
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
+from sqlalchemy import bindparam, true
 from sqlalchemy.exc import DataError
 
-from app import db, limit_payload_length
-from app.Models import User, Article, Channel, Comment
+from app import db, admission, limit_payload_length, response_cache, trending, write_behind
+from app.Counters import adjust_article_comments
+from app.Identity import current_identity
+from app.Json import jsonify
+from app.Loading import ARTICLE_AUTHOR_JOINED, ARTICLE_WITH_CONTENT, bakery, with_profile
+from app.Loading import ARTICLE_RECORD, CHANNEL_RECORD, COMMENT_RECORD
+from app.Models import User, Article, ArticleVisibility, Channel, Comment
+from app.Pagination import keyset_page, keyset_query, page_args, page_headers
+from app.Routing import read_only
+from app.Serializers import helper_article_list, helper_comment_list, stream_article_list
+from app.Streaming import stream_json, stream_requested
+from app.Trending import COMMENT
 from app.routes.Admin import one_channel_query
 
 content_control = Blueprint('content_control', __name__)
 
 
-def helper_article_list(iterator):
-    article_list = []
-    for article in iterator:
-        article_dict = {
-            'aid': article.aid,
-            'title': article.title,
-            'author': article.author.username,
-            'publish_time': article.article_created,
-            'content': article.content,
-            'likes': len(article.liked_by)
-        }
-        article_list.append(article_dict)
-
-    return article_list
-
-
 #
 # Return a single article which isn't disabled or its channel disabled.
 #
-def one_article_query(aid):
-    article = Article.query.join(Channel).join(User, User.uid == Article.article_author_uid)\
-                           .filter(Article.aid == aid) \
-                           .filter(Channel.status.op('&')(4) == 0) \
-                           .filter(User.is_active) \
-                           .filter(Article.article_status.op('&')(4) == 0) \
-                           .filter(Article.article_status.op('&')(8) == 0).first()
+def one_article_query(aid, profile=ARTICLE_AUTHOR_JOINED):
+    query = bakery(lambda session: session.query(Article).join(Channel)
+                                          .join(User, User.uid == Article.article_author_uid)
+                                          .filter(Article.aid == bindparam('aid'))
+                                          .filter(Channel.visible == true())
+                                          .filter(User.is_active)
+                                          .filter(Article.visibility == ArticleVisibility.Visible.value))
+    article = with_profile(query, profile)(db.session()).params(aid=aid).first()
 
     return article
 
 
 @content_control.route('/article/<int:aid>')
+@response_cache.cached('article:{aid}')
+@read_only
 def get_article(aid):
-    article = one_article_query(aid)
+    article = one_article_query(aid, ARTICLE_WITH_CONTENT)
     if not article:
         return jsonify(msg='what article?'), 404
 
@@ -51,7 +49,8 @@ def get_article(aid):
         'author': article.author.username,
         'publish_time': article.article_created,
         'content': article.content,
-        'likes': len(article.liked_by)
+        'likes': article.like_count,
+        'comments': article.comment_count
     }
 
     return jsonify(article_dict), 200
@@ -60,32 +59,35 @@ def get_article(aid):
 #
 # Removed comments are being deleted from the database in current implementation.
 # However, comments made by a later disabled user are not deleted, so these are filtered out.
+# Comments are paged oldest first, the next page cursor is sent in X-Next-Cursor.
 #
 @content_control.route('/article/comments/<int:aid>')
+@response_cache.cached('comments:{aid}')
+@read_only
 def get_comments(aid):
+    cursor, limit = page_args()
+
     article = one_article_query(aid)
     if not article:
         return jsonify(msg='what article?'), 404
 
-    comments = Comment.query.join(User).filter(Comment.comment_article_aid == aid)\
-                                       .filter(User.is_active)
-
-    comment_list = []
-    for comment in comments:
-        comment_dict = {
-            'coid': comment.coid,
-            'author': comment.sent_by.username,
-            'content': comment.body,
-            'time': comment.comment_created
-        }
+    comments = db.session.query(*COMMENT_RECORD).join(User, User.uid == Comment.comment_user_uid)\
+                                               .filter(Comment.comment_article_aid == aid)\
+                                               .filter(User.is_active)
+    comments, next_cursor = keyset_page(comments, Comment.comment_created, Comment.coid, cursor, limit,
+                                        descending=False)
 
-        comment_list.append(comment_dict)
+    comment_list = helper_comment_list(comments)
 
-    return jsonify(comment_list), 200
+    return jsonify(comment_list), 200, page_headers(next_cursor)
 
 
+#
+# In write-behind mode the comment is acknowledged with 202 and applied by the flusher.
+#
 @content_control.route('/article/comment/<int:aid>', methods=['POST'])
 @jwt_required
+@admission.rate_limit('write')
 @limit_payload_length(Comment.BODY_MAX_LENGTH + 100)
 def post_comment(aid):
     if not request.is_json:
@@ -95,28 +97,49 @@ def post_comment(aid):
     if not comment:
         return jsonify(msg='empty comment'), 400
 
-    username = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify(msg='who are you?'), 400
 
     article_obj = one_article_query(aid)
     if not article_obj:
         return jsonify(msg='what article?'), 404
 
-    comment_obj = Comment(body=comment, comment_article_aid=article_obj.aid)
-    user_obj.sent_comments.append(comment_obj)
+    if write_behind.enabled:
+        # the database can't reject it later, so check the length up front
+        comment = str(comment)
+        if len(comment) > Comment.BODY_MAX_LENGTH:
+            return jsonify(msg='comment too long', max=Comment.BODY_MAX_LENGTH), 413
+        write_behind.comment(identity.uid, article_obj.aid, comment)
+        trending.record(COMMENT, [article_obj.aid])
+        return jsonify(msg='comment accepted'), 202
+
+    comment_obj = Comment(body=comment, comment_article_aid=article_obj.aid, comment_user_uid=identity.uid)
+    db.session.add(comment_obj)
 
     try:
+        adjust_article_comments(article_obj.aid, 1)
         db.session.commit()
+        response_cache.invalidate('comments:{}'.format(aid), 'article:{}'.format(aid),
+                                  'channel:{}'.format(article_obj.article_channel_cid))
+        trending.record(COMMENT, [article_obj.aid])
         return jsonify(msg='comment posted'), 201
     except DataError:
         db.session.rollback()
         return jsonify(msg='comment too long', max=Comment.BODY_MAX_LENGTH), 413
 
 
+#
+# Articles are paged newest first, the next page cursor is sent in X-Next-Cursor.
+# With ?stream=1 every article from the cursor on is streamed instead of a single page.
+#
 @content_control.route('/channel/<int:cid>')
+@response_cache.cached('channel:{cid}')
+@admission.concurrency('listing')
+@read_only
 def get_channel(cid):
+    cursor, limit = page_args()
+
     channel = one_channel_query(cid)
     if not channel:
         return jsonify(msg='what channel?'), 404
@@ -125,32 +148,37 @@ def get_channel(cid):
         'cid': channel.cid,
         'name': channel.name,
         'summary': channel.description,
-        'subscribers': len(channel.subscribers),
-        'articles': []
+        'subscribers': channel.subscriber_count
     }
 
-    articles = Article.query.join(Channel).join(User, User.uid == Article.article_author_uid) \
-                            .filter(Channel.cid == cid) \
-                            .filter(User.is_active) \
-                            .filter(Article.article_status.op('&')(4) == 0) \
-                            .filter(Article.article_status.op('&')(8) == 0).order_by(Article.article_created.desc())
+    articles = db.session.query(*ARTICLE_RECORD).join(User, User.uid == Article.article_author_uid) \
+                                                .filter(Article.article_channel_cid == cid) \
+                                                .filter(Article.visibility == ArticleVisibility.Visible.value) \
+                                                .filter(User.is_active)
+    if stream_requested():
+        articles = keyset_query(articles, Article.article_created, Article.aid, cursor)
+        return stream_json(stream_article_list(articles), channel_dict, 'articles')
+
+    articles, next_cursor = keyset_page(articles, Article.article_created, Article.aid, cursor, limit)
 
     articles_list = helper_article_list(articles)
 
     channel_dict['articles'] = articles_list
 
-    return jsonify(channel_dict), 200
+    return jsonify(channel_dict), 200, page_headers(next_cursor)
 
 
 @content_control.route('/channels')
+@response_cache.cached('channels')
+@read_only
 def get_channels():
     channel_list = []
-    for channel in Channel.query.filter(Channel.status.op('&')(4) == 0):
+    for channel in db.session.query(*CHANNEL_RECORD).filter(Channel.visible == true()):
         channel_dict = {
             'cid': channel.cid,
             'name': channel.name,
             'summary': channel.description,
-            'subscribers': len(channel.subscribers)
+            'subscribers': channel.subscriber_count
         }
 
         channel_list.append(channel_dict)
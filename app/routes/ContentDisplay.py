@@ -1,13 +1,25 @@
-from flask import Blueprint, jsonify
-from flask_jwt_extended import get_jwt_identity, jwt_required
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required
 
+from sqlalchemy import true
 from sqlalchemy.exc import IntegrityError
 
-from app import db
-from app.Models import User, Article, Channel
-from app.Models import favorite_table
-from app.routes.ContentControl import helper_article_list, one_article_query
-from app.routes.Admin import one_channel_query
+from app import db, admission, limit_payload_length, response_cache, trending, write_behind
+from app.Counters import adjust_article_likes, adjust_channel_subscribers
+from app.Counters import adjust_articles_likes, adjust_channels_subscribers
+from app.Counters import recount_articles_likes, recount_channels_subscribers
+from app.Identity import current_identity
+from app.Json import jsonify
+from app.Loading import ARTICLE_RECORD
+from app.Models import User, Article, ArticleVisibility, Channel
+from app.Models import favorite_table, subscription_table, insert_ignore
+from app.Pagination import keyset_page, page_args, page_headers
+from app.Routing import read_only
+from app.Serializers import helper_article_list
+from app.Timeline import backfill_subscription, prune_subscription, prune_subscriptions, timeline_page
+from app.Trending import LIKE
+from app.routes.ContentControl import one_article_query
+from app.routes.Admin import one_channel_query, helper_bulk_ids
 
 content_display = Blueprint('content_display', __name__)
 channel_management = Blueprint('channel_management', __name__)
@@ -19,10 +31,10 @@ favorite_management = Blueprint('favorite_management', __name__)
 #
 @channel_management.route('/subscribe/<int:cid>')
 @jwt_required
+@admission.rate_limit('write')
 def subscribe_to(cid):
-    username = get_jwt_identity()
-    user_obj = db.session.query(User).filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify({'msg': 'who are you?'}), 401
 
     channel_obj = one_channel_query(cid)
@@ -30,8 +42,12 @@ def subscribe_to(cid):
         return jsonify({'msg': 'what channel?'}), 404
 
     try:
-        user_obj.subscriptions.append(channel_obj)
+        db.session.execute(subscription_table.insert().values(sub_user_uid=identity.uid,
+                                                              sub_channel_cid=channel_obj.cid))
+        adjust_channel_subscribers(channel_obj.cid, 1)
+        backfill_subscription(identity.uid, channel_obj.cid)
         db.session.commit()
+        response_cache.invalidate('channels', 'channel:{}'.format(cid))
         return jsonify({'msg': 'successfully subscribed'}), 201
     except IntegrityError:
         db.session.rollback()
@@ -40,22 +56,34 @@ def subscribe_to(cid):
 
 #
 # User can only like active articles (not disabled, not requested, not channel disabled)
+# In write-behind mode the like is acknowledged with 202 and applied by the flusher.
 #
 @favorite_management.route('/like/<int:aid>')
 @jwt_required
+@admission.rate_limit('write')
 def like(aid):
-    username = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify({'msg': 'who are you?'}), 401
 
     article_obj = one_article_query(aid)
     if not article_obj:
         return jsonify({'msg': 'what article?'}), 404
 
+    if write_behind.enabled:
+        if not write_behind.like(identity.uid, article_obj.aid,
+                                 lambda: bool(liked_among(identity.uid, [article_obj.aid]))):
+            return jsonify({'msg': 'already liked'}), 200
+        trending.record(LIKE, [article_obj.aid])
+        return jsonify({'msg': 'like accepted'}), 202
+
     try:
-        user_obj.favorites.append(article_obj)
+        db.session.execute(favorite_table.insert().values(fav_user_uid=identity.uid,
+                                                          fav_article_aid=article_obj.aid))
+        adjust_article_likes(article_obj.aid, 1)
         db.session.commit()
+        response_cache.invalidate('article:{}'.format(aid), 'channel:{}'.format(article_obj.article_channel_cid))
+        trending.record(LIKE, [article_obj.aid])
         return jsonify({'msg': 'liked article'}), 201
     except IntegrityError:
         db.session.rollback()
@@ -67,92 +95,374 @@ def like(aid):
 #
 @channel_management.route('/unsubscribe/<int:cid>')
 @jwt_required
+@admission.rate_limit('write')
 def unsubscribe_from(cid):
-    username = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify({'msg': 'who are you?'}), 401
 
     channel_obj = Channel.query.get(cid)
     if not channel_obj:
         return jsonify({'msg': 'what channel?'}), 404
 
-    try:
-        user_obj.subscriptions.remove(channel_obj)
-        db.session.commit()
-        return jsonify({'msg': 'successfully unsubscribed'}), 200
-    except ValueError:
+    removed = db.session.execute(subscription_table.delete()
+                                 .where(subscription_table.c.sub_user_uid == identity.uid)
+                                 .where(subscription_table.c.sub_channel_cid == channel_obj.cid)).rowcount
+    if not removed:
+        db.session.rollback()
         return jsonify({'msg': 'user did not subscribe'}), 200
 
+    adjust_channel_subscribers(channel_obj.cid, -1)
+    prune_subscription(identity.uid, channel_obj.cid)
+    db.session.commit()
+    response_cache.invalidate('channels', 'channel:{}'.format(cid))
+    return jsonify({'msg': 'successfully unsubscribed'}), 200
+
 
 #
 # User may unlike any article, including disabled and/or requested articles
+# In write-behind mode the unlike is acknowledged with 202 and applied by the flusher.
 #
 @favorite_management.route('/unlike/<int:aid>')
 @jwt_required
+@admission.rate_limit('write')
 def unlike(aid):
-    username: object = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-    if not user_obj:
+    identity = current_identity()
+    if not identity:
         return jsonify({'msg': 'who are you?'}), 401
 
     article_obj = Article.query.get(aid)
     if not article_obj:
         return jsonify({'msg': 'what article?'}), 404
 
-    try:
-        user_obj.favorites.remove(article_obj)
-        db.session.commit()
-        return jsonify({'msg': 'removed like from article'}), 201
-    except ValueError:
+    if write_behind.enabled:
+        if not write_behind.unlike(identity.uid, article_obj.aid,
+                                   lambda: bool(liked_among(identity.uid, [article_obj.aid]))):
+            return jsonify({'msg': 'article is not liked by user'}), 200
+        trending.record(LIKE, [article_obj.aid], -1)
+        return jsonify({'msg': 'unlike accepted'}), 202
+
+    removed = db.session.execute(favorite_table.delete()
+                                 .where(favorite_table.c.fav_user_uid == identity.uid)
+                                 .where(favorite_table.c.fav_article_aid == article_obj.aid)).rowcount
+    if not removed:
+        db.session.rollback()
         return jsonify({'msg': 'article is not liked by user'}), 200
 
+    adjust_article_likes(article_obj.aid, -1)
+    db.session.commit()
+    response_cache.invalidate('article:{}'.format(aid), 'channel:{}'.format(article_obj.article_channel_cid))
+    trending.record(LIKE, [article_obj.aid], -1)
+    return jsonify({'msg': 'removed like from article'}), 201
+
 
+#
+# Served from the precomputed timeline, see app/Timeline.py
+#
 @content_display.route('/subscriptions')
 @jwt_required
-def get_newest_articles_from_subscribed_channel(limit=20):
+@read_only
+def get_newest_articles_from_subscribed_channel():
+    cursor, limit = page_args()
     if limit < 1:
         return jsonify([]), 200
 
-    username = get_jwt_identity()
-    user_obj = User.query.filter_by(username=username).first()
-
-    channel_list = list(map(lambda channel: channel.cid, user_obj.subscriptions))
+    identity = current_identity()
+    if not identity:
+        return jsonify({'msg': 'who are you?'}), 401
 
-    it = Article.query.join(User, User.uid == Article.article_author_uid)\
-        .join(Channel, Channel.cid == Article.article_channel_cid) \
-        .filter(User.is_active) \
-        .filter(Channel.cid.in_(channel_list)) \
-        .filter(Channel.status.op('&')(4) == 0) \
-        .filter(Article.article_status.op('&')(4) == 0) \
-        .filter(Article.article_status.op('&')(8) == 0) \
-        .order_by(Article.article_created.desc()).limit(limit)
+    it, next_cursor = timeline_page(identity.uid, cursor, limit)
 
     article_list = helper_article_list(it)
 
-    return jsonify(article_list), 200
+    return jsonify(article_list), 200, page_headers(next_cursor)
 
 
 @content_display.route('/favorites')
 @content_display.route('/favorites/<int:limit>')
 @jwt_required
-def get_favorites_list(limit=20, page_offset=0):
+@read_only
+def get_favorites_list(limit=None):
+    cursor, limit = page_args(limit)
     if limit < 1:
         return jsonify([]), 200
 
-    username = get_jwt_identity()
-    user_obj: User = User.query.filter_by(username=username).first()
+    identity = current_identity()
+    if not identity:
+        return jsonify({'msg': 'who are you?'}), 401
 
-    it = Article.query.join(favorite_table)\
+    it = db.session.query(*ARTICLE_RECORD)\
+        .join(favorite_table, favorite_table.c.fav_article_aid == Article.aid)\
         .join(Channel, Channel.cid == Article.article_channel_cid)\
         .join(User, User.uid == Article.article_author_uid)\
-        .filter(favorite_table.c.fav_user_uid == user_obj.uid) \
-        .filter(Channel.status.op('&')(4) == 0) \
-        .filter(User.is_active) \
-        .filter(Article.article_status.op('&')(4) == 0) \
-        .filter(Article.article_status.op('&')(8) == 0) \
-        .order_by(Article.article_created.desc()).limit(limit)
+        .filter(favorite_table.c.fav_user_uid == identity.uid) \
+        .filter(Article.visibility == ArticleVisibility.Visible.value) \
+        .filter(Channel.visible == true()) \
+        .filter(User.is_active)
+    it, next_cursor = keyset_page(it, Article.article_created, Article.aid, cursor, limit)
 
     article_list = helper_article_list(it)
 
-    return jsonify(article_list), 200
+    return jsonify(article_list), 200, page_headers(next_cursor)
+
+
+#
+# Hottest visible articles across all channels, see app/Trending.py. The ranking is kept in
+# memory, the request only looks its articles up by primary key.
+#
+@content_display.route('/trending')
+@read_only
+def get_trending():
+    _, limit = page_args()
+    ranking = trending.ranking()
+    limit = max(limit, 0)
+
+    # articles hidden since the last reload are skipped, look further down the ranking for them
+    trending_list, start = [], 0
+    while len(trending_list) < limit and start < len(ranking):
+        chunk = ranking[start:start + 2 * (limit - len(trending_list))]
+        start += len(chunk)
+        articles = db.session.query(*ARTICLE_RECORD)\
+                             .join(Channel, Channel.cid == Article.article_channel_cid)\
+                             .join(User, User.uid == Article.article_author_uid)\
+                             .filter(Article.aid.in_([aid for aid, _ in chunk]))\
+                             .filter(Article.visibility == ArticleVisibility.Visible.value)\
+                             .filter(Channel.visible == true())\
+                             .filter(User.is_active)
+        article_list = {article['aid']: article for article in helper_article_list(articles)}
+        for aid, score in chunk:
+            if aid in article_list:
+                article_list[aid]['score'] = round(score, 3)
+                trending_list.append(article_list[aid])
+
+    return jsonify(trending_list[:limit]), 200
+
+
+#
+# Batch state and bulk changes, at most BATCH_MAX_ITEMS ids per request.
+#
+BATCH_MAX_ITEMS = 200
+
+
+def helper_query_ids(key):
+    try:
+        ids = [int(i) for i in request.args.get(key, '').split(',') if i.strip()]
+    except ValueError:
+        return None
+    return list(dict.fromkeys(ids))
+
+
+def helper_batch_error(ids, key):
+    if ids is None:
+        return jsonify(msg='expected a list of ids in {}'.format(key)), 400
+    if len(ids) > BATCH_MAX_ITEMS:
+        return jsonify(msg='too many ids', max=BATCH_MAX_ITEMS), 413
+    return None
+
+
+def visible_article_channels(aids):
+    rows = db.session.query(Article.aid, Article.article_channel_cid)\
+                     .join(Channel, Channel.cid == Article.article_channel_cid)\
+                     .join(User, User.uid == Article.article_author_uid)\
+                     .filter(Article.aid.in_(aids))\
+                     .filter(Article.visibility == ArticleVisibility.Visible.value)\
+                     .filter(Channel.visible == true())\
+                     .filter(User.is_active)
+    return {row.aid: row.article_channel_cid for row in rows}
+
+
+def liked_among(uid, aids, for_update=False):
+    if not aids:
+        return set()
+    query = db.session.query(favorite_table.c.fav_article_aid)\
+                      .filter(favorite_table.c.fav_user_uid == uid).filter(favorite_table.c.fav_article_aid.in_(aids))
+    return {row.fav_article_aid for row in (query.with_for_update() if for_update else query)}
+
+
+def subscribed_among(uid, cids, for_update=False):
+    if not cids:
+        return set()
+    query = db.session.query(subscription_table.c.sub_channel_cid)\
+                      .filter(subscription_table.c.sub_user_uid == uid)\
+                      .filter(subscription_table.c.sub_channel_cid.in_(cids))
+    return {row.sub_channel_cid for row in (query.with_for_update() if for_update else query)}
+
+
+#
+# ?aids=1,2,3 -> {"1": true, "2": false, ...}, one primary key range read.
+#
+@favorite_management.route('/liked')
+@jwt_required
+@read_only
+def get_liked_state():
+    aids = helper_query_ids('aids')
+    error = helper_batch_error(aids, 'aids')
+    if error:
+        return error
+
+    identity = current_identity()
+    if not identity:
+        return jsonify({'msg': 'who are you?'}), 401
+
+    liked = liked_among(identity.uid, aids)
+    return jsonify({str(aid): aid in liked for aid in aids}), 200
+
+
+@channel_management.route('/subscribed')
+@jwt_required
+@read_only
+def get_subscribed_state():
+    cids = helper_query_ids('cids')
+    error = helper_batch_error(cids, 'cids')
+    if error:
+        return error
+
+    identity = current_identity()
+    if not identity:
+        return jsonify({'msg': 'who are you?'}), 401
+
+    subscribed = subscribed_among(identity.uid, cids)
+    return jsonify({str(cid): cid in subscribed for cid in cids}), 200
+
+
+#
+# Bulk changes take {"aids": [...]} / {"cids": [...]} and answer with an outcome per id.
+# New rows go in with INSERT IGNORE, so a row another request added meanwhile is skipped
+# instead of failing the batch.
+#
+def helper_bulk_request(key):
+    if not request.is_json:
+        return None, (jsonify({'msg': 'Not json'}), 400)
+
+    ids = helper_bulk_ids(key)
+    error = helper_batch_error(ids, key)
+    if error:
+        return None, error
+
+    identity = current_identity()
+    if not identity:
+        return None, (jsonify({'msg': 'who are you?'}), 401)
+
+    return (identity, ids), None
+
+
+#
+# Run the batch's single multi-row INSERT IGNORE / DELETE for `ids`, read beforehand under
+# FOR UPDATE, and move their counters by `delta`. InnoDB holds the rows and the gaps of the
+# missing pairs it read that way, so the statement changes exactly `ids`; SQLite ignores FOR
+# UPDATE, and when the rowcount shows a concurrent request got in between, the counters of the
+# batch are recounted from the rows instead.
+#
+def helper_bulk_write(statement, ids, delta, adjust, recount):
+    if db.session.execute(statement).rowcount == len(ids):
+        adjust(ids, delta)
+    else:
+        recount(ids)
+
+
+def helper_outcome_response(results):
+    return jsonify({str(k): v for k, v in results.items()}), 200
+
+
+@favorite_management.route('/like', methods=['POST'])
+@jwt_required
+@admission.rate_limit('write')
+@limit_payload_length(BATCH_MAX_ITEMS * 12 + 100)
+def like_many():
+    parsed, error = helper_bulk_request('aids')
+    if error:
+        return error
+    identity, aids = parsed
+
+    channels = visible_article_channels(aids)
+    liked = liked_among(identity.uid, list(channels), for_update=True)
+    new = [aid for aid in channels if aid not in liked]
+    if new:
+        helper_bulk_write(insert_ignore(favorite_table)
+                          .values([{'fav_user_uid': identity.uid, 'fav_article_aid': aid} for aid in new]),
+                          new, 1, adjust_articles_likes, recount_articles_likes)
+        db.session.commit()
+    if new:
+        response_cache.invalidate(*(['article:{}'.format(aid) for aid in new] +
+                                    ['channel:{}'.format(cid) for cid in {channels[aid] for aid in new}]))
+        trending.record(LIKE, new)
+
+    return helper_outcome_response({aid: 'not found' if aid not in channels else
+                                 'liked' if aid in new else 'already liked' for aid in aids})
+
+
+@favorite_management.route('/unlike', methods=['POST'])
+@jwt_required
+@admission.rate_limit('write')
+@limit_payload_length(BATCH_MAX_ITEMS * 12 + 100)
+def unlike_many():
+    parsed, error = helper_bulk_request('aids')
+    if error:
+        return error
+    identity, aids = parsed
+
+    liked = list(liked_among(identity.uid, aids, for_update=True))
+    if liked:
+        helper_bulk_write(favorite_table.delete().where(favorite_table.c.fav_user_uid == identity.uid)
+                                                 .where(favorite_table.c.fav_article_aid.in_(liked)),
+                          liked, -1, adjust_articles_likes, recount_articles_likes)
+        cids = {row.article_channel_cid for row in
+                db.session.query(Article.article_channel_cid).filter(Article.aid.in_(liked)).distinct()}
+        db.session.commit()
+    if liked:
+        response_cache.invalidate(*(['article:{}'.format(aid) for aid in liked] +
+                                    ['channel:{}'.format(cid) for cid in cids]))
+        trending.record(LIKE, liked, -1)
+
+    return helper_outcome_response({aid: 'unliked' if aid in liked else 'not liked' for aid in aids})
+
+
+@channel_management.route('/subscribe', methods=['POST'])
+@jwt_required
+@admission.rate_limit('write')
+@limit_payload_length(BATCH_MAX_ITEMS * 12 + 100)
+def subscribe_many():
+    parsed, error = helper_bulk_request('cids')
+    if error:
+        return error
+    identity, cids = parsed
+
+    visible = {row.cid for row in db.session.query(Channel.cid).filter(Channel.cid.in_(cids))
+                                                               .filter(Channel.visible == true())}
+    subscribed = subscribed_among(identity.uid, list(visible), for_update=True)
+    new = [cid for cid in cids if cid in visible and cid not in subscribed]
+    if new:
+        helper_bulk_write(insert_ignore(subscription_table)
+                          .values([{'sub_user_uid': identity.uid, 'sub_channel_cid': cid} for cid in new]),
+                          new, 1, adjust_channels_subscribers, recount_channels_subscribers)
+        for cid in new:
+            backfill_subscription(identity.uid, cid)
+        db.session.commit()
+    if new:
+        response_cache.invalidate('channels', *['channel:{}'.format(cid) for cid in new])
+
+    return helper_outcome_response({cid: 'not found' if cid not in visible else
+                                 'subscribed' if cid in new else 'already subscribed' for cid in cids})
+
+
+@channel_management.route('/unsubscribe', methods=['POST'])
+@jwt_required
+@admission.rate_limit('write')
+@limit_payload_length(BATCH_MAX_ITEMS * 12 + 100)
+def unsubscribe_many():
+    parsed, error = helper_bulk_request('cids')
+    if error:
+        return error
+    identity, cids = parsed
+
+    subscribed = list(subscribed_among(identity.uid, cids, for_update=True))
+    if subscribed:
+        helper_bulk_write(subscription_table.delete().where(subscription_table.c.sub_user_uid == identity.uid)
+                                                     .where(subscription_table.c.sub_channel_cid.in_(subscribed)),
+                          subscribed, -1, adjust_channels_subscribers, recount_channels_subscribers)
+        prune_subscriptions(identity.uid, subscribed)
+        db.session.commit()
+    if subscribed:
+        response_cache.invalidate('channels', *['channel:{}'.format(cid) for cid in subscribed])
+
+    return helper_outcome_response({cid: 'unsubscribed' if cid in subscribed else 'not subscribed' for cid in cids})
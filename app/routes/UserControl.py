@@ -1,13 +1,18 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, create_access_token, get_raw_jwt
 
-from app import db, blacklist
+from app import db, admission, blacklist
+from app.Identity import identity_claims
+from app.Json import jsonify
+from app.Loading import load_user
 from app.Models import User
 
 user_control = Blueprint('user_control', __name__)
 
 
 @user_control.route('/register', methods=['POST'])
+@admission.rate_limit('login')
+@admission.concurrency('login')
 def register():
     if not request.is_json:
         return jsonify({'msg': 'Not json'}), 400
@@ -18,18 +23,20 @@ def register():
     if username is None or password is None:
         return jsonify({'msg': 'Missing required fields'}), 400
 
-    if User.query.filter_by(username=username).first() is not None:
+    if load_user(username) is not None:
         return jsonify({'msg': 'Username already registered'}), 400
     else:
         user = User(username=username)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
-        token = create_access_token(user.username)
+        token = create_access_token(user.username, user_claims=identity_claims(user))
         return jsonify({'user': user.username, 'msg': 'User creation successful', 'token': token}), 201
 
 
 @user_control.route('/login', methods=['POST'])
+@admission.rate_limit('login')
+@admission.concurrency('login')
 def login():
     if not request.is_json:
         return jsonify({'msg': 'Not json'}), 400
@@ -40,13 +47,13 @@ def login():
     if username is None or password is None:
         return jsonify({'msg': 'Missing required fields'}), 400
 
-    user = User.query.filter_by(username=username).first()
+    user = load_user(username)
     if user and not user.is_active:
         return jsonify(msg='Your account has been disabled'), 401
     elif user is None or not user.check_password(password):
         return jsonify({'msg': 'Bad credentials'}), 401
     else:
-        token = create_access_token(user.username)
+        token = create_access_token(user.username, user_claims=identity_claims(user))
         return jsonify({'username': user.username, 'msg': 'Login successful',
                         'access-token': token, 'is_admin': int(user.is_admin())}), 200
 
@@ -54,6 +61,6 @@ def login():
 @user_control.route('/logout')
 @jwt_required
 def logout():
-    jti = get_raw_jwt()['jti']
-    blacklist.add(jti)
+    raw_jwt = get_raw_jwt()
+    blacklist.revoke(raw_jwt['jti'], raw_jwt.get('exp'))
     return jsonify({'message': 'logged out'}), 200
@@ -0,0 +1,219 @@
+import bisect
+import random
+import string
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import bindparam, func
+
+from app import db, argon2
+from app.Models import User, Channel, Article, ArticleStatus, ArticleVisibility, Comment, UserRole
+from app.Models import favorite_table, subscription_table, timeline_table
+from app.Timeline import fanout_limit
+
+BENCH_PASSWORD = 'bench'
+ADMIN_NAME = 'bench-admin'
+USER_PREFIX = 'bench-user-'
+CHANNEL_PREFIX = 'bench-'
+
+
+def zipf_weights(n, exponent):
+    return [1.0 / (rank + 1) ** exponent for rank in range(n)]
+
+
+#
+# Draws indexes 0..n-1 proportionally to `weights`, callers map them onto ids.
+#
+class WeightedSampler(object):
+    def __init__(self, weights, rng):
+        self.rng = rng
+        self.cum_weights = list(accumulate(weights))
+
+    def sample(self):
+        return bisect.bisect_left(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+
+    def choice(self, items):
+        return items[self.sample()]
+
+
+def _next_id(column):
+    return (db.session.query(func.max(column)).scalar() or 0) + 1
+
+
+def _insert(table, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+        db.session.commit()
+
+
+def _update(statement, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(statement, rows[start:start + batch_size])
+        db.session.commit()
+
+
+_words_rng = random.Random(0)
+WORDS = [''.join(_words_rng.choice(string.ascii_lowercase) for _ in range(_words_rng.randint(2, 9)))
+         for _ in range(4096)]
+
+
+def _text(rng, length):
+    words, size = [], 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def _unique_pairs(count, left, right, limit):
+    pairs = set()
+    attempts = 0
+    # skewed draws collide often near the head, stop once the space is effectively exhausted
+    while len(pairs) < min(count, limit) and attempts < count * 20:
+        pairs.add((left(), right()))
+        attempts += 1
+    return pairs
+
+
+#
+# Fill the database with a synthetic dataset, rows go straight through the model tables in
+# batches so millions of articles stay practical. Channel popularity (articles, subscriptions)
+# and article popularity (likes, comments) follow Zipf distributions, the first `hot_channels`
+# channels are `hot_factor` times hotter still. Every user shares BENCH_PASSWORD.
+# Must run inside an app context. Returns the number of rows written per table.
+#
+def generate(users=10000, channels=200, articles=100000, subscriptions=200000, likes=500000,
+             comments=200000, hot_channels=5, hot_factor=4.0, channel_skew=1.1, article_skew=1.05,
+             requested_ratio=0.02, disabled_ratio=0.01, days=365, content_length=600,
+             seed=1234, batch_size=5000, log=print):
+    rng = random.Random(seed)
+    db.create_all()
+    started = time.time()
+
+    def step(msg):
+        log('[{:7.1f}s] {}'.format(time.time() - started, msg))
+
+    # one hash for everybody, argon2 is deliberately too slow to run per generated user
+    password_hash = argon2.hash(BENCH_PASSWORD)
+
+    first_uid = _next_id(User.uid)
+    user_rows = [{'uid': first_uid, 'username': ADMIN_NAME, 'password_hash': password_hash,
+                  'role': UserRole.Admin.value | UserRole.Editor.value | UserRole.Reader.value, 'is_active': True}]
+    user_rows.extend({'uid': first_uid + i, 'username': '{}{}'.format(USER_PREFIX, i),
+                      'password_hash': password_hash, 'role': UserRole.Reader.value, 'is_active': True}
+                     for i in range(1, users + 1))
+    _insert(User.__table__, user_rows, batch_size)
+    uids = [row['uid'] for row in user_rows]
+    step('{} users'.format(len(user_rows)))
+
+    first_cid = _next_id(Channel.cid)
+    cids = list(range(first_cid, first_cid + channels))
+    channel_rows = [{'cid': cid, 'name': '{}{}'.format(CHANNEL_PREFIX, cid), 'description': _text(rng, 80),
+                     'status': 1, 'visible': True, 'channel_admin_uid': first_uid} for cid in cids]
+    _insert(Channel.__table__, channel_rows, batch_size)
+    step('{} channels'.format(len(channel_rows)))
+
+    # zipf over cid order, with the first hot_channels channels boosted further
+    weights = zipf_weights(channels, channel_skew)
+    for i in range(min(hot_channels, channels)):
+        weights[i] *= hot_factor
+    channel_sampler = WeightedSampler(weights, rng)
+
+    first_aid = _next_id(Article.aid)
+    now = datetime.utcnow().replace(microsecond=0)
+    step_seconds = days * 86400.0 / max(articles, 1)
+    aids, visible_articles = [], []
+    for start in range(0, articles, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, articles)):
+            roll = rng.random()
+            if roll < disabled_ratio:
+                status = ArticleStatus.Public.value | ArticleStatus.Disabled.value
+            elif roll < disabled_ratio + requested_ratio:
+                status = ArticleStatus.Public.value | ArticleStatus.Requested.value
+            else:
+                status = ArticleStatus.Public.value
+            content = _text(rng, rng.randint(content_length // 2, content_length * 3 // 2))
+            rows.append({'aid': first_aid + i, 'title': _text(rng, 40),
+                         'content': content, 'excerpt': Article.excerpt_of(content),
+                         'article_created': now - timedelta(seconds=(articles - i) * step_seconds),
+                         'article_status': status, 'visibility': Article.visibility_of(status),
+                         'article_author_uid': rng.choice(uids),
+                         'article_channel_cid': cids[channel_sampler.sample()]})
+        db.session.execute(Article.__table__.insert(), rows)
+        db.session.commit()
+        aids.extend(row['aid'] for row in rows)
+        visible_articles.extend({key: row[key] for key in ('aid', 'article_channel_cid', 'article_created')}
+                                for row in rows if row['visibility'] == ArticleVisibility.Visible.value)
+    step('{} articles'.format(len(aids)))
+
+    # article popularity is independent of age
+    popular_aids = aids[:]
+    rng.shuffle(popular_aids)
+    article_sampler = WeightedSampler(zipf_weights(len(popular_aids), article_skew), rng)
+
+    subscription_pairs = _unique_pairs(subscriptions, lambda: rng.choice(uids),
+                                       lambda: cids[channel_sampler.sample()], len(uids) * len(cids))
+    _insert(subscription_table, [{'sub_user_uid': uid, 'sub_channel_cid': cid} for uid, cid in subscription_pairs],
+            batch_size)
+    step('{} subscriptions'.format(len(subscription_pairs)))
+
+    like_pairs = _unique_pairs(likes, lambda: rng.choice(uids), lambda: article_sampler.choice(popular_aids),
+                               len(uids) * len(aids))
+    _insert(favorite_table, [{'fav_user_uid': uid, 'fav_article_aid': aid} for uid, aid in like_pairs], batch_size)
+    step('{} likes'.format(len(like_pairs)))
+
+    comment_rows = [{'body': _text(rng, rng.randint(10, Comment.BODY_MAX_LENGTH)),
+                     'comment_user_uid': rng.choice(uids),
+                     'comment_article_aid': article_sampler.choice(popular_aids)} for _ in range(comments)]
+    _insert(Comment.__table__, comment_rows, batch_size)
+    step('{} comments'.format(len(comment_rows)))
+
+    # the generator knows every row, so counters and timelines are derived here instead of
+    # with the correlated reconcile/fan-out queries, which are slow on tables this size
+    like_counts = Counter(aid for _, aid in like_pairs)
+    comment_counts = Counter(row['comment_article_aid'] for row in comment_rows)
+    subscribers = defaultdict(list)
+    for uid, cid in subscription_pairs:
+        subscribers[cid].append(uid)
+
+    article_table = Article.__table__
+    _update(article_table.update().where(article_table.c.aid == bindparam('b_aid'))
+                                  .values(like_count=bindparam('b_likes'), comment_count=bindparam('b_comments')),
+            [{'b_aid': aid, 'b_likes': like_counts[aid], 'b_comments': comment_counts[aid]}
+             for aid in set(like_counts) | set(comment_counts)], batch_size)
+    channel_table = Channel.__table__
+    _update(channel_table.update().where(channel_table.c.cid == bindparam('b_cid'))
+                                  .values(subscriber_count=bindparam('b_count')),
+            [{'b_cid': cid, 'b_count': len(uids)} for cid, uids in subscribers.items()], batch_size)
+    step('counters set')
+
+    timeline_rows = []
+    timelines = 0
+    for article in visible_articles:
+        fans = subscribers[article['article_channel_cid']]
+        if len(fans) > fanout_limit():
+            continue
+        timeline_rows.extend({'tl_user_uid': uid, 'tl_article_aid': article['aid'],
+                              'tl_channel_cid': article['article_channel_cid'],
+                              'tl_created': article['article_created']} for uid in fans)
+        if len(timeline_rows) >= batch_size:
+            _insert(timeline_table, timeline_rows, batch_size)
+            timelines += len(timeline_rows)
+            timeline_rows = []
+    _insert(timeline_table, timeline_rows, batch_size)
+    timelines += len(timeline_rows)
+    step('{} timeline rows'.format(timelines))
+
+    return {
+        'users': len(user_rows),
+        'channels': len(channel_rows),
+        'articles': len(aids),
+        'subscriptions': len(subscription_pairs),
+        'likes': len(like_pairs),
+        'comments': len(comment_rows),
+        'timelines': timelines
+    }
@@ -0,0 +1,57 @@
+import time
+
+from flask import json as flask_json
+from flask.json import JSONEncoder
+
+from app import db, json_encoding
+from app.Json import BACKENDS, JsonEncoding
+from app.Loading import ARTICLE_RECORD
+from app.Models import Article
+from app.Serializers import helper_article_list
+
+
+def _per_call_ms(fn, payload, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(payload)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+#
+# Median milliseconds to encode `articles` serialized articles (a long /api/channel/<cid> page)
+# with flask.json as jsonify did before, then with every installed JsonEncoding backend and
+# datetime format. Returns the timings and the backend the app picked.
+#
+def time_encoding(app, articles=1000, rounds=50):
+    report, app_backend = {}, json_encoding.backend
+    with app.test_request_context():
+        rows = db.session.query(*ARTICLE_RECORD).order_by(Article.article_created.desc()).limit(articles)
+        payload = {'cid': 1, 'name': 'bench', 'summary': 'bench', 'subscribers': 0,
+                   'articles': helper_article_list(rows)}
+        if not payload['articles']:
+            raise ValueError('generate a dataset first')
+
+        def flask_dumps(obj):
+            return flask_json.dumps(obj, cls=JSONEncoder, separators=(',', ':')).encode('utf-8')
+
+        report['flask'] = {'ms': round(_per_call_ms(flask_dumps, payload, rounds), 3),
+                           'bytes': len(flask_dumps(payload))}
+
+        for backend in BACKENDS:
+            if not JsonEncoding._available(backend):
+                continue
+            for datetime_format in ('http', 'iso'):
+                # a throwaway instance, it also replaces app.json_encoder but the app is not served
+                encoding = JsonEncoding()
+                app.config.update(JSON_BACKEND=backend, JSON_DATETIME_FORMAT=datetime_format)
+                encoding.init_app(app)
+                report['{}/{}'.format(backend, datetime_format)] = {
+                    'ms': round(_per_call_ms(encoding.dumps, payload, rounds), 3),
+                    'bytes': len(encoding.dumps(payload))
+                }
+        db.session.remove()
+
+    return {'articles': len(payload['articles']), 'app_backend': app_backend, 'timings': report}
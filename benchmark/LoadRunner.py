@@ -0,0 +1,389 @@
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+from flask import request
+from sqlalchemy import event
+
+from app import db
+from app.Models import User, Article, ArticleVisibility, Channel, Comment
+from benchmark.DataGenerator import ADMIN_NAME, BENCH_PASSWORD, USER_PREFIX, WeightedSampler, zipf_weights
+
+
+#
+# Per thread request bookkeeping: the flask test client serves a request on the calling thread,
+# so the engine listener and the after_request hook see the same thread local as the client.
+#
+class _RequestProbe(object):
+    def __init__(self, app):
+        self.local = threading.local()
+        event.listen(db.get_engine(app), 'before_cursor_execute', self._count_query)
+        app.after_request(self._record_endpoint)
+
+    def _count_query(self, *args):
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def _record_endpoint(self, response):
+        self.local.endpoint = request.endpoint
+        return response
+
+    def reset(self):
+        self.local.queries, self.local.endpoint = 0, None
+
+    def take(self):
+        return self.local.endpoint, self.local.queries
+
+
+class _Samples(object):
+    def __init__(self):
+        self.latencies, self.queries, self.errors = [], [], 0
+
+
+#
+# Ids the scenarios pick from, popular rows first so the zipf samplers hit hot content.
+#
+class Targets(object):
+    def __init__(self, app, pool_size, skew):
+        with app.app_context():
+            self.aids = [row.aid for row in db.session.query(Article.aid)
+                         .filter(Article.visibility == ArticleVisibility.Visible.value)
+                         .order_by(Article.like_count.desc(), Article.aid).limit(pool_size)]
+            self.cids = [row.cid for row in db.session.query(Channel.cid).filter(Channel.visible.is_(True))
+                         .order_by(Channel.subscriber_count.desc(), Channel.cid).limit(pool_size)]
+            users = db.session.query(User.uid, User.username).filter(User.username.like(USER_PREFIX + '%'))\
+                                                             .filter(User.is_active).limit(pool_size).all()
+            self.users = [row.username for row in users]
+            self.uids = [row.uid for row in users]
+        if not self.aids or not self.cids or not self.users:
+            raise RuntimeError('no benchmark data found, run `python -m benchmark generate` first')
+
+        self.article_weights = zipf_weights(len(self.aids), skew)
+        self.channel_weights = zipf_weights(len(self.cids), skew)
+
+    def samplers(self, rng):
+        return WeightedSampler(self.article_weights, rng), WeightedSampler(self.channel_weights, rng)
+
+
+#
+# One simulated user: a test client, a token and its own random stream.
+# Every call goes through `call`, which times it and files it under the flask endpoint.
+#
+class Client(object):
+    def __init__(self, runner, username, admin_token, seed):
+        self.runner = runner
+        self.http = runner.app.test_client()
+        self.rng = random.Random(seed)
+        self.articles, self.channels = runner.targets.samplers(self.rng)
+        self.admin_token = admin_token
+        self.token = runner.login(self.http, username)
+
+    def call(self, method, url, token=None, **kwargs):
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        probe = self.runner.probe
+        probe.reset()
+        started = time.perf_counter()
+        response = self.http.open(url, method=method, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - started
+        endpoint, queries = probe.take()
+        self.runner.record(endpoint or '{} {}'.format(method, url), elapsed, queries, response.status_code)
+        return response
+
+    def aid(self):
+        return self.articles.choice(self.runner.targets.aids)
+
+    def cid(self):
+        return self.channels.choice(self.runner.targets.cids)
+
+    def read_article(self):
+        aid = self.aid()
+        self.call('GET', '/api/article/{}'.format(aid))
+        self.call('GET', '/api/article/comments/{}'.format(aid))
+
+    def read_channel(self):
+        response = self.call('GET', '/api/channel/{}'.format(self.cid()))
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor and self.rng.random() < 0.3:
+            self.call('GET', '/api/channel/{}?cursor={}'.format(self.cid(), cursor))
+
+    def list_channels(self):
+        self.call('GET', '/api/channels')
+
+    def read_trending(self):
+        self.call('GET', '/api/trending')
+
+    def read_feeds(self):
+        self.call('GET', '/api/subscriptions', self.token)
+        self.call('GET', '/api/favorites', self.token)
+
+    # what a listing page asks about the articles and channels it shows
+    def read_states(self):
+        aids = ','.join(str(aid) for aid in {self.aid() for _ in range(20)})
+        self.call('GET', '/api/liked?aids={}'.format(aids), self.token)
+        cids = ','.join(str(cid) for cid in {self.cid() for _ in range(10)})
+        self.call('GET', '/api/subscribed?cids={}'.format(cids), self.token)
+
+    def read_metrics(self):
+        self.call('GET', '/api/metrics')
+
+    # write cycles leave the dataset as they found it so consecutive runs stay comparable
+    def like_cycle(self):
+        aid = self.aid()
+        already_liked = self.call('GET', '/api/like/{}'.format(aid), self.token).status_code == 200
+        self.call('GET', '/api/unlike/{}'.format(aid), self.token)
+        if already_liked:
+            self.call('GET', '/api/like/{}'.format(aid), self.token)
+
+    def subscribe_cycle(self):
+        cid = self.cid()
+        already_subscribed = self.call('GET', '/api/subscribe/{}'.format(cid), self.token).status_code == 200
+        self.call('GET', '/api/unsubscribe/{}'.format(cid), self.token)
+        if already_subscribed:
+            self.call('GET', '/api/subscribe/{}'.format(cid), self.token)
+
+    def bulk_like_cycle(self):
+        aids = list({self.aid() for _ in range(10)})
+        outcomes = self.call('POST', '/api/like', self.token, json={'aids': aids}).get_json() or {}
+        self.call('POST', '/api/unlike', self.token,
+                  json={'aids': [int(aid) for aid, outcome in outcomes.items() if outcome == 'liked']})
+
+    def bulk_subscribe_cycle(self):
+        cids = list({self.cid() for _ in range(5)})
+        outcomes = self.call('POST', '/api/subscribe', self.token, json={'cids': cids}).get_json() or {}
+        self.call('POST', '/api/unsubscribe', self.token,
+                  json={'cids': [int(cid) for cid, outcome in outcomes.items() if outcome == 'subscribed']})
+
+    def comment_cycle(self):
+        aid = self.aid()
+        self.call('POST', '/api/article/comment/{}'.format(aid), self.token, json={'comment': 'bench comment'})
+        with self.runner.app.app_context():
+            coid = db.session.query(Comment.coid).filter_by(comment_article_aid=aid)\
+                                                 .order_by(Comment.coid.desc()).limit(1).scalar()
+        if coid is not None:
+            self.call('POST', '/api/article/comments/delete/{}/{}'.format(aid, coid), self.admin_token)
+
+    def publish_cycle(self):
+        cid = self.cid()
+        response = self.call('POST', '/api/channel/post/{}'.format(cid), self.token,
+                             json={'title': 'bench article', 'content': 'bench content ' * 40})
+        aid = (response.get_json() or {}).get('aid')
+        self.call('GET', '/api/article/requests/{}'.format(cid), self.admin_token)
+        if aid is None:
+            return
+        if self.rng.random() < 0.5:
+            self.call('POST', '/api/article/reject/{}'.format(aid), self.admin_token)
+        else:
+            self.call('POST', '/api/article/accept/{}'.format(aid), self.admin_token)
+            self.call('POST', '/api/article/delete/{}'.format(aid), self.admin_token)
+
+    # requests a few articles, accepts and rejects them in bulk, then removes them with their comments
+    def bulk_moderation_cycle(self):
+        cid = self.cid()
+        aids = []
+        for _ in range(4):
+            response = self.call('POST', '/api/channel/post/{}'.format(cid), self.token,
+                                 json={'title': 'bench article', 'content': 'bench content ' * 40})
+            aid = (response.get_json() or {}).get('aid')
+            if aid is not None:
+                aids.append(aid)
+        if not aids:
+            return
+        accepted, rejected = aids[:len(aids) // 2 + 1], aids[len(aids) // 2 + 1:]
+        self.call('POST', '/api/article/accept', self.admin_token, json={'aids': accepted})
+        self.call('POST', '/api/article/reject', self.admin_token, json={'aids': rejected})
+        for aid in accepted:
+            self.call('POST', '/api/article/comment/{}'.format(aid), self.token, json={'comment': 'bench comment'})
+        with self.runner.app.app_context():
+            coids = [row.coid for row in
+                     db.session.query(Comment.coid).filter(Comment.comment_article_aid.in_(accepted))]
+        self.call('POST', '/api/article/comments/delete', self.admin_token, json={'coids': coids})
+        self.call('POST', '/api/article/delete', self.admin_token, json={'aids': accepted})
+
+    # a bench user no client is logged in as
+    def user_status_cycle(self):
+        uids = self.runner.targets.uids[self.runner.clients:]
+        if not uids:
+            return
+        uid = self.rng.choice(uids)
+        self.call('POST', '/api/user/disable/{}'.format(uid), self.admin_token)
+        self.call('POST', '/api/user/enable/{}'.format(uid), self.admin_token)
+
+    def channel_cycle(self):
+        response = self.call('POST', '/api/channel/create', self.admin_token,
+                             json={'name': 'run-' + uuid.uuid4().hex[:12], 'description': 'bench'})
+        cid = (response.get_json() or {}).get('cid')
+        if cid is not None:
+            self.call('POST', '/api/channel/delete/{}'.format(cid), self.admin_token)
+
+    def account_cycle(self):
+        username = 'run-' + uuid.uuid4().hex[:16]
+        self.call('POST', '/api/user/register', json={'username': username, 'password': BENCH_PASSWORD})
+        response = self.call('POST', '/api/user/login', json={'username': username, 'password': BENCH_PASSWORD})
+        token = (response.get_json() or {}).get('access-token')
+        if token:
+            self.call('GET', '/api/user/logout', token)
+
+
+# scenario -> relative weight, reads dominate like on the real site
+DEFAULT_MIX = {
+    'read_article': 40,
+    'read_channel': 20,
+    'list_channels': 10,
+    'read_feeds': 15,
+    'read_trending': 5,
+    'read_states': 4,
+    'read_metrics': 0.5,
+    'like_cycle': 6,
+    'bulk_like_cycle': 2,
+    'subscribe_cycle': 3,
+    'bulk_subscribe_cycle': 1,
+    'comment_cycle': 3,
+    'publish_cycle': 2,
+    'bulk_moderation_cycle': 0.5,
+    'channel_cycle': 0.5,
+    'user_status_cycle': 0.2,
+    'account_cycle': 0.5
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(int(math.ceil(fraction * len(sorted_values))) - 1, 0))]
+
+
+#
+# Runs `clients` threads against an app from app.create_app for `duration` seconds or until
+# every client issued `iterations` scenarios, whichever comes first.
+#
+class LoadRunner(object):
+    def __init__(self, app, clients=8, duration=30, iterations=None, mix=None, pool_size=10000,
+                 skew=1.05, seed=1234):
+        self.app = app
+        self.clients, self.duration, self.iterations = clients, duration, iterations
+        self.mix = dict(mix or DEFAULT_MIX)
+        self.seed = seed
+        self.targets = Targets(app, pool_size, skew)
+        self.probe = _RequestProbe(app)
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def login(self, http, username):
+        response = http.post('/api/user/login', json={'username': username, 'password': BENCH_PASSWORD})
+        if response.status_code != 200:
+            raise RuntimeError('cannot log in as {}: {}'.format(username, response.get_data(as_text=True)))
+        return response.get_json()['access-token']
+
+    def record(self, endpoint, elapsed, queries, status):
+        with self._lock:
+            samples = self._samples.setdefault(endpoint, _Samples())
+            samples.latencies.append(elapsed)
+            samples.queries.append(queries)
+            if status >= 500:
+                samples.errors += 1
+
+    def _worker(self, client, deadline, failures):
+        scenarios, weights = zip(*sorted(self.mix.items()))
+        done = 0
+        try:
+            while time.time() < deadline and (self.iterations is None or done < self.iterations):
+                getattr(client, client.rng.choices(scenarios, weights)[0])()
+                done += 1
+        except Exception as e:
+            failures.append(repr(e))
+
+    def run(self):
+        http = self.app.test_client()
+        admin_token = self.login(http, ADMIN_NAME)
+        users = self.targets.users
+        clients = [Client(self, users[i % len(users)], admin_token, self.seed + i) for i in range(self.clients)]
+
+        failures = []
+        started = time.time()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self._worker, args=(client, deadline, failures)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        return self.report(elapsed, failures)
+
+    def report(self, elapsed, failures):
+        endpoints = {}
+        total = errors = 0
+        for endpoint, samples in sorted(self._samples.items()):
+            latencies = sorted(samples.latencies)
+            total += len(latencies)
+            errors += samples.errors
+            endpoints[endpoint] = {
+                'count': len(latencies),
+                'errors': samples.errors,
+                'throughput': len(latencies) / elapsed,
+                'latency_ms': {
+                    'mean': 1000 * sum(latencies) / len(latencies),
+                    'p50': 1000 * percentile(latencies, 0.50),
+                    'p95': 1000 * percentile(latencies, 0.95),
+                    'p99': 1000 * percentile(latencies, 0.99),
+                    'max': 1000 * latencies[-1]
+                },
+                'queries': {
+                    'mean': sum(samples.queries) / len(samples.queries),
+                    'max': max(samples.queries)
+                }
+            }
+
+        return {
+            'meta': {
+                'database': db.get_engine(self.app).dialect.name,
+                'clients': self.clients,
+                'duration': elapsed,
+                'seed': self.seed,
+                'mix': self.mix
+            },
+            'totals': {'requests': total, 'errors': errors, 'throughput': total / elapsed},
+            'failures': failures,
+            'endpoints': endpoints
+        }
+
+
+#
+# Endpoints present in the baseline regress when p95 latency grows by more than `threshold`
+# (ignoring differences under `min_delta_ms` and endpoints with under `min_samples` requests,
+# which are noise) or when they can issue more queries per request.
+# Returns human readable regressions, empty when the run passes.
+#
+def compare(report, baseline, threshold=0.25, min_delta_ms=1.0, min_samples=30):
+    regressions = []
+    for endpoint, before in sorted(baseline['endpoints'].items()):
+        after = report['endpoints'].get(endpoint)
+        if after is None:
+            continue
+
+        old, new = before['latency_ms']['p95'], after['latency_ms']['p95']
+        enough = min(before['count'], after['count']) >= min_samples
+        if enough and new > old * (1 + threshold) and new - old > min_delta_ms:
+            regressions.append('{}: p95 {:.2f}ms -> {:.2f}ms'.format(endpoint, old, new))
+
+        # the worst case is stable across runs, the mean moves with cache hits and the write branch taken
+        old, new = before['queries']['max'], after['queries']['max']
+        if new > old:
+            regressions.append('{}: up to {} queries per request, was {}'.format(endpoint, new, old))
+
+        if after['errors'] > before['errors']:
+            regressions.append('{}: {} server error(s)'.format(endpoint, after['errors']))
+
+    return regressions
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,61 @@
+import time
+
+from app import db
+from app.Loading import ARTICLE_WITH_CONTENT, load_uid, load_user
+from app.Models import User, Article, ArticleVisibility, Channel
+from app.routes.Admin import one_channel_query
+from app.routes.ContentControl import one_article_query
+
+
+def _lookups(aid, cid, username):
+    return {
+        'one_article_query': lambda: one_article_query(aid),
+        'one_article_query_with_content': lambda: one_article_query(aid, ARTICLE_WITH_CONTENT),
+        'one_channel_query': lambda: one_channel_query(cid),
+        'load_user': lambda: load_user(username),
+        'load_uid': lambda: load_uid(username),
+    }
+
+
+def _per_call_us(fn, calls, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        timings.append((time.perf_counter() - started) / calls * 1e6)
+        # keep the identity map from answering for the database
+        db.session.expunge_all()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+#
+# Median microseconds per call of the baked lookup helpers, with the statement cache (baked)
+# and with the session building and compiling the query on every call as before (plain).
+# Calls include the round trip to the database, so use a local dataset.
+#
+def time_lookups(app, calls=2000, rounds=5):
+    report = {}
+    with app.test_request_context():
+        aid = db.session.query(Article.aid).join(Channel).join(User, User.uid == Article.article_author_uid)\
+                        .filter(Channel.visible.is_(True)).filter(User.is_active)\
+                        .filter(Article.visibility == ArticleVisibility.Visible.value)\
+                        .order_by(Article.aid).limit(1).scalar()
+        cid = db.session.query(Article.article_channel_cid).filter(Article.aid == aid).scalar()
+        username = db.session.query(User.username).order_by(User.uid).limit(1).scalar()
+        if aid is None or username is None:
+            raise ValueError('generate a dataset first')
+
+        session = db.session()
+        for name, fn in sorted(_lookups(aid, cid, username).items()):
+            result = {}
+            for mode, enabled in (('plain', False), ('baked', True)):
+                session.enable_baked_queries = enabled
+                fn()
+                result[mode + '_us'] = round(_per_call_us(fn, calls, rounds), 1)
+            result['saved'] = round(1 - result['baked_us'] / result['plain_us'], 3)
+            report[name] = result
+        session.enable_baked_queries = True
+        db.session.remove()
+    return report
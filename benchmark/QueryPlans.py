@@ -0,0 +1,92 @@
+import re
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from app import db
+from benchmark.DataGenerator import ADMIN_NAME
+from benchmark.LoadRunner import DEFAULT_MIX, Client, LoadRunner
+
+# tables small enough that scanning them is fine
+SMALL_TABLES = {'Channel', 'write_checkpoints'}
+
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?')
+_ALIAS_SUFFIX = re.compile(r'_\d+$')
+
+
+#
+# Every distinct statement issued while serving a request, with the first parameters seen
+# and the endpoints that issued it.
+#
+class StatementRecorder(object):
+    def __init__(self, app):
+        self.statements = {}
+        event.listen(db.get_engine(app), 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context():
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        entry = self.statements.setdefault(statement, {'parameters': parameters, 'endpoints': set()})
+        entry['endpoints'].add(request.endpoint or 'unmatched')
+
+
+def _explainable(statement):
+    return statement.lstrip().split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+
+
+#
+# Tables a plan reads in full: type ALL (or a full index scan) on MySQL, SCAN on SQLite.
+#
+def full_scans(connection, dialect, statement, parameters):
+    cursor = connection.cursor()
+    try:
+        if dialect == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            scans = []
+            for row in cursor.fetchall():
+                match = _SQLITE_SCAN.match(row[-1])
+                if match and match.group(1) not in ('CONSTANT', 'SUBQUERY'):
+                    scans.append(_ALIAS_SUFFIX.sub('', match.group(1)))
+            return scans
+
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return [_ALIAS_SUFFIX.sub('', row['table']) for row in rows
+                if row.get('table') and not row['table'].startswith('<') and row.get('type') in ('ALL', 'index')]
+    finally:
+        cursor.close()
+
+
+#
+# Drive every scenario of the load test `iterations` times on one client, then EXPLAIN each
+# statement the routes issued. Returns the plan report and the full scans of tables outside
+# `allowed_tables`, formatted for humans; the run passes when that list is empty.
+#
+def check_query_plans(app, iterations=3, allowed_tables=SMALL_TABLES, seed=1234):
+    runner = LoadRunner(app, clients=1, seed=seed)
+    recorder = StatementRecorder(app)
+    client = Client(runner, runner.targets.users[0], runner.login(app.test_client(), ADMIN_NAME), seed)
+    for scenario in sorted(DEFAULT_MIX):
+        for _ in range(iterations):
+            getattr(client, scenario)()
+
+    report, problems = [], []
+    engine = db.get_engine(app)
+    connection = engine.raw_connection()
+    try:
+        for statement, entry in sorted(recorder.statements.items()):
+            if not _explainable(statement):
+                continue
+            scans = full_scans(connection, engine.dialect.name, statement, entry['parameters'])
+            endpoints = sorted(entry['endpoints'])
+            report.append({'statement': statement, 'endpoints': endpoints, 'full_scans': scans})
+            for table in sorted(set(scans) - set(allowed_tables)):
+                problems.append('{}: full scan of {} in {}'.format(', '.join(endpoints), table,
+                                                                  ' '.join(statement.split())))
+    finally:
+        connection.close()
+
+    return report, problems
@@ -0,0 +1,213 @@
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func
+
+from app import create_app, db, write_behind
+from app.Admission import AdmissionState
+from app.Models import Article, Channel, Comment, User, favorite_table, subscription_table
+from app.Revocation import RevocationBloom
+from benchmark.DataGenerator import ADMIN_NAME, BENCH_PASSWORD, USER_PREFIX
+
+
+#
+# Start `count` threads on `target(i)` at once and wait for them, re-raising the first failure.
+#
+def _hammer(count, target):
+    start, failures = threading.Barrier(count), []
+
+    def run(i):
+        try:
+            start.wait()
+            target(i)
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+
+
+#
+# Threads of one process adding to a file backed filter must not lose each other's bits.
+#
+def check_revocation_bloom(threads=8, adds=2000):
+    with tempfile.TemporaryDirectory() as directory:
+        bloom = RevocationBloom(3600, size_bits=1 << 20, path=os.path.join(directory, 'bloom'))
+        exp = time.time() + 60
+        _hammer(threads, lambda t: [bloom.add('race-{}-{}'.format(t, i), exp) for i in range(adds)])
+        missing = sum(not bloom.might_contain('race-{}-{}'.format(t, i), exp)
+                      for t in range(threads) for i in range(adds))
+    return ['revocation bloom: {} revoked token(s) not found'.format(missing)] if missing else []
+
+
+#
+# Threads of one worker must not share a lease slot or spend the same token twice.
+#
+def check_admission(threads=16, attempts=200, leases=4, burst=50):
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        state = AdmissionState(['race'], 64, 1024, os.path.join(directory, 'state'))
+        granted, taken = [], []
+        _hammer(threads, lambda _: [granted.append(state.acquire('race', leases, 60)) for _ in range(attempts)])
+        granted = [offset for offset in granted if offset is not None]
+        if len(granted) != leases or len(set(granted)) != leases:
+            problems.append('admission: {} lease(s) granted ({} distinct), limit {}'.format(
+                len(granted), len(set(granted)), leases))
+
+        _hammer(threads, lambda _: [taken.append(state.take('race', 1e-6, burst) == 0) for _ in range(attempts)])
+        if sum(taken) != burst:
+            problems.append('admission: {} token(s) spent from a burst of {}'.format(sum(taken), burst))
+    return problems
+
+
+# counter minus actual rows per id, a race shows up as a change of this offset
+def _like_offsets(aids):
+    rows = db.session.query(Article.aid, Article.like_count, func.count(favorite_table.c.fav_user_uid))\
+                     .outerjoin(favorite_table, favorite_table.c.fav_article_aid == Article.aid)\
+                     .filter(Article.aid.in_(aids)).group_by(Article.aid, Article.like_count)
+    return {aid: count - rows for aid, count, rows in rows}
+
+
+def _subscriber_offsets(cids):
+    rows = db.session.query(Channel.cid, Channel.subscriber_count, func.count(subscription_table.c.sub_user_uid))\
+                     .outerjoin(subscription_table, subscription_table.c.sub_channel_cid == Channel.cid)\
+                     .filter(Channel.cid.in_(cids)).group_by(Channel.cid, Channel.subscriber_count)
+    return {cid: count - rows for cid, count, rows in rows}
+
+
+def _comment_offsets(aids):
+    rows = db.session.query(Article.aid, Article.comment_count, func.count(Comment.coid))\
+                     .outerjoin(Comment, Comment.comment_article_aid == Article.aid)\
+                     .filter(Article.aid.in_(aids)).group_by(Article.aid, Article.comment_count)
+    return {aid: count - rows for aid, count, rows in rows}
+
+
+def _drifted(name, before, after):
+    return ['{} {}: counter off by {} after the race'.format(name, key, after[key] - before[key])
+            for key in sorted(before) if after.get(key) != before[key]]
+
+
+def _login(http, username):
+    response = http.post('/api/user/login', json={'username': username, 'password': BENCH_PASSWORD})
+    if response.status_code != 200:
+        raise RuntimeError('cannot log in as {}: {}'.format(username, response.get_data(as_text=True)))
+    return {'Authorization': 'Bearer ' + response.get_json()['access-token']}
+
+
+def _targets(app, articles, channels):
+    with app.app_context():
+        username = db.session.query(User.username).filter(User.username.like(USER_PREFIX + '%'))\
+                                                  .filter(User.is_active).limit(1).scalar()
+        aids = [row.aid for row in db.session.query(Article.aid).filter(Article.visibility == 1)
+                                                                .order_by(Article.aid).limit(articles)]
+        cids = [row.cid for row in db.session.query(Channel.cid).filter(Channel.visible.is_(True))
+                                                                .order_by(Channel.cid).limit(channels)]
+        db.session.remove()
+    if not username or not aids or not cids:
+        raise RuntimeError('no benchmark data found, run `python -m benchmark generate` first')
+    return username, aids, cids
+
+
+#
+# One user likes/unlikes and subscribes/unsubscribes the same ids in bulk from several threads;
+# the counters must still match the rows. The user's likes and subscriptions are restored.
+#
+def check_bulk_counters(app, threads=8, rounds=10):
+    username, aids, cids = _targets(app, 10, 5)
+    headers = _login(app.test_client(), username)
+    with app.app_context():
+        uid = db.session.query(User.uid).filter_by(username=username).scalar()
+        liked = {row.fav_article_aid for row in db.session.query(favorite_table.c.fav_article_aid)
+                 .filter(favorite_table.c.fav_user_uid == uid).filter(favorite_table.c.fav_article_aid.in_(aids))}
+        subscribed = {row.sub_channel_cid for row in db.session.query(subscription_table.c.sub_channel_cid)
+                      .filter(subscription_table.c.sub_user_uid == uid)
+                      .filter(subscription_table.c.sub_channel_cid.in_(cids))}
+        likes, subscribers = _like_offsets(aids), _subscriber_offsets(cids)
+        db.session.remove()
+
+    def race(i):
+        http = app.test_client()
+        for n in range(rounds):
+            flip = (i + n) % 2
+            http.post('/api/like' if flip else '/api/unlike', json={'aids': aids}, headers=headers)
+            http.post('/api/subscribe' if flip else '/api/unsubscribe', json={'cids': cids}, headers=headers)
+
+    _hammer(threads, race)
+
+    with app.app_context():
+        problems = _drifted('like_count of article', likes, _like_offsets(aids)) + \
+            _drifted('subscriber_count of channel', subscribers, _subscriber_offsets(cids))
+        db.session.remove()
+
+    http = app.test_client()
+    http.post('/api/unlike', json={'aids': [aid for aid in aids if aid not in liked]}, headers=headers)
+    http.post('/api/like', json={'aids': list(liked)}, headers=headers)
+    http.post('/api/unsubscribe', json={'cids': [cid for cid in cids if cid not in subscribed]}, headers=headers)
+    http.post('/api/subscribe', json={'cids': list(subscribed)}, headers=headers)
+    return problems
+
+
+#
+# Likes, unlikes and comments acknowledged by the write-behind log from several threads while
+# the flusher runs; once the log is applied the counters must match the rows. The user's likes
+# are restored and the comments deleted.
+#
+def check_write_behind(config, threads=8, rounds=20):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(dict(config, WRITE_BEHIND_ENABLED=True, WRITE_BEHIND_FLUSH_INTERVAL=0.05,
+                              WRITE_BEHIND_LOG_PATH=os.path.join(directory, 'writes.db')))
+        username, aids, _ = _targets(app, 4, 1)
+        headers = _login(app.test_client(), username)
+        with app.app_context():
+            uid = db.session.query(User.uid).filter_by(username=username).scalar()
+            liked = {row.fav_article_aid for row in db.session.query(favorite_table.c.fav_article_aid)
+                     .filter(favorite_table.c.fav_user_uid == uid).filter(favorite_table.c.fav_article_aid.in_(aids))}
+            likes, comments = _like_offsets(aids), _comment_offsets(aids)
+            first_coid = db.session.query(func.max(Comment.coid)).scalar() or 0
+            db.session.remove()
+
+        def race(i):
+            http = app.test_client()
+            for n in range(rounds):
+                aid = aids[(i + n) % len(aids)]
+                http.get('/api/{}/{}'.format('like' if (i + n) % 3 else 'unlike', aid), headers=headers)
+                if n % 5 == 0:
+                    http.post('/api/article/comment/{}'.format(aid), json={'comment': 'race comment'},
+                              headers=headers)
+
+        _hammer(threads, race)
+
+        with app.app_context():
+            while write_behind.log.pending():
+                write_behind.flush()
+            problems = _drifted('like_count of article', likes, _like_offsets(aids)) + \
+                _drifted('comment_count of article', comments, _comment_offsets(aids))
+            coids = [row.coid for row in db.session.query(Comment.coid).filter(Comment.coid > first_coid)
+                                                                     .filter(Comment.comment_user_uid == uid)]
+            db.session.remove()
+
+        http = app.test_client()
+        for aid in aids:
+            http.get('/api/{}/{}'.format('like' if aid in liked else 'unlike', aid), headers=headers)
+        http.post('/api/article/comments/delete', json={'coids': coids}, headers=_login(http, ADMIN_NAME))
+        with app.app_context():
+            write_behind.flush()
+            db.session.remove()
+    return problems
+
+
+#
+# Every check above, returns the problems found formatted for humans; empty when all pass.
+#
+def check_races(config):
+    problems = check_revocation_bloom() + check_admission()
+    problems += check_bulk_counters(create_app(config))
+    problems += check_write_behind(config)
+    return problems
@@ -0,0 +1,160 @@
+import json
+import sys
+
+import click
+
+from app import create_app
+
+
+def _config(database_uri, overrides):
+    # every simulated client shares one address, per client rate limits would throttle the whole run
+    config = {'SQLALCHEMY_DATABASE_URI': database_uri, 'ADMISSION_RATES': {}}
+    if database_uri.startswith('sqlite'):
+        # concurrent clients share one file, wait for the write lock instead of failing
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+    for override in overrides:
+        key, _, value = override.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+@click.group()
+def cli():
+    """Synthetic data and load benchmarks for the Koinu API."""
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI, e.g. sqlite:////tmp/koinu-bench.db')
+@click.option('--users', default=10000, show_default=True)
+@click.option('--channels', default=200, show_default=True)
+@click.option('--articles', default=100000, show_default=True)
+@click.option('--subscriptions', default=200000, show_default=True)
+@click.option('--likes', default=500000, show_default=True)
+@click.option('--comments', default=200000, show_default=True)
+@click.option('--hot-channels', default=5, show_default=True, help='Channels boosted above the zipf curve.')
+@click.option('--hot-factor', default=4.0, show_default=True)
+@click.option('--channel-skew', default=1.1, show_default=True, help='Zipf exponent for channel popularity.')
+@click.option('--article-skew', default=1.05, show_default=True, help='Zipf exponent for article popularity.')
+@click.option('--seed', default=1234, show_default=True)
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def generate(database_uri, overrides, **kwargs):
+    """Fill a database with a skewed synthetic dataset."""
+    from benchmark.DataGenerator import generate as generate_dataset
+
+    app = create_app(_config(database_uri, overrides))
+    with app.app_context():
+        counts = generate_dataset(log=click.echo, **kwargs)
+    click.echo(json.dumps(counts, indent=2))
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI of a generated dataset.')
+@click.option('--clients', default=8, show_default=True, help='Concurrent client threads.')
+@click.option('--duration', default=30.0, show_default=True, help='Seconds to run.')
+@click.option('--iterations', type=int, help='Stop each client after this many scenarios.')
+@click.option('--mix', help='JSON object of scenario weights replacing the default mix.')
+@click.option('--pool-size', default=10000, show_default=True, help='Popular articles/channels to draw from.')
+@click.option('--skew', default=1.05, show_default=True, help='Zipf exponent for picking targets.')
+@click.option('--seed', default=1234, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Fail on regressions against it.')
+@click.option('--threshold', default=0.25, show_default=True, help='Allowed relative p95 latency growth.')
+@click.option('--min-delta-ms', default=1.0, show_default=True, help='Ignore p95 changes smaller than this.')
+@click.option('--min-samples', default=30, show_default=True, help='Skip latency checks on rarer endpoints.')
+@click.option('--save-baseline', type=click.Path(dir_okay=False), help='Store this run as the new baseline.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def run(database_uri, clients, duration, iterations, mix, pool_size, skew, seed, output, baseline, threshold,
+        min_delta_ms, min_samples, save_baseline, overrides):
+    """Drive every API route with concurrent clients and report latency and query counts."""
+    from benchmark.LoadRunner import LoadRunner, compare, load_report, save_report
+
+    app = create_app(_config(database_uri, overrides))
+    runner = LoadRunner(app, clients=clients, duration=duration, iterations=iterations,
+                        mix=json.loads(mix) if mix else None, pool_size=pool_size, skew=skew, seed=seed)
+    report = runner.run()
+
+    if output:
+        save_report(report, output)
+    else:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+    if save_baseline:
+        save_report(report, save_baseline)
+
+    if report['failures']:
+        click.echo('client failures:\n  ' + '\n  '.join(report['failures']), err=True)
+    if baseline:
+        regressions = compare(report, load_report(baseline), threshold, min_delta_ms, min_samples)
+        if regressions:
+            click.echo('regressions against {}:\n  {}'.format(baseline, '\n  '.join(regressions)), err=True)
+            sys.exit(1)
+    if report['failures']:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI of a generated dataset.')
+@click.option('--iterations', default=3, show_default=True, help='Runs of each load test scenario.')
+@click.option('--allow-table', 'allowed_tables', multiple=True, help='Table that may be scanned in full, repeatable.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write every statement and its scans here as JSON.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def explain(database_uri, iterations, allowed_tables, output, overrides):
+    """EXPLAIN every statement the routes issue and fail on full table scans."""
+    from benchmark.QueryPlans import SMALL_TABLES, check_query_plans
+
+    app = create_app(_config(database_uri, overrides))
+    report, problems = check_query_plans(app, iterations, SMALL_TABLES | set(allowed_tables))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    click.echo('{} statement(s) explained'.format(len(report)))
+
+    if problems:
+        click.echo('full scans:\n  ' + '\n  '.join(problems), err=True)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI of a generated dataset.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def races(database_uri, overrides):
+    """Hammer the shared state and counters from concurrent threads and fail on lost updates."""
+    from benchmark.Races import check_races
+
+    problems = check_races(_config(database_uri, overrides))
+    if problems:
+        click.echo('races:\n  ' + '\n  '.join(problems), err=True)
+        sys.exit(1)
+    click.echo('no lost updates')
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI of a generated dataset.')
+@click.option('--calls', default=2000, show_default=True, help='Calls of each helper per round.')
+@click.option('--rounds', default=5, show_default=True, help='Rounds per helper, the median is reported.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def lookups(database_uri, calls, rounds, overrides):
+    """Time the hot lookup helpers with and without their baked query cache."""
+    from benchmark.Lookups import time_lookups
+
+    app = create_app(_config(database_uri, overrides))
+    click.echo(json.dumps(time_lookups(app, calls, rounds), indent=2, sort_keys=True))
+
+
+@cli.command()
+@click.option('--database-uri', required=True, help='SQLAlchemy URI of a generated dataset.')
+@click.option('--articles', default=1000, show_default=True, help='Articles in the encoded payload.')
+@click.option('--rounds', default=50, show_default=True, help='Encodings per backend, the median is reported.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Override an app config entry.')
+def encode(database_uri, articles, rounds, overrides):
+    """Time JSON encoding of a long article listing with every installed backend."""
+    from benchmark.Encoding import time_encoding
+
+    app = create_app(_config(database_uri, overrides))
+    click.echo(json.dumps(time_encoding(app, articles, rounds), indent=2, sort_keys=True))
+
+
+cli(prog_name='python -m benchmark')
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+import time
+
+#
+# gunicorn -c gunicorn.conf.py app:app_instance
+# The app is imported once by the master and forked into the workers, see app/Startup.py.
+#
+os.environ.setdefault('KOINU_ENV', 'production')
+
+bind = os.environ.get('KOINU_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('KOINU_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+
+_started = time.time()
+
+
+# runs in the master before the first worker is forked
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app import app_instance, request_metrics, startup
+
+        request_metrics.clear()
+        server.log.info('app preloaded in %.3fs', startup.prepare(app_instance, _started))
+
+
+def post_fork(server, worker):
+    from app import app_instance, startup
+
+    startup.after_fork(app_instance)
+
+
+# runs before the worker accepts connections
+def post_worker_init(worker):
+    from app import app_instance, startup
+
+    startup_seconds, warm_up_seconds = startup.warm_up(app_instance)
+    worker.log.info('worker %d ready in %.3fs (warm-up %.3fs)', worker.pid, startup_seconds, warm_up_seconds)
@@ -0,0 +1,36 @@
+"""denormalized like, comment and subscriber counters
+
+Revision ID: 3c1f0e8a2b7d
+Revises: 685cfdcec9dd
+Create Date: 2026-10-18 13:30:12.418820
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0e8a2b7d'
+down_revision = '685cfdcec9dd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Article', sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('Article', sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('Channel', sa.Column('subscriber_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill, later drift is fixed with `flask reconcile-counters`
+    op.execute('UPDATE Article SET like_count = '
+               '(SELECT count(*) FROM favorites WHERE favorites.fav_article_aid = Article.aid)')
+    op.execute('UPDATE Article SET comment_count = '
+               '(SELECT count(*) FROM comments WHERE comments.comment_article_aid = Article.aid)')
+    op.execute('UPDATE Channel SET subscriber_count = '
+               '(SELECT count(*) FROM subscriptions WHERE subscriptions.sub_channel_cid = Channel.cid)')
+
+
+def downgrade():
+    op.drop_column('Channel', 'subscriber_count')
+    op.drop_column('Article', 'comment_count')
+    op.drop_column('Article', 'like_count')
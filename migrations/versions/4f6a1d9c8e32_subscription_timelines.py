@@ -0,0 +1,70 @@
+"""subscription timelines
+
+Revision ID: 4f6a1d9c8e32
+Revises: e5a97b3d4c20
+Create Date: 2026-10-18 15:20:33.905126
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f6a1d9c8e32'
+down_revision = 'e5a97b3d4c20'
+branch_labels = None
+depends_on = None
+
+
+#
+# Seed like app/Timeline.py would have: the TIMELINE_BACKFILL latest visible articles of each
+# visible channel, for its subscribers, skipping channels above TIMELINE_FANOUT_LIMIT which are
+# read on demand. Subscriptions may hold duplicate rows at this revision.
+#
+def seed_timelines():
+    bind = op.get_bind()
+    fanout_limit = current_app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+    backfill = current_app.config.get('TIMELINE_BACKFILL', 50)
+
+    latest = sa.text('SELECT aid FROM Article WHERE article_channel_cid = :cid AND visibility = 1 '
+                     'AND article_created IS NOT NULL ORDER BY article_created DESC, aid DESC LIMIT :backfill')
+    seed = sa.text('INSERT INTO timelines (tl_user_uid, tl_article_aid, tl_channel_cid, tl_created) '
+                   'SELECT DISTINCT s.sub_user_uid, a.aid, a.article_channel_cid, a.article_created '
+                   'FROM subscriptions s JOIN Article a ON a.article_channel_cid = s.sub_channel_cid '
+                   'WHERE s.sub_channel_cid = :cid AND a.aid IN :aids')\
+        .bindparams(sa.bindparam('aids', expanding=True))
+
+    cids = [row[0] for row in bind.execute(sa.text('SELECT cid FROM Channel WHERE visible = 1 '
+                                                   'AND subscriber_count <= :fanout_limit'),
+                                           fanout_limit=fanout_limit)]
+    for cid in cids:
+        aids = [row[0] for row in bind.execute(latest, cid=cid, backfill=backfill)]
+        if aids:
+            bind.execute(seed, cid=cid, aids=aids)
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('tl_user_uid', sa.Integer(), nullable=False),
+    sa.Column('tl_article_aid', sa.Integer(), nullable=False),
+    sa.Column('tl_channel_cid', sa.Integer(), nullable=False),
+    sa.Column('tl_created', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['tl_article_aid'], ['Article.aid'], ),
+    sa.ForeignKeyConstraint(['tl_channel_cid'], ['Channel.cid'], ),
+    sa.ForeignKeyConstraint(['tl_user_uid'], ['User.uid'], ),
+    sa.PrimaryKeyConstraint('tl_user_uid', 'tl_article_aid')
+    )
+    op.create_index('ix_timelines_user_created', 'timelines', ['tl_user_uid', 'tl_created', 'tl_article_aid'],
+                    unique=False)
+    op.create_index('ix_timelines_article', 'timelines', ['tl_article_aid'], unique=False)
+    op.create_index('ix_timelines_channel', 'timelines', ['tl_channel_cid'], unique=False)
+
+    seed_timelines()
+
+
+def downgrade():
+    op.drop_index('ix_timelines_channel', table_name='timelines')
+    op.drop_index('ix_timelines_article', table_name='timelines')
+    op.drop_index('ix_timelines_user_created', table_name='timelines')
+    op.drop_table('timelines')
@@ -0,0 +1,59 @@
+"""join table keys
+
+Revision ID: 5e0c7a92b1f3
+Revises: d91b4e7a3f58
+Create Date: 2026-10-18 18:41:12.274519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0c7a92b1f3'
+down_revision = 'd91b4e7a3f58'
+branch_labels = None
+depends_on = None
+
+# table, primary key columns (user first), reverse index, (counting table, its key, counter) of 3c1f0e8a2b7d
+JOIN_TABLES = [
+    ('favorites', ['fav_user_uid', 'fav_article_aid'], 'ix_favorites_article', ('Article', 'aid', 'like_count')),
+    ('subscriptions', ['sub_user_uid', 'sub_channel_cid'], 'ix_subscriptions_channel',
+     ('Channel', 'cid', 'subscriber_count'))
+]
+
+
+def dedupe(table, columns, counter):
+    # only the duplicated pairs are copied out and back, the rest of the table stays untouched
+    op.execute('DELETE FROM {} WHERE {} IS NULL OR {} IS NULL'.format(table, *columns))
+    op.execute('CREATE TABLE {0}_dupes AS SELECT {1}, {2} FROM {0} GROUP BY {1}, {2} HAVING COUNT(*) > 1'
+               .format(table, *columns))
+    op.execute('DELETE FROM {0} WHERE ({1}, {2}) IN (SELECT {1}, {2} FROM {0}_dupes)'.format(table, *columns))
+    op.execute('INSERT INTO {0} ({1}, {2}) SELECT {1}, {2} FROM {0}_dupes'.format(table, *columns))
+    # the counters were backfilled with the duplicates counted, recount the rows they touched
+    counting, key, count = counter
+    op.execute('UPDATE {0} SET {2} = (SELECT COUNT(*) FROM {3} WHERE {3}.{4} = {0}.{1}) '
+               'WHERE {1} IN (SELECT {4} FROM {3}_dupes)'.format(counting, key, count, table, columns[1]))
+    op.execute('DROP TABLE {}_dupes'.format(table))
+
+
+def upgrade():
+    for table, columns, reverse_index, counter in JOIN_TABLES:
+        dedupe(table, columns, counter)
+        with op.batch_alter_table(table) as batch_op:
+            for column in columns:
+                batch_op.alter_column(column, existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key('pk_' + table, columns)
+            batch_op.create_index(reverse_index, columns[::-1], unique=False)
+
+
+def downgrade():
+    for table, columns, reverse_index, _ in JOIN_TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            # the foreign keys need an index of their own once the composite ones are gone
+            for column in columns:
+                batch_op.create_index(column, [column], unique=False)
+            batch_op.drop_index(reverse_index)
+            batch_op.drop_constraint('pk_' + table, type_='primary')
+            for column in columns:
+                batch_op.alter_column(column, existing_type=sa.Integer(), nullable=True)
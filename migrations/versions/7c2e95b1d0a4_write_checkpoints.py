@@ -0,0 +1,28 @@
+"""write checkpoints
+
+Revision ID: 7c2e95b1d0a4
+Revises: a3d8f20c6b17
+Create Date: 2026-10-18 17:11:05.482310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e95b1d0a4'
+down_revision = 'a3d8f20c6b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('write_checkpoints',
+    sa.Column('log_id', sa.String(length=32), nullable=False),
+    sa.Column('last_seq', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('log_id')
+    )
+
+
+def downgrade():
+    op.drop_table('write_checkpoints')
@@ -0,0 +1,56 @@
+"""article excerpts
+
+Revision ID: a3d8f20c6b17
+Revises: 4f6a1d9c8e32
+Create Date: 2026-10-18 16:02:41.317092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d8f20c6b17'
+down_revision = '4f6a1d9c8e32'
+branch_labels = None
+depends_on = None
+
+EXCERPT_LENGTH = 200
+BATCH_SIZE = 1000
+
+article = sa.table('Article',
+                   sa.column('aid', sa.Integer),
+                   sa.column('content', sa.Text),
+                   sa.column('excerpt', sa.String))
+
+
+# frozen copy of Article.excerpt_of
+def excerpt_of(content):
+    text = ' '.join((content or '').split())
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = text[:EXCERPT_LENGTH - 3]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut + '...'
+
+
+def upgrade():
+    op.add_column('Article', sa.Column('excerpt', sa.String(length=EXCERPT_LENGTH), server_default='',
+                                       nullable=False))
+
+    conn = op.get_bind()
+    last_aid = 0
+    while True:
+        rows = conn.execute(sa.select([article.c.aid, article.c.content])
+                            .where(article.c.aid > last_aid).order_by(article.c.aid).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        conn.execute(article.update().where(article.c.aid == sa.bindparam('b_aid'))
+                                     .values(excerpt=sa.bindparam('b_excerpt')),
+                     [{'b_aid': row.aid, 'b_excerpt': excerpt_of(row.content)} for row in rows])
+        last_aid = rows[-1].aid
+
+
+def downgrade():
+    op.drop_column('Article', 'excerpt')
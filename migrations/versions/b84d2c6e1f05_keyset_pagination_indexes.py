@@ -0,0 +1,30 @@
+"""keyset pagination indexes
+
+Revision ID: b84d2c6e1f05
+Revises: 3c1f0e8a2b7d
+Create Date: 2026-10-18 14:02:47.103385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b84d2c6e1f05'
+down_revision = '3c1f0e8a2b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Article_channel_created', 'Article', ['article_channel_cid', 'article_created', 'aid'],
+                    unique=False)
+    op.create_index('ix_Article_created', 'Article', ['article_created', 'aid'], unique=False)
+    op.create_index('ix_comments_article_created', 'comments', ['comment_article_aid', 'comment_created', 'coid'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comments_article_created', table_name='comments')
+    op.drop_index('ix_Article_created', table_name='Article')
+    op.drop_index('ix_Article_channel_created', table_name='Article')
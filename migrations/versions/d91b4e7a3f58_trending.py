@@ -0,0 +1,32 @@
+"""trending
+
+Revision ID: d91b4e7a3f58
+Revises: 7c2e95b1d0a4
+Create Date: 2026-10-18 18:02:47.660314
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91b4e7a3f58'
+down_revision = '7c2e95b1d0a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trending',
+    sa.Column('tr_article_aid', sa.Integer(), nullable=False),
+    sa.Column('tr_epoch', sa.Integer(), nullable=False),
+    sa.Column('tr_score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['tr_article_aid'], ['Article.aid'], ),
+    sa.PrimaryKeyConstraint('tr_article_aid')
+    )
+    op.create_index('ix_trending_epoch_score', 'trending', ['tr_epoch', 'tr_score'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_trending_epoch_score', table_name='trending')
+    op.drop_table('trending')
@@ -0,0 +1,46 @@
+"""materialized article visibility and channel visible flag
+
+Revision ID: e5a97b3d4c20
+Revises: b84d2c6e1f05
+Create Date: 2026-10-18 14:41:05.662174
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a97b3d4c20'
+down_revision = 'b84d2c6e1f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Article', sa.Column('visibility', sa.SmallInteger(), server_default='2', nullable=False))
+    op.add_column('Channel', sa.Column('visible', sa.Boolean(), server_default='1', nullable=False))
+
+    # same mapping as Article.visibility_of: 0 hidden, 1 visible, 2 requested
+    op.execute('UPDATE Article SET visibility = CASE WHEN article_status & 4 != 0 THEN 0 '
+               'WHEN article_status & 8 != 0 THEN 2 ELSE 1 END')
+    op.execute('UPDATE Channel SET visible = CASE WHEN status & 4 != 0 THEN 0 ELSE 1 END')
+
+    op.drop_index('ix_Article_channel_created', table_name='Article')
+    op.drop_index('ix_Article_created', table_name='Article')
+    op.create_index('ix_Article_channel_visibility_created', 'Article',
+                    ['article_channel_cid', 'visibility', 'article_created', 'aid'], unique=False)
+    op.create_index('ix_Article_visibility_created', 'Article', ['visibility', 'article_created', 'aid'],
+                    unique=False)
+    op.create_index('ix_Channel_visible', 'Channel', ['visible', 'cid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Channel_visible', table_name='Channel')
+    op.drop_index('ix_Article_visibility_created', table_name='Article')
+    op.drop_index('ix_Article_channel_visibility_created', table_name='Article')
+    op.create_index('ix_Article_created', 'Article', ['article_created', 'aid'], unique=False)
+    op.create_index('ix_Article_channel_created', 'Article', ['article_channel_cid', 'article_created', 'aid'],
+                    unique=False)
+
+    op.drop_column('Channel', 'visible')
+    op.drop_column('Article', 'visibility')
@@ -1,4 +1,5 @@
 source venv/bin/activate
 export FLASK_ENV=development
+export KOINU_ENV=debug
 export FLASK_APP=app/__init__.py
 flask run